@@ -21,8 +21,25 @@ class AnalyticsService(analytics_service_pb2_grpc.AnalyticsService):
         request: analytics_service_pb2.InferSymptomsAndCauseRequest,
         context: grpc.aio.ServicerContext,
     ) -> analytics_service_pb2.InferSymptomsAndCauseResponse:
-        # Implement your logic here
-        inferred = llm.infer_symptoms_and_cause(request.text)
+        # The inference is awaited on the event loop, so other RPCs are served
+        # meanwhile. It gives up at the client's deadline, if that is sooner than the
+        # inference timeout, and a cancelled RPC cancels its task and with it the
+        # request to Gemini.
+        remaining = context.time_remaining() if context is not None else None
+        timeout = None
+        if remaining is not None:
+            timeout = min(remaining, llm.INFERENCE_TIMEOUT)
+        try:
+            inferred = await llm.ainfer_symptoms_and_cause(
+                request.text, timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logging.warning("Symptom inference timed out.")
+            return analytics_service_pb2.InferSymptomsAndCauseResponse(success=False)
+        except Exception as e:
+            logging.error("Symptom inference failed: %s", e)
+            return analytics_service_pb2.InferSymptomsAndCauseResponse(success=False)
+
         return analytics_service_pb2.InferSymptomsAndCauseResponse(
             symptoms=inferred.symptoms,
             cause=inferred.cause,
@@ -1,8 +1,11 @@
 import logging
 import statistics
+from functools import cache
 import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from sklearn import metrics
-1
 from google.protobuf.json_format import ParseDict
 from collections import defaultdict
 import uuid
@@ -10,22 +13,179 @@ import uuid
 import calcs
 
 from generated import cluster_pb2, location_pb2
+from geo import EARTH_RADIUS_M, haversine_rad, to_unit_sphere
+
+class NeighborGraph:
+    """
+    Haversine distances between every pair of locations within eps_m of each other,
+    for every location clustered so far.
+
+    Readings for overlapping timespans and similarities cluster mostly the same
+    reports, so their neighbours are only searched for once: the first time a
+    location is seen, with a KD-tree over every known location on the unit sphere.
+    DBSCAN then runs on the precomputed subgraph of the requested reports.
+    """
+
+    def __init__(self, eps_m: float, max_locations: int = 500_000):
+        self.eps_rad = eps_m / EARTH_RADIUS_M
+        self.max_locations = max_locations
+        self._clear()
+
+    def _clear(self):
+        self._nodes: dict[tuple[float, float], int] = {}
+        self._coords_rad = np.empty((0, 2))
+        self._graph = sparse.csr_matrix((0, 0))
+
+    def subgraph(
+        self, coords: np.ndarray
+    ) -> tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+        """
+        Distances between the distinct locations of the given [n, 2] lat/lon points.
+
+        Returns:
+            The sparse [m, m] matrix of distances in radians between the m distinct
+            locations, in order of first appearance, holding every pair within eps_m
+            and the diagonal as explicit zeros; the number of points at each location;
+            and the location of each point.
+        """
+        keys = list(zip(coords[:, 0].tolist(), coords[:, 1].tolist()))
+        new_keys = list(dict.fromkeys(k for k in keys if k not in self._nodes))
+
+        if len(self._nodes) + len(new_keys) > self.max_locations:
+            # Start over rather than grow without bound. Only the requested locations
+            # are kept.
+            self._clear()
+            new_keys = list(dict.fromkeys(keys))
+        if new_keys:
+            self._add(new_keys)
+
+        nodes = np.fromiter(
+            (self._nodes[k] for k in keys), dtype=np.int64, count=len(keys)
+        )
+        unique, first, inverse, counts = np.unique(
+            nodes, return_index=True, return_inverse=True, return_counts=True
+        )
+
+        # Distinct locations in order of first appearance, as DBSCAN numbers clusters
+        # by it.
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        locations = unique[order]
+
+        # Rows of the requested locations, keeping only their columns among them.
+        position = np.full(len(self._nodes), -1, dtype=np.int64)
+        position[locations] = np.arange(len(locations))
+        rows = self._graph[locations].tocoo()
+        keep = position[rows.col] >= 0
+        graph = sparse.csr_matrix(
+            (rows.data[keep], (rows.row[keep], position[rows.col[keep]])),
+            shape=(len(locations), len(locations))
+        )
+
+        return graph, counts[order], rank[inverse.ravel()]
+
+    def _add(self, keys: list[tuple[float, float]]):
+        n_old = len(self._nodes)
+        for i, key in enumerate(keys):
+            self._nodes[key] = n_old + i
+        self._coords_rad = np.vstack(
+            [ self._coords_rad, np.radians(np.array(keys, dtype=np.float64)) ]
+        )
+        n = len(self._coords_rad)
+
+        # Candidate neighbours of the new locations among all of them, themselves
+        # included, from a KD-tree of points on the unit sphere, where eps is a chord.
+        # Candidates are then kept by their haversine distance, so the pairs are those
+        # a haversine DBSCAN would find.
+        xyz = to_unit_sphere(*np.degrees(self._coords_rad).T).T
+        chord = 2 * np.sin(self.eps_rad / 2) * (1 + 1e-9)
+        pairs = cKDTree(xyz[n_old:]).sparse_distance_matrix(
+            cKDTree(xyz), chord, output_type="ndarray"
+        )
+
+        rows = pairs["i"].astype(np.int64) + n_old
+        cols = pairs["j"].astype(np.int64)
+        lat1, lon1 = self._coords_rad[rows].T
+        lat2, lon2 = self._coords_rad[cols].T
+        dists = haversine_rad(lat1, lon1, lat2, lon2)
+        within = dists <= self.eps_rad
+        rows, cols, dists = rows[within], cols[within], dists[within]
+
+        # Edges to earlier locations are added in both directions. Edges between new
+        # locations are found from both ends already.
+        old = cols < n_old
+        rows, cols, dists = (
+            np.concatenate([ rows, cols[old] ]),
+            np.concatenate([ cols, rows[old] ]),
+            np.concatenate([ dists, dists[old] ])
+        )
+
+        graph = self._graph.tocoo()
+        data = np.concatenate([ graph.data, dists ])
+        rows = np.concatenate([ graph.row, rows ])
+        cols = np.concatenate([ graph.col, cols ])
+        self._graph = sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+def dbscan_labels(
+    distances: sparse.csr_matrix, weights: np.ndarray, min_samples: int
+) -> np.ndarray:
+    """
+    DBSCAN labels from a precomputed graph of every pair of points within eps, such as
+    NeighborGraph.subgraph, with -1 for noise.
+
+    Gives the same labels as sklearn's DBSCAN(metric="precomputed") with
+    sample_weight, without its per-point neighbourhood lists: core points are
+    connected in components, numbered in order of their first point, and a border
+    point takes the first cluster of its core neighbours.
+    """
+    n = distances.shape[0]
+    # Stored entries are the neighbours, including explicit zeros.
+    adjacency = sparse.csr_matrix(
+        (np.ones(distances.nnz), distances.indices, distances.indptr), shape=(n, n)
+    )
+
+    core = adjacency @ weights >= min_samples
+    core_points = np.flatnonzero(core)
+    labels = np.full(n, -1, dtype=np.int64)
+    if len(core_points) == 0:
+        return labels
+
+    _, components = connected_components(
+        adjacency[core_points][:, core_points], directed=False
+    )
+    _, first = np.unique(components, return_index=True)
+    cluster_of_component = np.empty(len(first), dtype=np.int64)
+    cluster_of_component[np.argsort(first, kind="stable")] = np.arange(len(first))
+    labels[core_points] = cluster_of_component[components]
+
+    edges = adjacency.tocoo()
+    border = ~core[edges.row] & core[edges.col]
+    border_labels = np.full(n, n, dtype=np.int64)
+    np.minimum.at(border_labels, edges.row[border], labels[edges.col[border]])
+    reached = border_labels < n
+    labels[reached] = border_labels[reached]
+    return labels
+
+@cache
+def neighbor_graph(eps_m: float) -> NeighborGraph:
+    """The service's neighbour graph for this radius, shared by every reading."""
+    return NeighborGraph(eps_m)
 
 # Find clusters of reports based on location, time and similarity.
 def calculate_clusters(reports: list) -> list[cluster_pb2.Cluster]:
     # Use DBSCAN to group clusters of reports.
-    coords = np.array([ [r['lat'], r['lon']] for r in reports ])
-    coords_rad = np.radians(coords)
+    coords = np.array(
+        [ [r['lat'], r['lon']] for r in reports ], dtype=np.float64
+    ).reshape(-1, 2)
 
     # Use epsilon as 500m to check for incidences in neighborhoods.
     eps_m = 500.0
+    graph = neighbor_graph(eps_m)
 
-    # Convert to radians
-    earth_radius_m = 6_378_000
-    eps_rad = eps_m / earth_radius_m
-
-    dbscan = DBSCAN(eps=eps_rad, min_samples=3, metric="haversine").fit(coords_rad)
-    labels = dbscan.labels_
+    # Points at the same location are clustered once, weighted by their number.
+    distances, weights, location_of = graph.subgraph(coords)
+    labels = dbscan_labels(distances, weights, min_samples=3)[location_of]
     logging.debug(labels)
 
     # Number of clusters in labels, ignoring noise if present.
@@ -40,15 +200,23 @@ def calculate_clusters(reports: list) -> list[cluster_pb2.Cluster]:
     for report, label in zip(reports, labels):
         clusters_dict[label].append(report)
     
+    # Areas and centroids of every cluster, projected in one batch.
+    clusters_points = {
+        cid: [location_pb2.Location(lat=rl['lat'], lon=rl['lon']) for rl in rls]
+        for cid, rls in clusters_dict.items()
+    }
+    areas = dict(
+        zip(clusters_points, calcs.cluster_areas(list(clusters_points.values())))
+    )
+
     # Convert to list of dicts
     clusters: list[cluster_pb2.Cluster] = []
     for cid, rls in clusters_dict.items():
-        points = [location_pb2.Location(lat=rl['lat'], lon=rl['lon']) for rl in rls]
+        points = clusters_points[cid]
 
-        try:
-            area, centroid = calcs.cluster_area(points)
-        except Exception as e:
+        if areas[cid] is None:
             continue
+        area, centroid = areas[cid]
         
         density = len(rls) / area
         centroid = location_pb2.Location(
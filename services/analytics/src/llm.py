@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import mimetypes
 import os
@@ -14,20 +15,26 @@ client = genai.Client(
     api_key=os.environ.get("GEMINI_API_KEY"),
 )
 
-def infer_symptoms_and_cause(text: str) -> InferredSymptoms:
-    """Uses Gemini to infer symptoms and their likely cause from free-text input."""
-    model = "gemini-2.5-pro"
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text=text),
-            ],
-        ),
-    ]
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
+# Requests that wait longer than this for Gemini are abandoned, unless the gRPC
+# deadline is sooner.
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "30"))
+# Inferences in flight at once. Further requests wait for a slot.
+INFERENCE_CONCURRENCY = int(os.environ.get("INFERENCE_CONCURRENCY", "8"))
+
+_inference_slots: asyncio.Semaphore = None
+
+def _request(text: str) -> dict:
+    """Arguments of the generate_content call for the report text."""
+    return dict(
+        model="gemini-2.5-pro",
+        contents=[
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=text),
+                ],
+            ),
+        ],
         config=types.GenerateContentConfig(
             system_instruction=(
                 "Infer the reported symptoms from this brief report. "
@@ -60,6 +67,7 @@ def infer_symptoms_and_cause(text: str) -> InferredSymptoms:
         ),
     )
 
+def _inferred(response) -> InferredSymptoms:
     symptoms_dict = {s["name"]: int(s["severity"]) for s in response.parsed["symptoms"]}
     cause = response.parsed["cause"]
     success = response.parsed["success"]
@@ -72,3 +80,31 @@ def infer_symptoms_and_cause(text: str) -> InferredSymptoms:
 
     return inferred
 
+def infer_symptoms_and_cause(text: str) -> InferredSymptoms:
+    """Uses Gemini to infer symptoms and their likely cause from free-text input."""
+    response = client.models.generate_content(**_request(text))
+    return _inferred(response)
+
+async def ainfer_symptoms_and_cause(
+    text: str, timeout: float | None = None
+) -> InferredSymptoms:
+    """
+        Async version of infer_symptoms_and_cause, which doesn't block the event loop.
+        At most INFERENCE_CONCURRENCY inferences run at once.
+
+        Raises asyncio.TimeoutError if the inference, including the wait for a slot,
+        takes longer than timeout seconds (default: INFERENCE_TIMEOUT). Cancelling the
+        calling task cancels the request to Gemini.
+    """
+    global _inference_slots
+    if _inference_slots is None:
+        _inference_slots = asyncio.Semaphore(INFERENCE_CONCURRENCY)
+
+    async def infer():
+        async with _inference_slots:
+            return await client.aio.models.generate_content(**_request(text))
+
+    response = await asyncio.wait_for(
+        infer(), INFERENCE_TIMEOUT if timeout is None else timeout
+    )
+    return _inferred(response)
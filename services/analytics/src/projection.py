@@ -0,0 +1,29 @@
+from functools import cache
+
+import numpy as np
+from pyproj import Transformer
+
+# Coordinates of reports, as longitude/latitude.
+WGS84 = "EPSG:4326"
+# World Cylindrical Equal Area, in meters, for areas.
+EQUAL_AREA = "EPSG:6933"
+
+@cache
+def transformer(source: str, target: str) -> Transformer:
+    """
+    Process-wide transformer between two CRSs, with x/y in lon/lat order.
+    Creating one loads the projection database, so they are created once and reused.
+    """
+    return Transformer.from_crs(source, target, always_xy=True)
+
+def to_equal_area(lon: np.ndarray, lat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Projects arrays of lon/lat degrees to EPSG:6933 x/y meters, in one call."""
+    return transformer(WGS84, EQUAL_AREA).transform(
+        np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    )
+
+def from_equal_area(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Inverse of to_equal_area: EPSG:6933 x/y meters to lon/lat degrees."""
+    return transformer(EQUAL_AREA, WGS84).transform(
+        np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    )
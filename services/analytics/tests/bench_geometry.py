@@ -0,0 +1,131 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import argparse
+import time
+
+import numpy as np
+from generated import location_pb2
+from pyproj import Transformer
+from scipy.interpolate import splev, splprep
+from shapely.geometry import Point, Polygon
+from shapely.ops import unary_union
+
+import calcs
+import geo
+
+# Benchmarks the geometry of cluster areas on clusters of 10 to 100k points:
+#   legacy: the previous path, with Location objects throughout. Every point is
+#           buffered into a circle and unioned before taking the hull, transformers
+#           are created per call and points projected one at a time, and the
+#           shoelace sum is a Python generator.
+#   kernel: calcs.cluster_area, on (n, 2) arrays from the hull to the area and
+#           centroid. The circles are added to the hull of the points analytically,
+#           by geo.offset_hull.
+# Both smooth the same region, so their regions and areas must match. Centroids
+# differ by design: the legacy path averaged the vertices, the kernel takes the
+# centroid of the area.
+
+def legacy_cluster_area(points: list[location_pb2.Location]):
+    unique = { (p.lat, p.lon) for p in points }
+    if len(unique) < 3:
+        raise ValueError(
+            "At least 3 unique points are required to calculate an area"
+        )
+
+    circles = [Point(lon, lat).buffer(0.005) for lat, lon in unique]
+    hull = unary_union(circles).convex_hull
+    x, y = hull.exterior.xy
+    tck, u = splprep(np.array([x, y]), s=0.001, per=True)
+    spline_points = splev(np.linspace(0, 1, 200), tck)
+    region = [
+        location_pb2.Location(lat=lat, lon=lon)
+        for lon, lat in zip(spline_points[0], spline_points[1])
+    ]
+
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:6933", always_xy=True)
+    projected = np.array([transformer.transform(p.lon, p.lat) for p in region])
+
+    x, y = projected[:, 0], projected[:, 1]
+    shoelace = sum(x[i] * y[i + 1] - x[i + 1] * y[i] for i in range(-1, len(x) - 1))
+    area_km2 = 0.5 * abs(shoelace) / 1_000_000
+
+    inverse_transformer = Transformer.from_crs(
+        "EPSG:6933", "EPSG:4326", always_xy=True
+    )
+    centroid_lon, centroid_lat = inverse_transformer.transform(
+        np.mean(x), np.mean(y)
+    )
+    return area_km2, location_pb2.Location(lat=centroid_lat, lon=centroid_lon)
+
+def region_difference(points: list[location_pb2.Location]) -> float:
+    """
+    Area of the symmetric difference between the legacy and offset_hull regions,
+    relative to the region.
+    """
+    lon_lat = np.array([ [p.lon, p.lat] for p in points ])
+    circles = [ Point(lon, lat).buffer(0.005) for lon, lat in lon_lat ]
+    legacy = unary_union(circles).convex_hull
+    offset = Polygon(geo.offset_hull(lon_lat, 0.005))
+    return legacy.symmetric_difference(offset).area / legacy.area
+
+def generate_cluster(
+    n: int, rng: np.random.Generator, lat=-23.353, lon=-47.848, radius_m=2000
+) -> list[location_pb2.Location]:
+    lat_radius = radius_m / 111_000
+    lon_radius = radius_m / (111_000 * np.cos(np.radians(lat)))
+    offsets = rng.normal(0, 1, (n, 2)) * [lat_radius, lon_radius]
+    return [
+        location_pb2.Location(lat=lat + dlat, lon=lon + dlon)
+        for dlat, dlon in offsets
+    ]
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the cluster area geometry."
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10, 100, 1_000, 10_000, 100_000]
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(
+        f"{'points':>8} {'legacy (s)':>12} {'kernel (s)':>12} {'speedup':>8} "
+        f"{'region diff':>12} {'area rel. diff':>15} {'centroid shift (m)':>19}"
+    )
+
+    for n in args.sizes:
+        points = generate_cluster(n, rng)
+        legacy_time, (legacy_area, legacy_centroid) = timed(
+            legacy_cluster_area, points, repeat=1 if n >= 10_000 else 3
+        )
+        kernel_time, (kernel_area, kernel_centroid) = timed(
+            calcs.cluster_area, points
+        )
+
+        region_diff = region_difference(points)
+        area_diff = abs(kernel_area - legacy_area) / legacy_area
+        shift = geo.haversine(
+            legacy_centroid.lat, legacy_centroid.lon,
+            kernel_centroid.lat, kernel_centroid.lon
+        )
+        speedup = legacy_time / kernel_time
+        print(
+            f"{n:>8} {legacy_time:>12.4f} {kernel_time:>12.4f} {speedup:>7.1f}x "
+            f"{region_diff:>12.2e} {area_diff:>15.2e} {shift:>19.2f}"
+        )
+
+        assert region_diff < 1e-9, f"Regions differ for {n} points"
+        assert area_diff < 1e-9, f"Areas differ for {n} points"
@@ -18,11 +18,20 @@ export function build(app: Express) {
 
 			console.log('Received /api/heatmap request with query:', req.query);
 			try {
+				// The GeoJSON only changes when a clustering run completes, so clients
+				// revalidate it by the ETag of the copy they have.
 				const fetchRes = await MLServiceClient.FetchLatestData(
-					MLService.FetchLatestDataRequest.create({}),
+					MLService.FetchLatestDataRequest.create({
+						etag: req.get('If-None-Match')?.replace(/"/g, '') ?? '',
+					}),
 				);
 
-				console.log('FetchLatestData response:', fetchRes);
+				if (fetchRes.etag) {
+					res.set('ETag', `"${fetchRes.etag}"`);
+				}
+				if (fetchRes.notModified) {
+					return res.status(304).end();
+				}
 				res.send(fetchRes);
 			} catch (error) {
 				console.error('Error processing /api/heatmap request:', error);
@@ -1,5 +1,5 @@
 import os
-from supabase import create_client, Client
+from supabase import acreate_client, create_client, AsyncClient, Client
 
 from google import genai
 from google.genai import types
@@ -12,4 +12,14 @@ supabase_key: str = os.getenv('SUPABASE_KEY')
 if not supabase_url or not supabase_key:
     raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables.")
 
-supabase: Client = create_client(supabase_url, supabase_key)
\ No newline at end of file
+supabase: Client = create_client(supabase_url, supabase_key)
+
+# The async client is bound to the event loop it is created in, so it is created on first use
+# by the server rather than at import.
+async_supabase: AsyncClient = None
+
+async def create_async_client() -> AsyncClient:
+    global async_supabase
+    if async_supabase is None:
+        async_supabase = await acreate_client(supabase_url, supabase_key)
+    return async_supabase
@@ -0,0 +1,38 @@
+-- Bulk updates for the summary and embedding backfills
+-- Each call updates a whole batch of reports in one statement instead of one request per report.
+
+-- Function to set the embeddings of many reports, given as parallel arrays
+-- Embeddings are passed as JSON arrays of floats and cast through pgvector's text format.
+CREATE OR REPLACE FUNCTION update_report_embeddings(report_ids BIGINT[], embeddings JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    updated_count INTEGER;
+BEGIN
+    UPDATE reports r
+    SET embedding = (u.embedding::TEXT)::VECTOR(768)
+    FROM (
+        SELECT ids.id, embeddings -> (ids.ord::INTEGER - 1) AS embedding
+        FROM unnest(report_ids) WITH ORDINALITY AS ids(id, ord)
+    ) u
+    WHERE r.id = u.id;
+
+    GET DIAGNOSTICS updated_count = ROW_COUNT;
+    RETURN updated_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to set the summaries of many reports, given as parallel arrays
+CREATE OR REPLACE FUNCTION update_report_summaries(report_ids BIGINT[], summaries TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    updated_count INTEGER;
+BEGIN
+    UPDATE reports r
+    SET summary = u.summary
+    FROM unnest(report_ids, summaries) AS u(id, summary)
+    WHERE r.id = u.id;
+
+    GET DIAGNOSTICS updated_count = ROW_COUNT;
+    RETURN updated_count;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,19 @@
+-- Batched centroid computation
+-- Computes the centroids of many groups of reports in one call, instead of one get_centroid
+-- call per group. Groups are given as parallel arrays of report IDs and group numbers.
+-- Used as the server-side fallback and reference for the centroids computed in the ML service.
+
+CREATE OR REPLACE FUNCTION get_centroids(report_ids BIGINT[], group_ids INTEGER[])
+RETURNS TABLE(group_id INTEGER, x FLOAT8, y FLOAT8) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        g.group_id,
+        ST_X(ST_Centroid(ST_Collect(r.geom))) AS x,
+        ST_Y(ST_Centroid(ST_Collect(r.geom))) AS y
+    FROM unnest(report_ids, group_ids) AS g(report_id, group_id)
+    JOIN reports r ON r.id = g.report_id
+    GROUP BY g.group_id
+    ORDER BY g.group_id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,55 @@
+-- Snapshots of a single cluster in a time window
+-- Used by the PredictEvolution RPC, which forecasts one cluster from its recent history instead
+-- of every cluster of the run. The composite index serves the (run, cluster, window) lookup
+-- directly, without scanning the run's snapshots.
+
+CREATE INDEX IF NOT EXISTS idx_snapshots_run_cluster_time ON snapshots(run_id, cluster_id, time_window_start);
+
+-- The reports column holds the id and symptoms of each report, which the forecast needs for
+-- the snapshot intensity.
+CREATE OR REPLACE FUNCTION get_cluster_snapshots(
+    target_cluster_id TEXT,
+    start_time TIMESTAMPTZ,
+    end_time TIMESTAMPTZ,
+    target_run_id INTEGER DEFAULT NULL
+)
+RETURNS TABLE(
+    run_id INTEGER,
+    timedelta INTEGER,
+    time_window_start TIMESTAMPTZ,
+    time_window_end TIMESTAMPTZ,
+    cluster_id TEXT,
+    centroid GEOMETRY(Point, 4326),
+    avg_embedding VECTOR(768),
+    report_ids BIGINT[],
+    common_symptoms JSONB,
+    reports JSONB
+) AS $$
+DECLARE
+    -- Resolved once, rather than for every row of the scan.
+    selected_run_id INTEGER := COALESCE(target_run_id, get_latest_clustering_run());
+BEGIN
+    RETURN QUERY
+    SELECT
+        s.run_id,
+        s.timedelta,
+        s.time_window_start,
+        s.time_window_end,
+        s.cluster_id,
+        s.centroid,
+        s.avg_embedding,
+        s.report_ids,
+        s.common_symptoms,
+        (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object('id', r.id, 'symptoms', r.symptoms)), '[]'::jsonb)
+            FROM reports r
+            WHERE r.id = ANY(s.report_ids)
+        ) AS reports
+    FROM snapshots s
+    WHERE s.run_id = selected_run_id
+      AND s.cluster_id = target_cluster_id
+      AND s.time_window_start >= start_time
+      AND s.time_window_start < end_time
+    ORDER BY s.time_window_start;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,205 @@
+-- Schema for incremental clustering runs
+-- Keeps the DBSCAN state of every clustered report so that a run only has to
+-- cluster the reports submitted since the previous one.
+
+-- Table to store the latest DBSCAN state of each report
+CREATE TABLE IF NOT EXISTS report_cluster_states (
+    report_id BIGINT PRIMARY KEY,
+    label INTEGER NOT NULL, -- DBSCAN label before time-gap splits, -1 for noise
+    neighbor_count INTEGER NOT NULL, -- Reports within eps, including itself
+    run_id INTEGER REFERENCES clustering_runs(run_id) ON DELETE SET NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_report_cluster_states_label ON report_cluster_states(label);
+
+-- The functions below return the same columns as fetch_reports_page (report_pages.sql), with
+-- embeddings in pgvector's binary format and coordinates projected by report_utm, so rows
+-- can be clustered with the scaler of the run they extend. They read the reports table
+-- directly, so their cost follows the reports they return rather than the whole history.
+
+DROP FUNCTION IF EXISTS fetch_reports_near(FLOAT8[], FLOAT8[], FLOAT8);
+DROP FUNCTION IF EXISTS fetch_reports_by_ids(BIGINT[]);
+
+-- Function to fetch the reports with an embedding within radius_meters of any of the points.
+-- The geometry index on geom narrows the search to a box of degrees that holds the radius,
+-- then the distance is checked on the geography.
+CREATE OR REPLACE FUNCTION fetch_reports_near(lats FLOAT8[], lons FLOAT8[], radius_meters FLOAT8)
+RETURNS TABLE(
+    id BIGINT,
+    "timestamp" TIMESTAMPTZ,
+    lat NUMERIC,
+    lon NUMERIC,
+    symptoms JSONB,
+    summary TEXT,
+    embedding_bin BYTEA,
+    utm_x FLOAT8,
+    utm_y FLOAT8
+) AS $$
+BEGIN
+    RETURN QUERY
+    WITH points AS (
+        SELECT
+            ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326) AS geom,
+            -- Degrees of longitude (the larger) spanned by the radius, at the far edge from the equator
+            radius_meters / (110000.0 * cos(radians(LEAST(abs(p.lat) + radius_meters / 110000.0, 89.0)))) AS radius_degrees
+        FROM unnest(lats, lons) AS p(lat, lon)
+    )
+    SELECT
+        r.id,
+        r.timestamp,
+        r.lat,
+        r.lon,
+        r.symptoms,
+        r.summary,
+        vector_send(r.embedding) AS embedding_bin,
+        u.utm_x,
+        u.utm_y
+    FROM reports r, LATERAL report_utm(r.geom) u
+    WHERE r.embedding IS NOT NULL
+      AND EXISTS (
+          SELECT 1
+          FROM points p
+          WHERE ST_DWithin(r.geom, p.geom, p.radius_degrees)
+            AND ST_DWithin(r.geom::geography, p.geom::geography, radius_meters)
+      )
+    ORDER BY r.id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to fetch reports with an embedding by ID
+CREATE OR REPLACE FUNCTION fetch_reports_by_ids(report_ids BIGINT[])
+RETURNS TABLE(
+    id BIGINT,
+    "timestamp" TIMESTAMPTZ,
+    lat NUMERIC,
+    lon NUMERIC,
+    symptoms JSONB,
+    summary TEXT,
+    embedding_bin BYTEA,
+    utm_x FLOAT8,
+    utm_y FLOAT8
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        r.id,
+        r.timestamp,
+        r.lat,
+        r.lon,
+        r.symptoms,
+        r.summary,
+        vector_send(r.embedding) AS embedding_bin,
+        u.utm_x,
+        u.utm_y
+    FROM reports r, LATERAL report_utm(r.geom) u
+    WHERE r.id = ANY(report_ids)
+      AND r.embedding IS NOT NULL
+    ORDER BY r.id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keyset-paginated reports that have an embedding but no clustering state yet, i.e. that no
+-- run has clustered, whenever they were submitted or embedded.
+CREATE OR REPLACE FUNCTION fetch_unclustered_reports_page(
+    after_id BIGINT DEFAULT 0,
+    page_size INTEGER DEFAULT 1000
+)
+RETURNS TABLE(
+    id BIGINT,
+    "timestamp" TIMESTAMPTZ,
+    lat NUMERIC,
+    lon NUMERIC,
+    symptoms JSONB,
+    summary TEXT,
+    embedding_bin BYTEA,
+    utm_x FLOAT8,
+    utm_y FLOAT8
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        r.id,
+        r.timestamp,
+        r.lat,
+        r.lon,
+        r.symptoms,
+        r.summary,
+        vector_send(r.embedding) AS embedding_bin,
+        u.utm_x,
+        u.utm_y
+    FROM reports r
+    LEFT JOIN report_cluster_states s ON s.report_id = r.id
+    CROSS JOIN LATERAL report_utm(r.geom) u
+    WHERE s.report_id IS NULL
+      AND r.id > after_id
+      AND r.embedding IS NOT NULL
+    ORDER BY r.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to copy the snapshots of untouched clusters from a previous run into a delta run
+CREATE OR REPLACE FUNCTION carry_forward_snapshots(
+    source_run_id INTEGER,
+    target_run_id INTEGER,
+    exclude_report_ids BIGINT[]
+)
+RETURNS INTEGER AS $$
+DECLARE
+    copied_count INTEGER;
+BEGIN
+    INSERT INTO snapshots (
+        run_id,
+        timedelta,
+        time_window_start,
+        time_window_end,
+        cluster_id,
+        centroid,
+        avg_embedding,
+        report_ids,
+        common_symptoms
+    )
+    SELECT
+        target_run_id,
+        s.timedelta,
+        s.time_window_start,
+        s.time_window_end,
+        s.cluster_id,
+        s.centroid,
+        s.avg_embedding,
+        s.report_ids,
+        s.common_symptoms
+    FROM snapshots s
+    WHERE s.run_id = source_run_id
+      AND NOT (s.report_ids && exclude_report_ids);
+
+    GET DIAGNOSTICS copied_count = ROW_COUNT;
+    RETURN copied_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to save the DBSCAN state of a run's reports and mark the run completed, in one
+-- transaction. States are only ever written by completed runs, so the stored labels always
+-- match the next_label of the latest completed run, and the reports of a failed run stay
+-- unclustered for the next one.
+CREATE OR REPLACE FUNCTION complete_clustering_run(
+    target_run_id INTEGER,
+    report_ids BIGINT[],
+    labels INTEGER[],
+    neighbor_counts INTEGER[]
+)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO report_cluster_states (report_id, label, neighbor_count, run_id, updated_at)
+    SELECT s.report_id, s.label, s.neighbor_count, target_run_id, NOW()
+    FROM unnest(report_ids, labels, neighbor_counts) AS s(report_id, label, neighbor_count)
+    ON CONFLICT (report_id) DO UPDATE SET
+        label = EXCLUDED.label,
+        neighbor_count = EXCLUDED.neighbor_count,
+        run_id = EXCLUDED.run_id,
+        updated_at = EXCLUDED.updated_at;
+
+    UPDATE clustering_runs SET status = 'completed' WHERE run_id = target_run_id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,69 @@
+-- Keyset-paginated report fetching
+-- Returns reports with the same columns as fetch_all_reports, one page at a time,
+-- ordered by id so the last id of a page is the cursor for the next one.
+-- Embeddings are sent in pgvector's binary format (vector_send) rather than as text literals,
+-- so they can be decoded in bulk without parsing.
+
+-- Projected coordinates of a report, in meters, which clustering fits its scaler on.
+-- Every function that returns utm_x/utm_y for clustering computes them here, so a scaler
+-- fit on one fetch path applies to the rows of the others. Reports are in São Paulo state,
+-- in SIRGAS 2000 / UTM zone 23S (EPSG:31983).
+CREATE OR REPLACE FUNCTION report_utm(geom GEOMETRY, OUT utm_x FLOAT8, OUT utm_y FLOAT8) AS $$
+    SELECT ST_X(p), ST_Y(p) FROM ST_Transform(geom, 31983) AS p;
+$$ LANGUAGE sql IMMUTABLE;
+
+DROP FUNCTION IF EXISTS fetch_reports_page(BIGINT, INTEGER, TIMESTAMPTZ, TIMESTAMPTZ, INTEGER);
+DROP FUNCTION IF EXISTS fetch_reports_page(BIGINT, INTEGER, TIMESTAMPTZ, TIMESTAMPTZ, INTEGER, BOOLEAN);
+
+CREATE OR REPLACE FUNCTION fetch_reports_page(
+    after_id BIGINT DEFAULT 0,
+    page_size INTEGER DEFAULT 1000,
+    start_time TIMESTAMPTZ DEFAULT NULL,
+    end_time TIMESTAMPTZ DEFAULT NULL,
+    with_embeddings BOOLEAN DEFAULT TRUE -- FALSE when the caller has the embeddings cached locally
+)
+RETURNS TABLE(
+    id BIGINT,
+    "timestamp" TIMESTAMPTZ,
+    lat NUMERIC,
+    lon NUMERIC,
+    symptoms JSONB,
+    summary TEXT,
+    embedding_bin BYTEA,
+    utm_x FLOAT8,
+    utm_y FLOAT8
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        r.id,
+        r.timestamp,
+        r.lat,
+        r.lon,
+        r.symptoms,
+        r.summary,
+        CASE WHEN with_embeddings THEN vector_send(r.embedding) END AS embedding_bin,
+        u.utm_x,
+        u.utm_y
+    FROM reports r, LATERAL report_utm(r.geom) u
+    WHERE r.id > after_id
+      AND r.embedding IS NOT NULL
+      AND (start_time IS NULL OR r.timestamp >= start_time)
+      AND (end_time IS NULL OR r.timestamp < end_time)
+    ORDER BY r.id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Function to fetch the embeddings of reports by ID, in pgvector's binary format
+CREATE OR REPLACE FUNCTION fetch_embeddings_by_ids(report_ids BIGINT[])
+RETURNS TABLE(id BIGINT, embedding_bin BYTEA) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT r.id, vector_send(r.embedding) AS embedding_bin
+    FROM reports r
+    WHERE r.id = ANY(report_ids)
+      AND r.embedding IS NOT NULL
+    ORDER BY r.id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,53 @@
+-- GeoJSON of each clustering run
+-- FetchLatestData serves the latest run as a GeoJSON FeatureCollection. It only changes when a
+-- run completes, so it is built once per run and stored here, with an ETag of its content that
+-- clients revalidate against. Deleting a run deletes its GeoJSON.
+
+CREATE TABLE IF NOT EXISTS run_geojson (
+    run_id INTEGER PRIMARY KEY REFERENCES clustering_runs(run_id) ON DELETE CASCADE,
+    etag TEXT NOT NULL,
+    geojson TEXT NOT NULL,
+    time_window_start TIMESTAMPTZ,
+    time_window_end TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Snapshots of a run with the coordinates of their reports, which the spline boundaries are
+-- fit to. The reports column holds the id, lat, lon and symptoms of each report.
+CREATE OR REPLACE FUNCTION get_run_snapshots(target_run_id INTEGER)
+RETURNS TABLE(
+    snapshot_id INTEGER,
+    timedelta INTEGER,
+    time_window_start TIMESTAMPTZ,
+    time_window_end TIMESTAMPTZ,
+    cluster_id TEXT,
+    centroid GEOMETRY(Point, 4326),
+    avg_embedding VECTOR(768),
+    report_ids BIGINT[],
+    common_symptoms JSONB,
+    reports JSONB
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        s.snapshot_id,
+        s.timedelta,
+        s.time_window_start,
+        s.time_window_end,
+        s.cluster_id,
+        s.centroid,
+        s.avg_embedding,
+        s.report_ids,
+        s.common_symptoms,
+        (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                'id', r.id, 'lat', r.lat, 'lon', r.lon, 'symptoms', r.symptoms
+            )), '[]'::jsonb)
+            FROM reports r
+            WHERE r.id = ANY(s.report_ids)
+        ) AS reports
+    FROM snapshots s
+    WHERE s.run_id = target_run_id
+    ORDER BY s.time_window_start, s.snapshot_id;
+END;
+$$ LANGUAGE plpgsql;
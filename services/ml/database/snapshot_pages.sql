@@ -0,0 +1,55 @@
+-- Keyset-paginated snapshot fetching
+-- Returns the snapshots of a clustering run in a time window, optionally of a single cluster,
+-- one page at a time. Pages are ordered by (time_window_start, snapshot_id), so the last row of
+-- a page is the cursor for the next one, and every row has the run_id so that the following
+-- pages can be pinned to the same run even if a newer one completes in between.
+-- Average embeddings are sent in pgvector's binary format (vector_send), like fetch_reports_page.
+
+CREATE INDEX IF NOT EXISTS idx_snapshots_run_time_id ON snapshots(run_id, time_window_start, snapshot_id);
+
+CREATE OR REPLACE FUNCTION fetch_snapshots_page(
+    start_time TIMESTAMPTZ DEFAULT NULL,
+    end_time TIMESTAMPTZ DEFAULT NULL,
+    target_cluster_id TEXT DEFAULT NULL,
+    after_time TIMESTAMPTZ DEFAULT NULL, -- Cursor: time_window_start of the last row of the previous page
+    after_id INTEGER DEFAULT 0,          -- Cursor: snapshot_id of the last row of the previous page
+    page_size INTEGER DEFAULT 500,
+    target_run_id INTEGER DEFAULT NULL   -- The latest completed run if NULL
+)
+RETURNS TABLE(
+    snapshot_id INTEGER,
+    run_id INTEGER,
+    timedelta INTEGER,
+    time_window_start TIMESTAMPTZ,
+    time_window_end TIMESTAMPTZ,
+    cluster_id TEXT,
+    centroid GEOMETRY(Point, 4326),
+    avg_embedding_bin BYTEA,
+    report_ids BIGINT[],
+    common_symptoms JSONB
+) AS $$
+DECLARE
+    selected_run_id INTEGER := COALESCE(target_run_id, get_latest_clustering_run());
+BEGIN
+    RETURN QUERY
+    SELECT
+        s.snapshot_id,
+        s.run_id,
+        s.timedelta,
+        s.time_window_start,
+        s.time_window_end,
+        s.cluster_id,
+        s.centroid,
+        vector_send(s.avg_embedding) AS avg_embedding_bin,
+        s.report_ids,
+        s.common_symptoms
+    FROM snapshots s
+    WHERE s.run_id = selected_run_id
+      AND (target_cluster_id IS NULL OR s.cluster_id = target_cluster_id)
+      AND (start_time IS NULL OR s.time_window_start >= start_time)
+      AND (end_time IS NULL OR s.time_window_start < end_time)
+      AND (after_time IS NULL OR (s.time_window_start, s.snapshot_id) > (after_time, after_id))
+    ORDER BY s.time_window_start, s.snapshot_id
+    LIMIT page_size;
+END;
+$$ LANGUAGE plpgsql;
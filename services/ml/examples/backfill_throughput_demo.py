@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Throughput demo for the embedding backfill.
+
+Runs the backfill pipeline against FakeEmbeddingBackend and an in-memory writer, so no
+Gemini or Supabase access is needed, and prints rows per second for a few batch sizes
+and concurrency levels.
+"""
+
+import asyncio
+import os
+import sys
+
+import numpy as np
+
+# Add the services/ml directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from models.outbreakml.backfill import FakeEmbeddingBackend, embed_reports
+
+
+def make_reports(n):
+    """Reports with a few hundred distinct summaries, like real data."""
+    symptoms = ["fever", "cough", "headache", "nausea", "rash", "fatigue"]
+    levels = ["mild", "moderate", "severe"]
+    causes = ["flu", "dengue", "covid-19", "food poisoning"]
+
+    rng = np.random.default_rng(0)
+    reports = []
+    for i in range(n):
+        names = rng.choice(symptoms, size=rng.integers(1, 4), replace=False)
+        summary = ", ".join(f"{rng.choice(levels)} {name}" for name in sorted(names))
+        reports.append({"id": i + 1, "summary": f"{summary}: {rng.choice(causes)}"})
+    return reports
+
+
+def run(reports, batch_size, concurrency, latency=0.05, failure_rate=0.05):
+    written = {}
+
+    def write(ids, embeddings):
+        written.update(zip(ids, embeddings))
+
+    backend = FakeEmbeddingBackend(latency=latency, failure_rate=failure_rate)
+    stats = asyncio.run(embed_reports(
+        reports, backend, write,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        base_delay=0.01
+    ))
+
+    assert len(written) == stats.rows
+    return stats
+
+
+def main():
+    reports = make_reports(5000)
+    print(f"=== Backfill throughput, {len(reports)} reports, fake backend with 50ms latency and 5% failures ===\n")
+
+    print(f"{'batch':>6} {'workers':>8}  result")
+    # batch_size=1 and concurrency=1 is the old one-request-per-report loop.
+    for batch_size, concurrency in [(1, 1), (10, 1), (100, 1), (100, 4), (100, 8)]:
+        subset = reports[:batch_size * 200]
+        stats = run(subset, batch_size, concurrency)
+        print(f"{batch_size:>6} {concurrency:>8}  {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Checks the locally computed snapshot centroids against PostGIS.
+
+Snapshots use the spherical mean of their reports' coordinates, computed in the ML service.
+This script takes the report groups of the latest clustering run, computes their centroids
+both locally and with the get_centroids database function, and reports the largest deviation.
+"""
+
+import os
+import sys
+
+# Add the services/ml directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def main(tolerance_meters=10.0):
+    import models.outbreakml.db as db
+    from models.outbreakml.snapshots import compare_centroids_with_server
+
+    timedelta_snapshots = db.fetch_latest_timedelta_snapshots()
+    report_id_groups = [s.report_ids for ts in timedelta_snapshots for s in ts.snapshots]
+    if not report_id_groups:
+        print("No snapshots in the latest clustering run.")
+        return 0
+
+    reports = db.fetch_reports_by_ids(sorted({rid for ids in report_id_groups for rid in ids}))
+    index_of = {r["id"]: i for i, r in enumerate(reports)}
+    index_groups = [[index_of[rid] for rid in ids if rid in index_of] for ids in report_id_groups]
+    index_groups = [indices for indices in index_groups if indices]
+
+    max_distance = compare_centroids_with_server(reports, index_groups, tolerance_meters)
+    return 0 if max_distance <= tolerance_meters else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
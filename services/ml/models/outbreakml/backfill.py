@@ -0,0 +1,250 @@
+"""
+Embedding Backfill
+
+Embeds the summaries of many reports at once: summaries are sent to the embedding
+backend in batches, a bounded number of batches are in flight at a time, and the
+results are written back to the database in bulk. Failed requests and writes are
+retried with exponential backoff.
+
+The backend and the writer are plain callables, so the pipeline can run against
+FakeEmbeddingBackend and an in-memory writer, e.g. to measure its throughput.
+"""
+
+import asyncio
+import hashlib
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional
+
+import numpy as np
+
+from models.outbreakml.embeddings import EMBEDDING_DIM, EMBEDDING_MODEL
+
+# Writes a batch of embeddings back: (report ids, [n, dim] float32 embeddings).
+EmbeddingWriter = Callable[[List[int], np.ndarray], None]
+
+
+class GeminiEmbeddingBackend():
+  """Embeds batches of summaries with Gemini, like generate_embeddings does for a single one."""
+
+  def __init__(self, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM):
+    self.model = model
+    self.dim = dim
+
+  async def __call__(self, summaries: List[str]) -> np.ndarray:
+    from google.genai import types
+    from common.ai import gemini_client
+
+    response = await gemini_client.aio.models.embed_content(
+      model=self.model,
+      contents=summaries,
+      config=types.EmbedContentConfig(
+        task_type="CLUSTERING",
+        output_dimensionality=self.dim
+      )
+    )
+    embeddings = np.array([ e.values for e in response.embeddings ], dtype=np.float32)
+    if embeddings.shape != (len(summaries), self.dim):
+      raise ValueError(f"Expected {len(summaries)} embeddings of {self.dim} dimensions, got {embeddings.shape}")
+
+    # Normalize embeddings
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+class FakeEmbeddingBackend():
+  """
+    Local stand-in for the embedding API.
+
+    Returns deterministic unit vectors derived from each summary, after a simulated
+    request latency, and fails the given fraction of requests to exercise retries.
+  """
+
+  def __init__(self, dim: int = EMBEDDING_DIM, latency: float = 0.05, failure_rate: float = 0.0, seed: int = 0):
+    self.dim = dim
+    self.latency = latency
+    self.failure_rate = failure_rate
+    self.calls = 0
+    self._random = random.Random(seed)
+
+  async def __call__(self, summaries: List[str]) -> np.ndarray:
+    self.calls += 1
+    await asyncio.sleep(self.latency)
+    if self._random.random() < self.failure_rate:
+      raise RuntimeError("Simulated embedding API failure")
+
+    embeddings = np.empty((len(summaries), self.dim), dtype=np.float32)
+    for i, summary in enumerate(summaries):
+      seed = int.from_bytes(hashlib.sha256(summary.encode()).digest()[:8], "little")
+      embeddings[i] = np.random.default_rng(seed).standard_normal(self.dim)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+class RateLimiter():
+  """Spaces out the start of requests so that at most `rate` start per second."""
+
+  def __init__(self, rate: Optional[float]):
+    self.interval = 1.0 / rate if rate else 0.0
+    self._next = 0.0
+    self._lock = asyncio.Lock()
+
+  async def wait(self):
+    if not self.interval:
+      return
+    async with self._lock:
+      now = time.monotonic()
+      delay = self._next - now
+      self._next = max(now, self._next) + self.interval
+    if delay > 0:
+      await asyncio.sleep(delay)
+
+
+@dataclass
+class BackfillStats():
+  rows: int = 0
+  failed: int = 0
+  requests: int = 0
+  retries: int = 0
+  seconds: float = 0.0
+  failed_ids: List[int] = field(default_factory=list)
+
+  @property
+  def rows_per_second(self) -> float:
+    return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+  def __str__(self):
+    return (
+      f"{self.rows} rows in {self.seconds:.2f}s ({self.rows_per_second:.1f} rows/s), "
+      f"{self.requests} requests, {self.retries} retries, {self.failed} failed"
+    )
+
+
+async def embed_reports(
+    reports: List[dict],
+    backend: Callable[[List[str]], Awaitable[np.ndarray]],
+    write: EmbeddingWriter,
+    batch_size: int = 100,
+    concurrency: int = 4,
+    requests_per_second: Optional[float] = None,
+    max_retries: int = 5,
+    base_delay: float = 1.0
+) -> BackfillStats:
+  """
+    Embeds the summaries of reports and writes the embeddings back.
+
+    Args:
+      reports (list): Dicts with the report "id" and its "summary".
+      backend: Async callable embedding a list of summaries into a [n, dim] array.
+      write: Writes a batch of report ids and their embeddings, e.g. db.update_report_embeddings.
+      batch_size (int): Summaries per embedding request.
+      concurrency (int): Maximum number of batches being embedded or written at once.
+      requests_per_second (float): Maximum rate of new requests, unlimited if None.
+      max_retries (int): Retries of a failed request or write before its reports are given up.
+      base_delay (float): Delay before the first retry in seconds, doubled on every retry.
+
+    Returns:
+      BackfillStats: Embedded and failed rows, requests, retries and throughput.
+  """
+
+  stats = BackfillStats()
+  semaphore = asyncio.Semaphore(concurrency)
+  limiter = RateLimiter(requests_per_second)
+  start = time.perf_counter()
+
+  async def retrying(call: Callable[[], Awaitable], ids: List[int], action: str):
+    """Awaits call() until it succeeds, and returns (True, its result), or (False, None) once the reports are given up."""
+    for attempt in range(max_retries + 1):
+      try:
+        return True, await call()
+      except Exception as e:
+        if attempt == max_retries:
+          print(f"Giving up on {len(ids)} reports after {attempt + 1} attempts to {action}: {e}")
+          stats.failed += len(ids)
+          stats.failed_ids += ids
+          return False, None
+        stats.retries += 1
+        # Exponential backoff with jitter, so throttled workers don't retry in lockstep.
+        await asyncio.sleep(base_delay * 2 ** attempt * (0.5 + random.random()))
+
+  async def embed_batch(batch: List[dict]):
+    ids = [ r["id"] for r in batch ]
+    summaries = [ r["summary"] for r in batch ]
+
+    async def request():
+      await limiter.wait()
+      stats.requests += 1
+      return await backend(summaries)
+
+    async with semaphore:
+      embedded, embeddings = await retrying(request, ids, "embed them")
+      if not embedded:
+        return
+
+      # The writer is blocking, so it runs in a thread to keep other requests going.
+      written, _ = await retrying(lambda: asyncio.to_thread(write, ids, embeddings), ids, "write them")
+      if written:
+        stats.rows += len(batch)
+
+  batches = [ reports[i:i + batch_size] for i in range(0, len(reports), batch_size) ]
+  await asyncio.gather(*(embed_batch(batch) for batch in batches))
+
+  stats.seconds = time.perf_counter() - start
+  return stats
+
+
+def backfill_embeddings(
+    backend=None,
+    batch_size: int = 100,
+    concurrency: int = 4,
+    requests_per_second: Optional[float] = None,
+    cache=None
+) -> BackfillStats:
+  """
+    Backfills embeddings for all reports that lack one.
+
+    Reports without a summary get one generated from their symptoms and cause first.
+    Summaries found in the embedding cache (default: the service's cache) aren't sent to the backend.
+  """
+  import models.outbreakml.db as db
+  from models.outbreakml.embedding_cache import CachedEmbeddingBackend, default_cache, normalize_summary
+  from models.outbreakml.embeddings import generate_summary
+
+  reports = db.fetch_reports_without_embeddings()
+  reports = [ r for r in reports if r["symptoms"] ]
+  for r in reports:
+    if not r.get("summary"):
+      r["summary"] = generate_summary(r["symptoms"], r["cause"])
+
+  # Reports with the same summary end up in the same batch, where they're embedded once.
+  reports.sort(key=lambda r: normalize_summary(r["summary"]))
+
+  stats = asyncio.run(embed_reports(
+    reports,
+    CachedEmbeddingBackend(backend or GeminiEmbeddingBackend(), cache or default_cache()),
+    db.update_report_embeddings,
+    batch_size=batch_size,
+    concurrency=concurrency,
+    requests_per_second=requests_per_second
+  ))
+
+  print(f"Updated {stats.rows} reports with embeddings: {stats}")
+  return stats
+
+
+def backfill_summaries(batch_size: int = 1000) -> int:
+  """
+    Backfills summaries for all reports that lack one, writing them in bulk.
+  """
+  import models.outbreakml.db as db
+  from models.outbreakml.embeddings import generate_summary
+
+  reports = [ r for r in db.fetch_reports_without_summaries() if r["symptoms"] ]
+  for start in range(0, len(reports), batch_size):
+    batch = reports[start:start + batch_size]
+    db.update_report_summaries(
+      [ r["id"] for r in batch ],
+      [ generate_summary(r["symptoms"], r["cause"]) for r in batch ]
+    )
+
+  print(f"Updated {len(reports)} reports with summaries.")
+  return len(reports)
@@ -2,23 +2,27 @@ import numpy as np
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics.pairwise import cosine_similarity
-from scipy.spatial.distance import cosine
 from datetime import datetime
 from typing import Dict, List, Tuple
 
 from common.db import supabase
+from geo import haversine
 
-from models.outbreakml.embeddings import decode_embedding
-from models.outbreakml.helpers import haversine_distance
+from models.outbreakml.distance import SPATIAL_WEIGHT, hybrid_radius_graph
+from models.outbreakml.embeddings import decode_embeddings
+from models.outbreakml.structures import ReportBatch
 from models.outbreakml.cluster_id_manager import ClusterIDManager
 
 
-def create_feature_matrix(reports):
+def create_feature_matrix(reports, scaler=None):
   """
   Create a feature matrix for clustering from reports.
 
   Args:
-      reports (list): List of dicts with id, lat, lon, symptoms, embedding, utm_x, utm_y.
+      reports (list | ReportBatch): List of dicts with id, lat, lon, symptoms, embedding, utm_x, utm_y,
+          or a ReportBatch with the same columns.
+      scaler (MinMaxScaler): An already fitted scaler to reuse, e.g. from a previous run.
+          A new one is fitted on the reports if not given.
 
   Returns:
       tuple: (feature_matrix, scaler, report_ids)
@@ -27,25 +31,30 @@ def create_feature_matrix(reports):
           - report_ids: List of report IDs
   """
 
-  utm_x = np.array([r["utm_x"] for r in reports])
-  utm_y = np.array([r["utm_y"] for r in reports])
+  if isinstance(reports, ReportBatch):
+    utm_x, utm_y = reports.utm_x, reports.utm_y
+    embeddings = reports.embeddings.astype(np.float64)
+  else:
+    utm_x = np.array([r["utm_x"] for r in reports])
+    utm_y = np.array([r["utm_y"] for r in reports])
 
-  embeddings = []
-  for r in reports:
-    embedding_str = r["embedding"]
-    embeddings.append(decode_embedding(embedding_str) if isinstance(embedding_str, str) else embedding_str)
-
-  embeddings = np.array(embeddings, dtype=np.float64)
+    embeddings, _ = decode_embeddings([r["embedding"] for r in reports])
+    embeddings = embeddings.astype(np.float64)
 
 
   # Normalize UTM coords to [0,1]
-  scaler = MinMaxScaler()
-  coords = scaler.fit_transform(np.vstack([utm_x, utm_y]).T)  # Shape: [n_reports, 2]
+  if scaler is None:
+    scaler = MinMaxScaler()
+    coords = scaler.fit_transform(np.vstack([utm_x, utm_y]).T)  # Shape: [n_reports, 2]
+  else:
+    coords = scaler.transform(np.vstack([utm_x, utm_y]).T)
 
   # Compute the range of each feature type and scale them for comparable distances.
   spatial_range = np.ptp(coords, axis=0).mean()  # average span in normalized units
   embedding_range = np.ptp(embeddings, axis=0).mean()
   weight = spatial_range / embedding_range  # scale embeddings to match spatial scale
+  if not np.isfinite(weight) or weight == 0:
+    weight = 1.0  # Degenerate ranges (e.g. a single report) would zero out the embeddings.
   weighted_embeddings = embeddings * weight
 
   # Weight embeddings to balance with spatial (tune 0.001 for meters scale)
@@ -55,10 +64,11 @@ def create_feature_matrix(reports):
 
   # Combine into feature matrix
   feature_matrix = np.hstack([coords, weighted_embeddings])  # Shape: [n_reports, 2 + 768]
-  return feature_matrix, scaler, [r["id"] for r in reports]
+  report_ids = reports.ids.tolist() if isinstance(reports, ReportBatch) else [r["id"] for r in reports]
+  return feature_matrix, scaler, report_ids
 
 
-def cluster_reports(features, scaler, report_ids, eps_meters=5000, min_samples=3):
+def cluster_reports(features, scaler, report_ids, eps_meters=5000, min_samples=3, return_graph=False):
   """
     Clusters reports based on a feature matrix embedding.
 
@@ -67,21 +77,9 @@ def cluster_reports(features, scaler, report_ids, eps_meters=5000, min_samples=3
       report_ids: (list[int]): A list of report IDs to include.
       eps_meters: The spatial component in meters to use for grouping.
       min_samples: Minimum amount of reports to form a cluster.
+      return_graph: Also return the radius-neighbour graph used by DBSCAN.
   """
 
-  def sum_custom_metric(x, y):
-    """
-      A custom metric that uses a weighted sum to define distance.
-
-      Use eps=0.1 * (eps_meters / 1000).
-    """
-
-    coord1, emb1 = x[:2], x[2:]
-    coord2, emb2 = y[:2], y[2:]
-    spatial_dist = np.sqrt(np.sum((coord1 - coord2) ** 2)) * scaler.data_range_[0]  # Denormalize to meters
-    cosine_dist = cosine(emb1, emb2)
-    return 0.1 * (spatial_dist / 1000) + 0.5 * cosine_dist
-
   # Define a custom distance metric for DBSCAN
   def rigid_custom_metric(x, y):
       """
@@ -108,7 +106,7 @@ def cluster_reports(features, scaler, report_ids, eps_meters=5000, min_samples=3
       cosine_dist = 1 - cosine_similarity(embedding_x.reshape(1, -1), embedding_y.reshape(1, -1))[0][0]
 
       # Calculate Haversine distance for lat/lon (geographical proximity)
-      geo_dist = haversine_distance(lat_x, lon_x, lat_y, lon_y)
+      geo_dist = haversine(lat_x, lon_x, lat_y, lon_y)
 
       # Combine distances:
       # For location, 5000 meters is the threshold.
@@ -122,9 +120,15 @@ def cluster_reports(features, scaler, report_ids, eps_meters=5000, min_samples=3
       # The `eps` parameter for DBSCAN will then be 1.0.
       return max(geo_dist / 5000, cosine_dist / 0.5)
 
-  db = DBSCAN(eps=0.1 * (eps_meters / 1000), min_samples=min_samples, metric=sum_custom_metric)
+  # Weighted sum of spatial and cosine distance, evaluated in blocks as a sparse radius graph.
+  # The metric is 0.1 * (spatial_dist / 1000) + 0.5 * cosine_dist, so use eps=0.1 * (eps_meters / 1000).
+  eps = SPATIAL_WEIGHT * (eps_meters / 1000)
+  graph = hybrid_radius_graph(features, scaler, eps)
 
-  return db.fit_predict(features)
+  db = DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed")
+  labels = db.fit_predict(graph)
+
+  return (labels, graph) if return_graph else labels
 
 
 def cluster_reports_with_id_management(
@@ -157,6 +161,27 @@ def cluster_reports_with_id_management(
     features, scaler, report_ids = create_feature_matrix(reports)
     labels = cluster_reports(features, scaler, report_ids, eps_meters, min_samples)
     
+    return assign_cluster_ids(labels, reports, max_time_gap_days, previous_cluster_mapping)
+
+
+def assign_cluster_ids(
+    labels: List[int],
+    reports: List[dict],
+    max_time_gap_days: int = 14,
+    previous_cluster_mapping: Dict[int, str] = None
+) -> Tuple[List[int], Dict[int, str]]:
+    """
+    Assign persistent cluster IDs to DBSCAN labels, splitting clusters on time gaps.
+    
+    Args:
+        labels: Cluster labels from DBSCAN
+        reports: List of reports with 'id' and 'timestamp'
+        max_time_gap_days: Maximum time gap before splitting clusters
+        previous_cluster_mapping: Previous mapping of labels to cluster IDs
+        
+    Returns:
+        Tuple of (cluster_labels, cluster_id_mapping)
+    """
     # Initialize cluster ID manager
     id_manager = ClusterIDManager()
     
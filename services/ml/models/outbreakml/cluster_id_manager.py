@@ -7,10 +7,19 @@ ensuring that clusters can be tracked over time even when they split or merge.
 
 import uuid
 from collections import defaultdict
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+
 from common.db import supabase
+from models.outbreakml.structures import ReportBatch
+
+NANOSECONDS_PER_DAY = 86400 * 10**9
 
 
 class ClusterIDManager:
@@ -68,70 +77,18 @@ class ClusterIDManager:
             if label != -1:  # Ignore noise points
                 new_clusters[label].append(report['id'])
         
-        # Map new clusters to existing IDs
-        label_to_cluster_id = {}
-        used_cluster_ids = set()
+        # Match all new clusters against the previous run's clusters at once
+        matches = {}
+        if previous_cluster_mapping:
+            matches = match_clusters_by_overlap(new_clusters, self._get_previous_cluster_reports())
         
-        for new_label, report_ids in new_clusters.items():
-            best_match_id = self._find_best_cluster_match(
-                report_ids, 
-                previous_cluster_mapping,
-                used_cluster_ids
-            )
-            
-            if best_match_id:
-                label_to_cluster_id[new_label] = best_match_id
-                used_cluster_ids.add(best_match_id)
-            else:
-                # Create new cluster ID for unmatched cluster
-                label_to_cluster_id[new_label] = self._generate_cluster_id()
+        # Create new cluster IDs for unmatched clusters, in order of first appearance
+        label_to_cluster_id = {}
+        for new_label in new_clusters:
+            label_to_cluster_id[new_label] = matches.get(new_label) or self._generate_cluster_id()
         
         return label_to_cluster_id
     
-    def _find_best_cluster_match(
-        self, 
-        report_ids: List[int], 
-        previous_mapping: Dict[int, str],
-        used_cluster_ids: Set[str]
-    ) -> Optional[str]:
-        """
-        Find the best matching existing cluster ID based on report overlap.
-        
-        Args:
-            report_ids: List of report IDs in the new cluster
-            previous_mapping: Previous mapping of labels to cluster IDs
-            used_cluster_ids: Set of already used cluster IDs
-            
-        Returns:
-            Best matching cluster ID or None if no good match found
-        """
-        if not previous_mapping:
-            return None
-        
-        # Get previous cluster report mappings
-        previous_cluster_reports = self._get_previous_cluster_reports()
-        
-        best_match_id = None
-        best_overlap_ratio = 0.0
-        
-        for cluster_id, prev_report_ids in previous_cluster_reports.items():
-            if cluster_id in used_cluster_ids:
-                continue
-                
-            # Calculate overlap ratio
-            overlap = len(set(report_ids) & set(prev_report_ids))
-            total_unique = len(set(report_ids) | set(prev_report_ids))
-            
-            if total_unique > 0:
-                overlap_ratio = overlap / total_unique
-                
-                # Use a threshold to determine if clusters are similar enough
-                if overlap_ratio > 0.3 and overlap_ratio > best_overlap_ratio:
-                    best_overlap_ratio = overlap_ratio
-                    best_match_id = cluster_id
-        
-        return best_match_id
-    
     def _get_previous_cluster_reports(self) -> Dict[str, List[int]]:
         """Get the most recent cluster-to-reports mapping from the database."""
         try:
@@ -170,62 +127,20 @@ class ClusterIDManager:
         Returns:
             Tuple of (updated_labels, updated_cluster_id_mapping)
         """
-        from datetime import datetime, timedelta
-        
-        # Group reports by cluster label
-        cluster_reports = defaultdict(list)
-        for label, report in zip(labels, reports):
-            if label != -1:
-                cluster_reports[label].append(report)
-        
-        new_labels = labels.copy()
+        labels = np.asarray(labels)
         new_cluster_id_mapping = cluster_id_mapping.copy()
-        
-        for label, cluster_reports_list in cluster_reports.items():
-            if len(cluster_reports_list) <= 1:
-                continue
-                
-            # Sort reports by timestamp
-            cluster_reports_list.sort(key=lambda r: datetime.fromisoformat(r['timestamp'].replace('Z', '+00:00')))
-            
-            # Find split points based on time gaps
-            split_indices = []
-            for i in range(1, len(cluster_reports_list)):
-                prev_time = datetime.fromisoformat(cluster_reports_list[i-1]['timestamp'].replace('Z', '+00:00'))
-                curr_time = datetime.fromisoformat(cluster_reports_list[i]['timestamp'].replace('Z', '+00:00'))
-                
-                if (curr_time - prev_time).days > max_time_gap_days:
-                    split_indices.append(i)
-            
-            if split_indices:
-                # Split the cluster
-                original_cluster_id = cluster_id_mapping.get(label)
-                if not original_cluster_id:
-                    original_cluster_id = self._generate_cluster_id()
-                    new_cluster_id_mapping[label] = original_cluster_id
-                
-                # Create new labels for split segments
-                current_label = label
-                segment_start = 0
-                
-                for split_idx in split_indices:
-                    # Update labels for current segment
-                    for i in range(segment_start, split_idx):
-                        report_id = cluster_reports_list[i]['id']
-                        report_idx = next(idx for idx, r in enumerate(reports) if r['id'] == report_id)
-                        new_labels[report_idx] = current_label
-                    
-                    # Create new label and cluster ID for next segment
-                    current_label = max(new_labels) + 1 if new_labels.size > 0 else 0
-                    new_cluster_id_mapping[current_label] = self._generate_cluster_id()
-                    segment_start = split_idx
-                
-                # Handle the last segment
-                for i in range(segment_start, len(cluster_reports_list)):
-                    report_id = cluster_reports_list[i]['id']
-                    report_idx = next(idx for idx, r in enumerate(reports) if r['id'] == report_id)
-                    new_labels[report_idx] = current_label
-        
+
+        new_labels, split_labels, segment_labels = split_on_time_gaps(
+            labels, _report_times_ns(reports), max_time_gap_days
+        )
+
+        # IDs are generated cluster by cluster, in order of first appearance: the original
+        # cluster's ID first if it has none yet, then one for each later segment.
+        for label, segment_label in zip(split_labels, segment_labels):
+            if not new_cluster_id_mapping.get(label):
+                new_cluster_id_mapping[label] = self._generate_cluster_id()
+            new_cluster_id_mapping[segment_label] = self._generate_cluster_id()
+
         return new_labels, new_cluster_id_mapping
     
     def save_cluster_mapping(self, cluster_id_mapping: Dict[int, str], labels: List[int], reports: List[dict]):
@@ -267,6 +182,155 @@ class ClusterIDManager:
             print(f"Error saving cluster mapping: {e}")
 
 
+def _report_times_ns(reports) -> np.ndarray:
+    """Parse report timestamps into UTC nanoseconds since the epoch."""
+    if isinstance(reports, ReportBatch):
+        return reports.timestamps.astype("datetime64[ns]").view(np.int64)
+    times = pd.to_datetime([r['timestamp'] for r in reports], utc=True, format="ISO8601").tz_localize(None)
+    return times.to_numpy().astype("datetime64[ns]").view(np.int64)
+
+
+def split_on_time_gaps(
+    labels: np.ndarray,
+    times_ns: np.ndarray,
+    max_time_gap_days: int = 14
+) -> Tuple[np.ndarray, List[int], List[int]]:
+    """
+    Split clusters wherever consecutive reports are more than max_time_gap_days apart.
+    
+    The first segment of a cluster keeps its label. Later segments get new labels counting
+    up from max(labels) + 1, going through the clusters in order of first appearance and
+    through each cluster's segments in time order.
+    
+    Args:
+        labels: Cluster labels, -1 for noise
+        times_ns: Report timestamps in nanoseconds
+        max_time_gap_days: Maximum allowed gap in whole days before splitting
+        
+    Returns:
+        Tuple of (new_labels, split_labels, segment_labels), where segment_labels are the
+        new labels in order of creation and split_labels the label each one was split from
+    """
+    labels = np.asarray(labels)
+    new_labels = labels.copy()
+    members = np.flatnonzero(labels != -1)
+    if members.size == 0:
+        return new_labels, [], []
+    
+    # Rank clusters by first appearance, then sort members by cluster rank and time.
+    # lexsort is stable, so reports at the same time keep their input order.
+    unique_labels, first_index, inverse = np.unique(labels[members], return_index=True, return_inverse=True)
+    rank = np.empty(len(unique_labels), dtype=np.int64)
+    rank[np.argsort(first_index)] = np.arange(len(unique_labels))
+    member_rank = rank[inverse]
+    order = np.lexsort((times_ns[members], member_rank))
+    
+    sorted_members = members[order]
+    sorted_rank = member_rank[order]
+    sorted_times = times_ns[sorted_members]
+    
+    # A gap of more than max_time_gap_days whole days is a gap of at least max_time_gap_days + 1 days.
+    splits = np.zeros(len(sorted_members), dtype=bool)
+    splits[1:] = (sorted_rank[1:] == sorted_rank[:-1]) & (
+        np.diff(sorted_times) >= (max_time_gap_days + 1) * NANOSECONDS_PER_DAY
+    )
+    
+    # Each split starts a segment with the next new label, so a report's label offset is the
+    # number of splits up to it, relative to the start of its cluster.
+    split_count = np.cumsum(splits)
+    cluster_start = np.ones(len(sorted_members), dtype=bool)
+    cluster_start[1:] = sorted_rank[1:] != sorted_rank[:-1]
+    start_count = np.maximum.accumulate(np.where(cluster_start, split_count, 0))
+    in_later_segment = split_count > start_count
+    
+    next_label = int(labels.max()) + 1
+    new_labels[sorted_members[in_later_segment]] = next_label - 1 + split_count[in_later_segment]
+    
+    split_positions = np.flatnonzero(splits)
+    split_labels = labels[sorted_members[split_positions]].tolist()
+    segment_labels = (next_label - 1 + split_count[split_positions]).tolist()
+    return new_labels, split_labels, segment_labels
+
+
+def match_clusters_by_overlap(
+    new_clusters: Dict[int, List[int]],
+    previous_clusters: Dict[str, List[int]],
+    min_overlap_ratio: float = 0.3
+) -> Dict[int, str]:
+    """
+    Match new clusters to previous clusters by the Jaccard overlap of their reports.
+    
+    Overlaps are counted for all pairs at once through a sparse cluster-by-report incidence
+    matrix, and the pairs are assigned one-to-one so that the total overlap is maximal.
+    
+    Args:
+        new_clusters: Report IDs of each new cluster, by label
+        previous_clusters: Report IDs of each previous cluster, by cluster ID
+        min_overlap_ratio: Pairs must overlap by more than this to be matched
+        
+    Returns:
+        Dictionary mapping matched new labels to previous cluster IDs
+    """
+    if not new_clusters or not previous_clusters:
+        return {}
+    
+    new_labels = list(new_clusters)
+    previous_ids = list(previous_clusters)
+    
+    new_reports = [new_clusters[label] for label in new_labels]
+    previous_reports = [previous_clusters[cid] or [] for cid in previous_ids]
+    all_reports = np.sort(np.concatenate(
+        [np.asarray(ids, dtype=np.int64) for ids in new_reports + previous_reports]
+    ))
+    all_reports = all_reports[np.concatenate([[True], all_reports[1:] != all_reports[:-1]])]
+    
+    def incidence(clusters):
+        rows = np.repeat(np.arange(len(clusters)), [len(ids) for ids in clusters])
+        cols = np.searchsorted(all_reports, np.concatenate([np.asarray(ids, dtype=np.int64) for ids in clusters]))
+        matrix = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(clusters), len(all_reports)))
+        matrix.data[:] = 1  # Count duplicate report IDs once, like sets.
+        return matrix
+    
+    new_matrix = incidence(new_reports)
+    previous_matrix = incidence(previous_reports)
+    
+    # Contingency table: number of shared reports for every pair that shares any.
+    overlap = (new_matrix @ previous_matrix.T).tocoo()
+    new_sizes = np.asarray(new_matrix.sum(axis=1)).ravel()
+    previous_sizes = np.asarray(previous_matrix.sum(axis=1)).ravel()
+    jaccard = overlap.data / (new_sizes[overlap.row] + previous_sizes[overlap.col] - overlap.data)
+    
+    candidate = jaccard > min_overlap_ratio
+    rows, cols, jaccard = overlap.row[candidate], overlap.col[candidate], jaccard[candidate]
+    if len(jaccard) == 0:
+        return {}
+    
+    # Optimal one-to-one assignment, solved separately for each connected group of candidate
+    # pairs. Most groups are a single pair, which is matched directly.
+    n_new = len(new_labels)
+    graph = coo_matrix((jaccard, (rows, n_new + cols)), shape=(n_new + len(previous_ids),) * 2)
+    _, component = connected_components(graph, directed=False)
+    pair_component = component[rows]
+    order = np.argsort(pair_component, kind="stable")
+    rows, cols, jaccard = rows[order], cols[order], jaccard[order]
+    _, starts, pair_counts = np.unique(pair_component[order], return_index=True, return_counts=True)
+    
+    single = starts[pair_counts == 1]
+    matched = list(zip(rows[single], cols[single]))
+    
+    for start, count in zip(starts[pair_counts > 1], pair_counts[pair_counts > 1]):
+        group = slice(start, start + count)
+        row_ids, row_pos = np.unique(rows[group], return_inverse=True)
+        col_ids, col_pos = np.unique(cols[group], return_inverse=True)
+        scores = np.zeros((len(row_ids), len(col_ids)))
+        scores[row_pos, col_pos] = jaccard[group]
+        for r, c in zip(*linear_sum_assignment(scores, maximize=True)):
+            if scores[r, c] > min_overlap_ratio:
+                matched.append((row_ids[r], col_ids[c]))
+    
+    return {new_labels[r]: previous_ids[c] for r, c in matched}
+
+
 def create_cluster_id_manager() -> ClusterIDManager:
     """Factory function to create a ClusterIDManager instance."""
     return ClusterIDManager()
@@ -3,9 +3,12 @@ from google.genai import types
 import numpy as np
 import ast
 
-from common.db import supabase
+from common.db import create_async_client, supabase
 
 import models.outbreakml.structures
+from models.outbreakml.embedding_store import EmbeddingStore
+from models.outbreakml.embeddings import decode_embeddings
+from models.outbreakml.structures import ReportBatch
 from generated.symptom_report_pb2 import SymptomReport
 
 
@@ -40,6 +43,222 @@ def fetch_reports_in_interval(start_timestamp: str, end_timestamp: str):
   }).execute()
   return response.data
 
+def iter_report_batches(
+    batch_size: int = 1000,
+    start_timestamp: str = None,
+    end_timestamp: str = None,
+    embedding_store: EmbeddingStore = None
+):
+  """
+    Fetches reports page by page with a keyset cursor on the report id.
+
+    Args:
+      batch_size (int): Number of reports per page.
+      start_timestamp (str): Only fetch reports at or after this time, if given.
+      end_timestamp (str): Only fetch reports before this time, if given.
+      embedding_store (EmbeddingStore): Read embeddings from this store instead of downloading
+        them, if given. Only the embeddings it doesn't have yet are fetched, and added to it.
+
+    Yields:
+      ReportBatch: One block of reports per page, in id order.
+  """
+
+  after_id = 0
+  while True:
+    rows = supabase.rpc("fetch_reports_page", {
+        "after_id": after_id,
+        "page_size": batch_size,
+        "start_time": start_timestamp,
+        "end_time": end_timestamp,
+        "with_embeddings": embedding_store is None
+    }).execute().data
+
+    if not rows:
+      return
+
+    if embedding_store is None:
+      yield ReportBatch.from_rows(rows)
+    else:
+      embeddings, valid = embedding_store.load([r["id"] for r in rows], fetch_embeddings_by_ids)
+      yield ReportBatch.from_rows([r for r, v in zip(rows, valid) if v], embeddings=embeddings)
+
+    if len(rows) < batch_size:
+      return
+    after_id = rows[-1]["id"]
+
+def fetch_all_report_batches(
+    batch_size: int = 1000,
+    start_timestamp: str = None,
+    end_timestamp: str = None,
+    embedding_store: EmbeddingStore = None
+) -> ReportBatch:
+  """
+    Fetches all reports, optionally within a time interval, into a single ReportBatch.
+
+    With an embedding_store, the embeddings of the batch are read from its memory map,
+    without a copy when the reports are stored in the same order.
+  """
+
+  batches = list(iter_report_batches(batch_size, start_timestamp, end_timestamp, embedding_store))
+  if embedding_store is None:
+    return ReportBatch.concat(batches)
+
+  ids = np.concatenate([ b.ids for b in batches ]) if batches else np.empty(0, dtype=np.int64)
+  return ReportBatch.concat(batches, embeddings=embedding_store.take(embedding_store.rows(ids)))
+
+def fetch_embeddings_by_ids(report_ids):
+  """
+    Fetches the embeddings of reports by ID, in pgvector's binary format.
+
+    Returns:
+      tuple: (ids, embeddings) of the reports that have a valid embedding,
+        with embeddings as a [n, 768] float32 array.
+  """
+
+  ids, embedding_bins = [], []
+  report_ids = [int(rid) for rid in report_ids]
+  for start in range(0, len(report_ids), 1000):
+    rows = supabase.rpc("fetch_embeddings_by_ids", {
+        "report_ids": report_ids[start:start + 1000]
+    }).execute().data
+    ids += [r["id"] for r in rows]
+    embedding_bins += [r["embedding_bin"] for r in rows]
+
+  embeddings, valid = decode_embeddings(embedding_bins)
+  return np.array(ids, dtype=np.int64)[valid], embeddings[valid]
+
+def fetch_reports_near(lats: list[float], lons: list[float], radius_meters: float):
+  """
+    Fetches all reports with an embedding within radius_meters of any of the given points.
+
+    Returns:
+      list: Report dicts, with the columns and projection of fetch_reports_page.
+  """
+
+  rows = supabase.rpc("fetch_reports_near", {
+      "lats": [float(lat) for lat in lats],
+      "lons": [float(lon) for lon in lons],
+      "radius_meters": float(radius_meters)
+  }).execute().data
+  return list(ReportBatch.from_rows(rows))
+
+def fetch_reports_by_ids(report_ids: list[int], batch_size: int = 1000):
+  """
+    Fetches the given reports that have an embedding.
+
+    Returns:
+      list: Report dicts, with the columns and projection of fetch_reports_page.
+  """
+
+  report_ids = [int(rid) for rid in report_ids]
+  rows = []
+  for start in range(0, len(report_ids), batch_size):
+    rows += supabase.rpc("fetch_reports_by_ids", {
+        "report_ids": report_ids[start:start + batch_size]
+    }).execute().data
+  return list(ReportBatch.from_rows(rows))
+
+def fetch_unclustered_reports(batch_size: int = 1000):
+  """
+    Fetches the reports that have an embedding but no clustering state, page by page.
+
+    These are the reports no run has clustered yet, including older ones whose embedding
+    was backfilled after the last run.
+
+    Returns:
+      list: Report dicts, with the columns and projection of fetch_reports_page.
+  """
+
+  rows = []
+  after_id = 0
+  while True:
+    page = supabase.rpc("fetch_unclustered_reports_page", {
+        "after_id": after_id,
+        "page_size": batch_size
+    }).execute().data
+    rows += page
+    if len(page) < batch_size:
+      break
+    after_id = page[-1]["id"]
+  return list(ReportBatch.from_rows(rows))
+
+def fetch_reports_without_embeddings(batch_size: int = 1000):
+  """
+    Fetches the id, symptoms, cause and summary of all reports that lack an embedding.
+  """
+
+  reports = []
+  after_id = 0
+  while True:
+    rows = supabase.table("reports").select("id, symptoms, cause, summary") \
+      .is_("embedding", "NULL").gt("id", after_id).order("id").limit(batch_size).execute().data
+    reports += rows
+    if len(rows) < batch_size:
+      return reports
+    after_id = rows[-1]["id"]
+
+def fetch_reports_without_summaries(batch_size: int = 1000):
+  """
+    Fetches the id, symptoms and cause of all reports that lack a summary.
+  """
+
+  reports = []
+  after_id = 0
+  while True:
+    rows = supabase.table("reports").select("id, symptoms, cause") \
+      .is_("summary", "NULL").gt("id", after_id).order("id").limit(batch_size).execute().data
+    reports += rows
+    if len(rows) < batch_size:
+      return reports
+    after_id = rows[-1]["id"]
+
+def update_report_embeddings(report_ids, embeddings):
+  """
+    Writes the embeddings of many reports in a single statement.
+
+    Args:
+      report_ids (list): Report IDs.
+      embeddings (np.ndarray): [n, 768] embeddings, in the same order.
+  """
+
+  response = supabase.rpc("update_report_embeddings", {
+      "report_ids": [int(rid) for rid in report_ids],
+      "embeddings": [np.asarray(e, dtype=np.float32).tolist() for e in embeddings]
+  }).execute()
+  return response.data
+
+def update_report_summaries(report_ids, summaries):
+  """
+    Writes the summaries of many reports in a single statement.
+  """
+
+  response = supabase.rpc("update_report_summaries", {
+      "report_ids": [int(rid) for rid in report_ids],
+      "summaries": list(summaries)
+  }).execute()
+  return response.data
+
+def fetch_group_centroids(report_id_groups):
+  """
+    Computes the centroids of many groups of reports with PostGIS, in a single call.
+
+    Args:
+      report_id_groups (list[list[int]]): Report IDs of each group.
+
+    Returns:
+      np.ndarray: [n_groups, 2] centroids as (lat, lon), NaN for groups without reports.
+  """
+
+  response = supabase.rpc("get_centroids", {
+      "report_ids": [int(rid) for ids in report_id_groups for rid in ids],
+      "group_ids": [g for g, ids in enumerate(report_id_groups) for _ in ids]
+  }).execute()
+
+  centroids = np.full((len(report_id_groups), 2), np.nan)
+  for row in response.data:
+    centroids[row["group_id"]] = [row["y"], row["x"]]
+  return centroids
+
 def save_report(report: SymptomReport):
   response = supabase.table("reports").insert(report).execute()
   return response.data
@@ -80,23 +299,77 @@ def save_timedelta_snapshots(
         total_reports: Total number of reports processed
         parameters: Additional parameters as dict
     """
-    from datetime import datetime
-    
-    # Create a new clustering run record
+    run_id = create_clustering_run(
+        eps_meters=eps_meters,
+        min_samples=min_samples,
+        max_time_gap_days=max_time_gap_days,
+        total_reports=total_reports,
+        total_clusters=sum(len(ts.snapshots) for ts in timedelta_snapshots),
+        parameters=parameters,
+        status="completed"
+    )
+    _insert_snapshots(run_id, timedelta_snapshots)
+    return run_id
+
+
+def create_clustering_run(
+    eps_meters=5000,
+    min_samples=3,
+    max_time_gap_days=14,
+    total_reports=0,
+    total_clusters=0,
+    parameters=None,
+    status="running"
+):
+    """
+    Create a clustering run record.
+
+    Runs created as 'running' are filled in with save_run_snapshots and completed with
+    complete_clustering_run, or set as 'failed' with set_clustering_run_status.
+
+    Returns:
+        ID of the new run
+    """
     run_data = {
         "total_reports": int(total_reports),
-        "total_clusters": int(sum(len(ts.snapshots) for ts in timedelta_snapshots)),
+        "total_clusters": int(total_clusters),
         "eps_meters": int(eps_meters),
         "min_samples": int(min_samples),
         "max_time_gap_days": int(max_time_gap_days),
         "parameters": _convert_numpy_types(parameters or {}),
-        "status": "completed"
+        "status": status
     }
     
     run_response = supabase.table("clustering_runs").insert(run_data).execute()
-    run_id = run_response.data[0]["run_id"]
-    
-    # Save all snapshots from all timedelta snapshots
+    return run_response.data[0]["run_id"]
+
+
+def save_run_snapshots(run_id, timedelta_snapshots, total_reports=0, parameters=None):
+    """
+    Save the TimedeltaSnapshot objects of a run created with create_clustering_run.
+
+    Args:
+        run_id: ID of the run
+        timedelta_snapshots: List of TimedeltaSnapshot objects
+        total_reports: Total number of reports processed
+        parameters: Additional parameters as dict
+    """
+    supabase.table("clustering_runs").update({
+        "total_reports": int(total_reports),
+        "total_clusters": int(sum(len(ts.snapshots) for ts in timedelta_snapshots)),
+        "parameters": _convert_numpy_types(parameters or {})
+    }).eq("run_id", int(run_id)).execute()
+
+    _insert_snapshots(run_id, timedelta_snapshots)
+
+
+def delete_clustering_run(run_id):
+    """Delete a clustering run and, by cascade, everything saved for it."""
+    supabase.table("clustering_runs").delete().eq("run_id", int(run_id)).execute()
+
+
+def _insert_snapshots(run_id, timedelta_snapshots):
+    """Save all snapshots from all timedelta snapshots into a run."""
     snapshot_data = []
     for timedelta_snapshot in timedelta_snapshots:
         for snapshot in timedelta_snapshot.snapshots:
@@ -114,8 +387,14 @@ def save_timedelta_snapshots(
     
     if snapshot_data:
         supabase.table("snapshots").insert(snapshot_data).execute()
-    
-    return run_id
+
+
+def set_clustering_run_status(run_id, status):
+    """
+    Set the status of a clustering run: 'running', 'completed' or 'failed'.
+    Only completed runs are read as the latest run.
+    """
+    supabase.table("clustering_runs").update({"status": status}).eq("run_id", int(run_id)).execute()
 
 
 def save_predicted_snapshots(predicted_snapshots, run_id):
@@ -145,27 +424,18 @@ def save_predicted_snapshots(predicted_snapshots, run_id):
         supabase.table("predicted_snapshots").insert(prediction_data).execute()
 
 
-def fetch_latest_timedelta_snapshots():
-    """
-    Fetch the latest TimedeltaSnapshot objects from the database.
-    
-    Returns:
-        List of TimedeltaSnapshot objects
-    """
+def _rows_to_timedelta_snapshots(rows):
+    """Group snapshot rows into TimedeltaSnapshot objects by time window."""
     from models.outbreakml.structures import TimedeltaSnapshot, ClusterSnapshot
-    
-    # Get latest snapshots
-    response = supabase.rpc("get_latest_snapshots").execute()
-    
-    if not response.data:
-        return []
-    
+
     # Group snapshots by time window
     time_windows = {}
-    for row in response.data:
+    timedeltas = {}
+    for row in rows:
         key = (row["time_window_start"], row["time_window_end"])
         if key not in time_windows:
             time_windows[key] = []
+            timedeltas[key] = row.get("timedelta", 1)
         
         # Convert database row to ClusterSnapshot
         cluster_snapshot = ClusterSnapshot(
@@ -176,7 +446,7 @@ def fetch_latest_timedelta_snapshots():
             avg_embedding=row["avg_embedding"],
             report_ids=row["report_ids"],
             common_symptoms=row["common_symptoms"],
-            reports=row["reports"]
+            reports=row.get("reports") or []
         )
         time_windows[key].append(cluster_snapshot)
     
@@ -184,7 +454,7 @@ def fetch_latest_timedelta_snapshots():
     timedelta_snapshots = []
     for (start, end), snapshots in time_windows.items():
         timedelta_snapshots.append(TimedeltaSnapshot(
-            timedelta=snapshots[0].timedelta if hasattr(snapshots[0], 'timedelta') else 1,
+            timedelta=timedeltas[(start, end)],
             time_window_start=start,
             time_window_end=end,
             snapshots=snapshots
@@ -193,6 +463,315 @@ def fetch_latest_timedelta_snapshots():
     return timedelta_snapshots
 
 
+def fetch_latest_timedelta_snapshots():
+    """
+    Fetch the latest TimedeltaSnapshot objects from the database.
+    
+    Returns:
+        List of TimedeltaSnapshot objects
+    """
+    # Get latest snapshots
+    response = supabase.rpc("get_latest_snapshots").execute()
+    
+    if not response.data:
+        return []
+    
+    return _rows_to_timedelta_snapshots(response.data)
+
+
+def fetch_run_timedelta_snapshots(run_id):
+    """
+    Fetch the TimedeltaSnapshot objects of a clustering run, with the id, lat, lon and
+    symptoms of their reports.
+
+    Args:
+        run_id: Clustering run to read
+
+    Returns:
+        List of TimedeltaSnapshot objects in time order
+    """
+    response = supabase.rpc("get_run_snapshots", {"target_run_id": int(run_id)}).execute()
+    return _rows_to_timedelta_snapshots(response.data or [])
+
+
+def save_run_geojson(run_id, geojson, etag, time_window_start=None, time_window_end=None):
+    """
+    Store the serialized GeoJSON of a clustering run, replacing any previous one.
+
+    Args:
+        run_id: Clustering run the GeoJSON was built from
+        geojson: Serialized FeatureCollection
+        etag: Hash of geojson
+        time_window_start: ISO start of the run's first time window
+        time_window_end: ISO end of the run's first time window
+    """
+    supabase.table("run_geojson").upsert({
+        "run_id": int(run_id),
+        "etag": etag,
+        "geojson": geojson,
+        "time_window_start": time_window_start,
+        "time_window_end": time_window_end
+    }).execute()
+
+
+def fetch_run_geojson(run_id):
+    """
+    Fetch the stored GeoJSON of a clustering run.
+
+    Returns:
+        Dict of run_id, geojson, etag, time_window_start and time_window_end, or None if
+        none was stored
+    """
+    response = (
+        supabase.table("run_geojson")
+        .select("run_id, geojson, etag, time_window_start, time_window_end")
+        .eq("run_id", int(run_id))
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+async def afetch_run_geojson(run_id):
+    """Async version of fetch_run_geojson, over the async client."""
+    client = await create_async_client()
+    response = await (
+        client.table("run_geojson")
+        .select("run_id, geojson, etag, time_window_start, time_window_end")
+        .eq("run_id", int(run_id))
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+def fetch_cluster_snapshots(cluster_id, start_time, end_time, run_id=None):
+    """
+    Fetch the snapshots of one cluster whose time window starts in [start_time, end_time).
+
+    Args:
+        cluster_id: Cluster to fetch the snapshots of
+        start_time: ISO start of the window
+        end_time: ISO end of the window
+        run_id: Clustering run to read, the latest completed one if None
+
+    Returns:
+        List of ClusterSnapshot objects in time order, with their reports' id and symptoms
+    """
+    from models.outbreakml.structures import ClusterSnapshot
+
+    response = supabase.rpc("get_cluster_snapshots", {
+        "target_cluster_id": str(cluster_id),
+        "start_time": start_time,
+        "end_time": end_time,
+        "target_run_id": int(run_id) if run_id is not None else None
+    }).execute()
+
+    rows = response.data or []
+    avg_embeddings, _ = decode_embeddings([row["avg_embedding"] for row in rows])
+
+    return [
+        ClusterSnapshot(
+            cluster_id=row["cluster_id"],
+            time_window_start=row["time_window_start"],
+            time_window_end=row["time_window_end"],
+            centroid=[row["centroid"]["coordinates"][1], row["centroid"]["coordinates"][0]],  # Convert from PostGIS format
+            avg_embedding=avg_embedding.tolist(),
+            report_ids=row["report_ids"],
+            common_symptoms=row["common_symptoms"],
+            reports=row["reports"]
+        )
+        for row, avg_embedding in zip(rows, avg_embeddings)
+    ]
+
+
+def _snapshot_page_params(start_time, end_time, cluster_id, page_size, run_id, after_time, after_id):
+    return {
+        "start_time": start_time,
+        "end_time": end_time,
+        "target_cluster_id": str(cluster_id) if cluster_id else None,
+        "after_time": after_time,
+        "after_id": after_id,
+        "page_size": page_size,
+        "target_run_id": int(run_id) if run_id is not None else None
+    }
+
+
+def _snapshot_page(rows):
+    """Convert a page of fetch_snapshots_page rows to ClusterSnapshot objects."""
+    from models.outbreakml.structures import ClusterSnapshot
+
+    avg_embeddings, _ = decode_embeddings([row["avg_embedding_bin"] for row in rows])
+    return [
+        ClusterSnapshot(
+            cluster_id=row["cluster_id"],
+            time_window_start=row["time_window_start"],
+            time_window_end=row["time_window_end"],
+            centroid=[row["centroid"]["coordinates"][1], row["centroid"]["coordinates"][0]],  # Convert from PostGIS format
+            avg_embedding=avg_embedding.tolist(),
+            report_ids=row["report_ids"],
+            common_symptoms=row["common_symptoms"]
+        )
+        for row, avg_embedding in zip(rows, avg_embeddings)
+    ]
+
+
+def iter_snapshot_pages(start_time=None, end_time=None, cluster_id=None, page_size=500, run_id=None):
+    """
+    Fetch the snapshots of a clustering run page by page, with a keyset cursor on
+    (time_window_start, snapshot_id).
+
+    Args:
+        start_time: Only fetch snapshots whose window starts at or after this ISO time, if given
+        end_time: Only fetch snapshots whose window starts before this ISO time, if given
+        cluster_id: Only fetch the snapshots of this cluster, if given
+        page_size: Number of snapshots per page
+        run_id: Clustering run to read, the latest completed one if None. Every page is read
+            from the run of the first one.
+
+    Yields:
+        List of ClusterSnapshot objects per page, in time order
+    """
+    after_time, after_id = None, 0
+    while True:
+        rows = supabase.rpc("fetch_snapshots_page", _snapshot_page_params(
+            start_time, end_time, cluster_id, page_size, run_id, after_time, after_id
+        )).execute().data
+
+        if not rows:
+            return
+
+        yield _snapshot_page(rows)
+
+        if len(rows) < page_size:
+            return
+        run_id = rows[-1]["run_id"]
+        after_time, after_id = rows[-1]["time_window_start"], rows[-1]["snapshot_id"]
+
+
+async def aiter_snapshot_pages(start_time=None, end_time=None, cluster_id=None, page_size=500, run_id=None):
+    """Async version of iter_snapshot_pages, over the async client."""
+    client = await create_async_client()
+
+    after_time, after_id = None, 0
+    while True:
+        response = await client.rpc("fetch_snapshots_page", _snapshot_page_params(
+            start_time, end_time, cluster_id, page_size, run_id, after_time, after_id
+        )).execute()
+        rows = response.data
+
+        if not rows:
+            return
+
+        yield _snapshot_page(rows)
+
+        if len(rows) < page_size:
+            return
+        run_id = rows[-1]["run_id"]
+        after_time, after_id = rows[-1]["time_window_start"], rows[-1]["snapshot_id"]
+
+
+def fetch_latest_clustering_run():
+    """
+    Fetch the most recent completed clustering run.
+
+    Returns:
+        The clustering run record, or None if there is none
+    """
+    response = (
+        supabase.table("clustering_runs")
+        .select("*")
+        .eq("status", "completed")
+        .order("created_at", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+async def afetch_latest_clustering_run():
+    """Async version of fetch_latest_clustering_run, over the async client."""
+    client = await create_async_client()
+    response = await (
+        client.table("clustering_runs")
+        .select("*")
+        .eq("status", "completed")
+        .order("created_at", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+def carry_forward_snapshots(source_run_id, target_run_id, exclude_report_ids):
+    """
+    Copy the snapshots of a previous run into a new run, skipping every
+    snapshot that contains one of exclude_report_ids.
+
+    Args:
+        source_run_id: Run to copy snapshots from
+        target_run_id: Run to copy snapshots into
+        exclude_report_ids: Report IDs whose snapshots were recomputed
+
+    Returns:
+        Number of snapshots copied
+    """
+    response = supabase.rpc("carry_forward_snapshots", {
+        "source_run_id": int(source_run_id),
+        "target_run_id": int(target_run_id),
+        "exclude_report_ids": [int(rid) for rid in exclude_report_ids]
+    }).execute()
+    return response.data or 0
+
+
+def fetch_report_cluster_states(report_ids=None, labels=None, batch_size=1000):
+    """
+    Fetch the stored DBSCAN state of reports, by report ID or by label.
+
+    Args:
+        report_ids: Report IDs to fetch states for
+        labels: DBSCAN labels to fetch the member states of
+        batch_size: Maximum number of values per request
+
+    Returns:
+        Dictionary mapping report IDs to (label, neighbor_count)
+    """
+    column, values = ("report_id", report_ids) if report_ids is not None else ("label", labels)
+    values = [int(v) for v in values or []]
+
+    states = {}
+    for start in range(0, len(values), batch_size):
+        response = (
+            supabase.table("report_cluster_states")
+            .select("report_id, label, neighbor_count")
+            .in_(column, values[start:start + batch_size])
+            .execute()
+        )
+        for row in response.data:
+            states[row["report_id"]] = (row["label"], row["neighbor_count"])
+
+    return states
+
+
+def complete_clustering_run(run_id, states):
+    """
+    Upsert the DBSCAN state of a run's reports and mark the run completed.
+
+    Both happen in a single statement, so the stored states are never a mix of
+    completed and failed runs, and the reports of a run that fails stay unclustered.
+
+    Args:
+        run_id: ID of the clustering run that produced the states
+        states: Dictionary mapping report IDs to (label, neighbor_count)
+    """
+    supabase.rpc("complete_clustering_run", {
+        "target_run_id": int(run_id),
+        "report_ids": [int(report_id) for report_id in states],
+        "labels": [int(label) for label, _ in states.values()],
+        "neighbor_counts": [int(count) for _, count in states.values()]
+    }).execute()
+
+
 def fetch_clustering_runs(limit=10):
     """
     Fetch recent clustering runs.
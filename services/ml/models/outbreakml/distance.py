@@ -0,0 +1,109 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+# Weights of the hybrid metric: kilometers of spatial distance and cosine distance.
+SPATIAL_WEIGHT = 0.1
+SEMANTIC_WEIGHT = 0.5
+
+
+def prepare_hybrid_features(features, scaler):
+  """
+    Splits a feature matrix into the arrays used by the hybrid metric.
+
+    Args:
+      features (np.ndarray): Feature matrix from create_feature_matrix, [n_reports, 2 + 768].
+      scaler (MinMaxScaler): The scaler used to normalize the UTM coordinates.
+
+    Returns:
+      tuple: (coords_m, unit_embeddings)
+        - coords_m: [n_reports, 2] spatial coordinates, denormalized to meters.
+        - unit_embeddings: [n_reports, 768] L2-normalized embeddings.
+  """
+
+  features = np.asarray(features, dtype=np.float64)
+
+  # Same denormalization as the original pairwise metric, which scales both axes by the x range.
+  coords_m = features[:, :2] * scaler.data_range_[0]
+
+  embeddings = features[:, 2:]
+  norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+  norms[norms == 0] = 1.0  # Zero vectors end up with cosine distance 1 to everything.
+  unit_embeddings = embeddings / norms
+
+  return coords_m, unit_embeddings
+
+
+def spatial_candidate_pairs(coords_m, radius_m):
+  """
+    Lists the report pairs that are within a spatial radius of each other.
+
+    Args:
+      coords_m (np.ndarray): [n_reports, 2] spatial coordinates in meters.
+      radius_m (float): Spatial radius in meters.
+
+    Returns:
+      np.ndarray: [n_pairs, 2] index pairs (i, j) with i < j.
+  """
+
+  if len(coords_m) < 2:
+    return np.empty((0, 2), dtype=np.intp)
+
+  # Pad the radius so pairs on the boundary are not lost to rounding in the tree.
+  tree = cKDTree(coords_m)
+  return tree.query_pairs(radius_m * (1 + 1e-9), output_type="ndarray")
+
+
+def hybrid_radius_graph(features, scaler, eps, block_size=65536):
+  """
+    Builds the sparse radius-neighbour graph of the hybrid spatial+semantic metric.
+
+    The distance between two reports is
+    SPATIAL_WEIGHT * (spatial_dist / 1000) + SEMANTIC_WEIGHT * cosine_dist.
+    Cosine distance is never negative, so only pairs within eps / SPATIAL_WEIGHT kilometers
+    can be neighbours. Those candidates are listed with a KD-tree first, and the embedding
+    distance is evaluated only for them, in blocks.
+
+    Args:
+      features (np.ndarray): Feature matrix from create_feature_matrix.
+      scaler (MinMaxScaler): The scaler used to normalize the UTM coordinates.
+      eps (float): Neighbourhood radius in hybrid distance units.
+      block_size (int): Number of candidate pairs evaluated per block.
+
+    Returns:
+      csr_matrix: [n_reports, n_reports] distances for every pair within eps,
+        suitable for DBSCAN(metric="precomputed").
+  """
+
+  coords_m, unit_embeddings = prepare_hybrid_features(features, scaler)
+  n = coords_m.shape[0]
+
+  pairs = spatial_candidate_pairs(coords_m, eps / SPATIAL_WEIGHT * 1000)
+
+  rows, cols, values = [], [], []
+  for start in range(0, len(pairs), block_size):
+    i, j = pairs[start:start + block_size].T
+
+    spatial_dist = np.linalg.norm(coords_m[i] - coords_m[j], axis=1)
+
+    cosine_dist = 1.0 - np.einsum("ij,ij->i", unit_embeddings[i], unit_embeddings[j])
+    np.clip(cosine_dist, 0.0, 2.0, out=cosine_dist)
+
+    dist = SPATIAL_WEIGHT * (spatial_dist / 1000) + SEMANTIC_WEIGHT * cosine_dist
+
+    within = dist <= eps
+    rows.append(i[within])
+    cols.append(j[within])
+    values.append(dist[within])
+
+  rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+  cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.intp)
+  values = np.concatenate(values) if values else np.empty(0, dtype=np.float64)
+
+  # Mirror the upper triangle and add every report as its own neighbour.
+  diagonal = np.arange(n)
+  rows, cols = np.concatenate([rows, cols, diagonal]), np.concatenate([cols, rows, diagonal])
+  values = np.concatenate([values, values, np.zeros(n)])
+
+  # Explicit zeros are kept, so duplicate reports are still neighbours.
+  return csr_matrix((values, (rows, cols)), shape=(n, n))
@@ -0,0 +1,157 @@
+"""
+Embedding Cache
+
+Summaries are canonical strings like "mild fever, severe cough: flu", and many reports
+share the same one. This cache maps a summary to its embedding, so each distinct summary
+is only embedded once per model and dimensionality.
+
+Entries are kept in memory with LRU eviction, in front of a persistent SQLite store.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from models.outbreakml.embeddings import EMBEDDING_DIM, EMBEDDING_MODEL
+
+
+def normalize_summary(summary: str) -> str:
+  """Lowercases a summary and collapses its whitespace, so equivalent summaries share a key."""
+  return re.sub(r"\s+", " ", summary.strip().lower())
+
+
+def cache_key(summary: str, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM) -> str:
+  return hashlib.sha256(f"{model}\0{dim}\0{normalize_summary(summary)}".encode()).hexdigest()
+
+
+class EmbeddingCache():
+  """
+    Content-addressed embedding cache keyed by the normalized summary, model and dimensionality.
+
+    Safe to share between threads.
+  """
+
+  def __init__(self, path: Optional[str] = None, capacity: int = 10000):
+    """
+      Args:
+        path (str): SQLite file of the persistent store, or None to only cache in memory.
+        capacity (int): Maximum number of embeddings kept in memory.
+    """
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+    self._lock = threading.Lock()
+    self._db = None
+
+    if path is not None:
+      Path(path).parent.mkdir(parents=True, exist_ok=True)
+      self._db = sqlite3.connect(path, check_same_thread=False)
+      self._db.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings ("
+        "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, "
+        "summary TEXT NOT NULL, embedding BLOB NOT NULL)"
+      )
+      self._db.commit()
+
+  def get_many(self, summaries: List[str], model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM) -> Dict[str, np.ndarray]:
+    """Returns the cached embeddings of the given summaries, by summary."""
+    keys = { summary: cache_key(summary, model, dim) for summary in summaries }
+    found = {}
+
+    with self._lock:
+      for summary, key in keys.items():
+        if key in self._memory:
+          self._memory.move_to_end(key)
+          found[summary] = self._memory[key]
+
+      missing = { key: summary for summary, key in keys.items() if summary not in found }
+      if missing and self._db is not None:
+        keys_list = list(missing)
+        for start in range(0, len(keys_list), 500):
+          chunk = keys_list[start:start + 500]
+          rows = self._db.execute(
+            f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+            chunk
+          ).fetchall()
+          for key, blob in rows:
+            embedding = np.frombuffer(blob, dtype="<f4")
+            found[missing[key]] = embedding
+            self._remember(key, embedding)
+
+      self.hits += len(found)
+      self.misses += len(keys) - len(found)
+
+    return found
+
+  def get(self, summary: str, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM) -> Optional[np.ndarray]:
+    return self.get_many([summary], model, dim).get(summary)
+
+  def put_many(self, summaries: List[str], embeddings, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM):
+    """Stores the embeddings of the given summaries."""
+    embeddings = np.asarray(embeddings, dtype="<f4").reshape(len(summaries), dim)
+    rows = [
+      (cache_key(summary, model, dim), model, dim, normalize_summary(summary), embedding.tobytes())
+      for summary, embedding in zip(summaries, embeddings)
+    ]
+
+    with self._lock:
+      for (key, *_), embedding in zip(rows, embeddings):
+        self._remember(key, embedding.copy())
+      if self._db is not None:
+        self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+        self._db.commit()
+
+  def put(self, summary: str, embedding, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM):
+    self.put_many([summary], [embedding], model, dim)
+
+  def _remember(self, key: str, embedding: np.ndarray):
+    self._memory[key] = embedding
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.capacity:
+      self._memory.popitem(last=False)
+
+
+class CachedEmbeddingBackend():
+  """
+    Wraps an embedding backend (see backfill.py) so that only summaries missing from the
+    cache are sent to it, each distinct one once.
+  """
+
+  def __init__(self, backend, cache: EmbeddingCache):
+    self.backend = backend
+    self.cache = cache
+    self.model = getattr(backend, "model", EMBEDDING_MODEL)
+    self.dim = getattr(backend, "dim", EMBEDDING_DIM)
+
+  async def __call__(self, summaries: List[str]) -> np.ndarray:
+    found = self.cache.get_many(summaries, self.model, self.dim)
+
+    # Equivalent summaries are embedded once, under their first spelling.
+    missing = {}
+    for summary in summaries:
+      if summary not in found:
+        missing.setdefault(cache_key(summary, self.model, self.dim), summary)
+
+    if missing:
+      to_embed = list(missing.values())
+      embeddings = await self.backend(to_embed)
+      self.cache.put_many(to_embed, embeddings, self.model, self.dim)
+      found.update(zip(to_embed, embeddings))
+
+    by_key = { cache_key(summary, self.model, self.dim): embedding for summary, embedding in found.items() }
+    return np.stack([ by_key[cache_key(summary, self.model, self.dim)] for summary in summaries ])
+
+
+@lru_cache(maxsize=None)
+def default_cache() -> EmbeddingCache:
+  """The service's embedding cache, stored in EMBEDDING_CACHE_PATH (default: data/embedding_cache.sqlite)."""
+  return EmbeddingCache(os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite"))
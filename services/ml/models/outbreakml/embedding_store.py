@@ -0,0 +1,217 @@
+"""
+Embedding Store
+
+A local, memory-mapped copy of the report embeddings, indexed by report id.
+
+Embeddings never change once backfill_embeddings writes them, so each one only has to
+be downloaded once. The store is two append-only files: the report ids (int64) and their
+embeddings (float32 rows), in the same order. Runs read the embeddings they need straight
+from the memory map and only fetch the ids the store hasn't seen yet.
+"""
+
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+
+from models.outbreakml.embeddings import EMBEDDING_DIM
+
+# Fetches the embeddings of report ids from the database: (ids, [n, dim] float32 embeddings).
+FetchEmbeddings = Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]
+
+
+class EmbeddingStore():
+  """
+    Append-only, memory-mapped float32 embeddings indexed by report id.
+
+    Writes go to the embeddings file first and to the ids file second, so a write that was
+    interrupted leaves at most some trailing embedding bytes, which are dropped on open.
+    Only one process should append to a store at a time. Within it, the store is safe to share
+    between threads.
+
+    Files are never truncated once mapped: clear() replaces them with new ones, so arrays
+    returned by take() before keep reading the old embeddings.
+  """
+
+  IDS_FILE = "ids.i64"
+  EMBEDDINGS_FILE = "embeddings.f32"
+
+  def __init__(self, path: str, dim: int = EMBEDDING_DIM):
+    self.path = Path(path)
+    self.dim = dim
+    self.path.mkdir(parents=True, exist_ok=True)
+    self._lock = threading.RLock()
+    self._open(repair=True)
+
+  def _open(self, repair: bool = False):
+    ids_path = self.path / self.IDS_FILE
+    embeddings_path = self.path / self.EMBEDDINGS_FILE
+    ids_path.touch()
+    embeddings_path.touch()
+
+    # Keep only the rows that are complete in both files. Incomplete rows are only cut off
+    # before the files are first mapped, when no array can be reading them.
+    row_bytes = self.dim * np.dtype(np.float32).itemsize
+    n = min(ids_path.stat().st_size // 8, embeddings_path.stat().st_size // row_bytes)
+    if repair:
+      for file, size in ((ids_path, n * 8), (embeddings_path, n * row_bytes)):
+        if file.stat().st_size != size:
+          os.truncate(file, size)
+
+    self.ids = np.fromfile(ids_path, dtype="<i8", count=n)
+    if n > 0:
+      self.embeddings = np.memmap(embeddings_path, dtype="<f4", mode="r", shape=(n, self.dim))
+    else:
+      self.embeddings = np.empty((0, self.dim), dtype=np.float32)
+
+    # id -> row index, as the ids in sorted order and the row of each.
+    self._order = np.argsort(self.ids, kind="stable")
+    self._sorted_ids = self.ids[self._order]
+
+  def __len__(self):
+    return len(self.ids)
+
+  def rows(self, ids) -> np.ndarray:
+    """Returns the row index of each report id, or -1 for ids that aren't in the store."""
+    ids = np.asarray(ids, dtype=np.int64)
+    with self._lock:
+      sorted_ids, order = self._sorted_ids, self._order
+    if len(sorted_ids) == 0:
+      return np.full(len(ids), -1, dtype=np.int64)
+
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    found = sorted_ids[pos] == ids
+    return np.where(found, order[pos], -1)
+
+  def take(self, rows) -> np.ndarray:
+    """
+      Returns the embeddings of the given rows.
+
+      A run of consecutive rows, which is what reports fetched in id order map to once the
+      store has been filled in id order, is returned as a view of the memory map without copying.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+      return np.empty((0, self.dim), dtype=np.float32)
+
+    with self._lock:
+      embeddings = self.embeddings
+    start = rows[0]
+    if rows[-1] - start == len(rows) - 1 and np.all(np.diff(rows) == 1):
+      return embeddings[start:start + len(rows)]
+    return np.asarray(embeddings[rows])
+
+  def append(self, ids, embeddings) -> int:
+    """Appends the embeddings of report ids that aren't in the store yet, returning how many were added."""
+    ids = np.asarray(ids, dtype=np.int64)
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), self.dim)
+
+    _, first = np.unique(ids, return_index=True)
+    first = np.sort(first)
+
+    # Checked and written under the lock, so an id is never written twice and the two
+    # files stay in step.
+    with self._lock:
+      first = first[self.rows(ids[first]) < 0]
+      if len(first) == 0:
+        return 0
+
+      # Rows are written right after the last complete one, over what an interrupted append
+      # may have left. That is past the end of every memory map, so it is safe to overwrite.
+      n = len(self)
+      for name, data in ((self.EMBEDDINGS_FILE, embeddings[first].astype("<f4")), (self.IDS_FILE, ids[first].astype("<i8"))):
+        with open(self.path / name, "r+b") as f:
+          f.seek(n * data[0].nbytes)
+          f.write(data.tobytes())
+          f.truncate()
+          f.flush()
+          os.fsync(f.fileno())
+
+      self._open()
+      return len(first)
+
+  def load(self, ids, fetch_missing: FetchEmbeddings) -> Tuple[np.ndarray, np.ndarray]:
+    """
+      Returns the embeddings of report ids, fetching and storing the ones the store hasn't seen.
+
+      Args:
+        ids: Report ids.
+        fetch_missing: Fetches the embeddings of the ids that aren't in the store.
+
+      Returns:
+        tuple: (embeddings, valid)
+          - embeddings: [n, dim] float32 embeddings of the ids that have one, in order.
+          - valid: [n] boolean mask of the ids that have an embedding.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    with self._lock:
+      rows = self.rows(ids)
+
+      missing = ids[rows < 0]
+      if len(missing) > 0:
+        fetched_ids, fetched = fetch_missing(missing)
+        added = self.append(fetched_ids, fetched)
+        print(f"Embedding store: fetched {added} of {len(missing)} missing embeddings, {len(self)} stored.")
+        rows = self.rows(ids)
+
+      valid = rows >= 0
+      return self.take(rows[valid]), valid
+
+  def check(self, fetch: FetchEmbeddings, sample_size: int = 100, seed: int = None) -> bool:
+    """
+      Compares a random sample of the stored embeddings against the database.
+
+      If a sampled report was deleted or its embedding changed, the store is cleared so it
+      gets rebuilt from the database.
+
+      Returns:
+        bool: Whether the sample matched.
+    """
+    with self._lock:
+      if len(self) == 0:
+        return True
+
+      rng = np.random.default_rng(seed)
+      sample = rng.choice(self.ids, size=min(sample_size, len(self)), replace=False)
+      fetched_ids, fetched = fetch(sample)
+
+      fetched_rows = self.rows(fetched_ids)
+      consistent = (
+        len(fetched_ids) == len(sample) and
+        np.all(fetched_rows >= 0) and
+        np.allclose(self.take(fetched_rows), fetched, rtol=0, atol=1e-6)
+      )
+
+      if not consistent:
+        print(f"Embedding store at {self.path} is out of sync with the database, clearing it.")
+        self.clear()
+      return bool(consistent)
+
+  def clear(self):
+    """
+      Removes every stored embedding.
+
+      The files are replaced by new empty ones rather than truncated, so memory maps of the old
+      ones, such as arrays previously returned by take, stay readable until they are released.
+    """
+    with self._lock:
+      for name in (self.EMBEDDINGS_FILE, self.IDS_FILE):
+        replacement = self.path / f"{name}.new"
+        open(replacement, "wb").close()
+        os.replace(replacement, self.path / name)
+      self._open()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> EmbeddingStore:
+  """The service's embedding store, under EMBEDDING_STORE_DIR (default: data/embeddings)."""
+  global _default_store
+  with _default_store_lock:
+    if _default_store is None:
+      _default_store = EmbeddingStore(os.getenv("EMBEDDING_STORE_DIR", "data/embeddings"))
+    return _default_store
@@ -1,5 +1,5 @@
 import ast
-import json
+import warnings
 import numpy as np
 from google.genai import types
 
@@ -92,73 +92,221 @@ def generate_summary(symptoms: dict[str, int], cause: str):
   summary = f"{summary}: {cause}"
   return summary
 
-def generate_embeddings(symptoms, cause) -> list[float]:
-  summary = generate_summary(symptoms, cause)
+EMBEDDING_MODEL = "gemini-embedding-001"
+EMBEDDING_DIM = 768
+
+def generate_embeddings(summary: str, cache=None) -> np.ndarray:
+  """
+    Embeds a summary from generate_summary.
+
+    Args:
+      summary (str): The summary to embed.
+      cache (EmbeddingCache): Cache to look the summary up in first, defaults to the service's cache.
+
+    Returns:
+      np.ndarray: The normalized [768] float32 embedding.
+  """
+  from models.outbreakml.embedding_cache import default_cache
+
+  cache = cache or default_cache()
+  cached = cache.get(summary, EMBEDDING_MODEL, EMBEDDING_DIM)
+  if cached is not None:
+    return cached
+
   print(f"Generated summary to embed: {summary}")
 
   # Generate embeddings using Gemini.
-  embeddings = [
-      np.array(e.values)
+  [embedding] = [
+      np.array(e.values, dtype=np.float32)
       for e in gemini_client.models.embed_content(
-        model="gemini-embedding-001",
+        model=EMBEDDING_MODEL,
         contents=[summary],
         config=types.EmbedContentConfig(
           task_type="CLUSTERING",
-          output_dimensionality=768
+          output_dimensionality=EMBEDDING_DIM
         )
       ).embeddings
   ]
 
   # Normalize embeddings
-  embeddings = embeddings / np.linalg.norm(embeddings)
+  embedding = embedding / np.linalg.norm(embedding)
+
+  cache.put(summary, embedding, EMBEDDING_MODEL, EMBEDDING_DIM)
+  return embedding
 
-  return embeddings
 
 def decode_embedding(embedding):
   """Decode a pgvector embedding string to a list of 768 floats."""
+  decoded, valid = decode_embeddings([embedding])
+  return decoded[0].tolist() if valid[0] else None
+
+
+def decode_embeddings(embeddings, dim: int = EMBEDDING_DIM):
+  """
+    Decodes a batch of embeddings into a single contiguous float32 array.
+
+    Every embedding of the batch must use the same encoding, either:
+      - pgvector text literals, e.g. "[0.1,0.2,...]", as returned for vector columns;
+      - binary, as bytes or a PostgREST bytea hex string ("\\x..."), in one of the formats
+        of _BINARY_FORMATS, told apart by their size;
+      - sequences or arrays of floats, e.g. embeddings already decoded.
+
+    Dimensions are validated for the whole batch at once. Only when that fails are the rows
+    decoded one by one, to find the invalid ones.
+
+    Args:
+      embeddings (list): Encoded embeddings.
+      dim (int): Expected number of dimensions.
+
+    Returns:
+      tuple: (decoded, valid)
+        - decoded: [n, dim] float32 array, with zero rows for invalid embeddings.
+        - valid: [n] boolean mask of the embeddings that could be decoded.
+  """
+
+  n = len(embeddings)
+  decoded = np.zeros((n, dim), dtype=np.float32)
+  valid = np.zeros(n, dtype=bool)
+  if n == 0:
+    return decoded, valid
+
+  decode_bulk = {
+    "text": _decode_text_bulk,
+    "binary": _decode_binary_bulk,
+    "array": _decode_array_bulk
+  }[_encoding(embeddings[0])]
+
   try:
-    if not embedding or embedding == '[]':
-      raise ValueError("Empty or invalid embedding string")
+    decoded[:] = decode_bulk(embeddings, dim)
+    valid[:] = True
+    return decoded, valid
+  except (ValueError, TypeError, AttributeError, DeprecationWarning):
+    pass
+
+  # Slow path: decode row by row so a single bad embedding doesn't drop the whole batch.
+  decode_row = {
+    "text": _decode_text,
+    "binary": _decode_binary,
+    "array": _decode_array
+  }
+  for i, embedding in enumerate(embeddings):
+    try:
+      decoded[i] = decode_row[_encoding(embedding)](embedding, dim)
+      valid[i] = True
+    except (ValueError, TypeError, AttributeError, DeprecationWarning) as e:
+      print(f"Failed to decode embedding {i}: {e}")
+
+  return decoded, valid
+
+
+# Binary embedding formats: (header bytes, element dtype).
+# pgvector's vector_send/halfvec_send write a dimension and an unused int16, then big-endian values.
+_BINARY_FORMATS = [
+  (4, np.dtype(">f4")),  # vector_send
+  (4, np.dtype(">f2")),  # halfvec_send
+  (0, np.dtype("<f4")),  # raw little-endian float32
+  (0, np.dtype("<f2")),  # raw little-endian half precision
+]
+
+def _binary_format(size: int, dim: int):
+  for header, dtype in _BINARY_FORMATS:
+    if size == header + dim * dtype.itemsize:
+      return header, dtype
+  raise ValueError(f"Binary embedding of {size} bytes doesn't hold {dim} dimensions")
+
+def _to_bytes(embedding) -> bytes:
+  if isinstance(embedding, str):
+    return bytes.fromhex(embedding[2:])  # PostgREST returns bytea as "\\x" followed by hex digits.
+  return bytes(embedding)
+
+def _check_header(data: np.ndarray, header: int, dim: int):
+  """Checks the dimension stored in the pgvector headers of a [n, row_size] byte array."""
+  if header and not np.all(data[:, :2].copy().view(">i2") == dim):
+    raise ValueError(f"Embedding header doesn't hold {dim} dimensions")
+
+def _decode_binary(embedding, dim: int) -> np.ndarray:
+  data = _to_bytes(embedding)
+  header, dtype = _binary_format(len(data), dim)
+  _check_header(np.frombuffer(data, dtype=np.uint8).reshape(1, -1), header, dim)
+  return np.frombuffer(data, dtype=dtype, offset=header)
+
+def _decode_binary_bulk(embeddings, dim: int) -> np.ndarray:
+  # All embeddings must have the same size, and are joined into one buffer in a single call.
+  if len(set(map(len, embeddings))) != 1:
+    raise ValueError("Binary embeddings of different sizes")
+  if isinstance(embeddings[0], str):
+    data = bytes.fromhex("".join(e[2:] for e in embeddings))
+  else:
+    data = b"".join(map(bytes, embeddings))
 
-    emb = json.loads(embedding) #ast.literal_eval(embedding)
-    if not isinstance(emb, (list, tuple)) or len(emb) != 768:
-      raise ValueError(f"Embedding length is {len(emb)}, expected 768")
+  n = len(embeddings)
+  row_size = len(data) // n
+  header, dtype = _binary_format(row_size, dim)
 
-    return [float(x) for x in emb]  # Ensure all elements are floats
+  rows = np.frombuffer(data, dtype=np.uint8).reshape(n, row_size)
+  _check_header(rows, header, dim)
+  return rows[:, header:].copy().view(dtype).astype(np.float32)
 
-  except (ValueError, SyntaxError) as e:
-    print(f"Failed to decode embedding: {e}")
-    return None
+def _parse_floats(text: str) -> np.ndarray:
+  # Older NumPy versions only warn, and return what was parsed, on malformed text.
+  with warnings.catch_warnings():
+    warnings.simplefilter("error", DeprecationWarning)
+    return np.fromstring(text, dtype=np.float32, sep=",")
+
+def _decode_text(embedding: str, dim: int) -> np.ndarray:
+  if not embedding or embedding == '[]':
+    raise ValueError("Empty or invalid embedding string")
+
+  values = _parse_floats(embedding.strip()[1:-1])
+  if values.shape[0] != dim:
+    raise ValueError(f"Embedding length is {values.shape[0]}, expected {dim}")
+  return values
+
+def _decode_text_bulk(embeddings, dim: int) -> np.ndarray:
+  # Every literal must have exactly dim values, i.e. dim - 1 commas, so they line up when concatenated.
+  commas = np.array([ e.count(",") for e in embeddings ])
+  if not np.all(commas == dim - 1):
+    raise ValueError(f"Embeddings don't all have {dim} dimensions")
+
+  text = ",".join(embeddings).replace("[", "").replace("]", "")
+  values = _parse_floats(text)
+  if values.shape[0] != len(embeddings) * dim:
+    raise ValueError(f"Embeddings don't all have {dim} dimensions")
+  return values.reshape(len(embeddings), dim)
+
+def _encoding(embedding) -> str:
+  if isinstance(embedding, str):
+    return "binary" if embedding.startswith("\\x") else "text"
+  if isinstance(embedding, (bytes, bytearray, memoryview)):
+    return "binary"
+  return "array"
+
+def _decode_array_bulk(embeddings, dim: int) -> np.ndarray:
+  values = np.asarray(embeddings, dtype=np.float32)
+  if values.shape != (len(embeddings), dim):
+    raise ValueError(f"Embeddings don't all have {dim} dimensions")
+  return values
+
+def _decode_array(embedding, dim: int) -> np.ndarray:
+  if embedding is None:
+    raise ValueError("Missing embedding")
+
+  values = np.asarray(embedding, dtype=np.float32).ravel()
+  if values.shape[0] != dim:
+    raise ValueError(f"Embedding length is {values.shape[0]}, expected {dim}")
+  return values
 
 
 def backfill_summaries():
   """
     Backfills summaries for all reports that lack one.
   """
-
-  response = supabase.table("reports").select("id, symptoms, cause").is_("summary", "NULL").execute()
-  reports = response.data
-  for report in reports:
-      symptoms = report["symptoms"]
-      cause = report["cause"]
-      if symptoms:
-          summary = generate_summary(symptoms, cause)
-          supabase.table("reports").update({"summary": summary}).eq("id", report["id"]).execute()
-  print(f"Updated {len(reports)} reports with summaries.")
+  from models.outbreakml.backfill import backfill_summaries
+  return backfill_summaries()
 
 def backfill_embeddings():
   """
-    Backfills embeddings for all reports that lack one.
+    Backfills embeddings for all reports that lack one, in concurrent batches (see backfill.py).
   """
-
-  response = supabase.table("reports").select("id, symptoms, cause").is_("embedding", "NULL").execute()
-  reports = response.data
-  for report in reports:
-      print(report)
-      symptoms = report["symptoms"]
-      cause = report["cause"]
-      print(symptoms)
-      if symptoms:
-          [embedding] = generate_embeddings(symptoms, cause)
-          supabase.table("reports").update({"embedding": embedding.tolist()}).eq("id", report["id"]).execute()
-  print(f"Updated {len(reports)} reports with embeddings.")
\ No newline at end of file
+  from models.outbreakml.backfill import backfill_embeddings
+  return backfill_embeddings()
@@ -0,0 +1,140 @@
+"""
+Forecast Model Cache
+
+Between runs, most clusters' daily series are unchanged or have only gained a few days.
+This cache keeps the fitted VAR model of each persistent cluster_id: its coefficients,
+the OLS statistics they were solved from, the last observations it forecasts from, and a
+hash of the series it was fit to. predict.py reuses a model whose series is unchanged and
+refits it incrementally when the series has only been appended to.
+
+Models are keyed by cluster_id and max_lags, since the lag order is selected up to max_lags.
+The forecast is stored with its number of steps and recomputed from the coefficients when
+a different number is requested.
+
+Entries are kept in memory, in front of a persistent SQLite store.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def window_hash(values: np.ndarray) -> str:
+  """Hash of a [days, variables] daily series."""
+  return hashlib.sha256(np.ascontiguousarray(values, dtype=np.float64).tobytes()).hexdigest()
+
+
+@dataclass
+class ForecastModel():
+  max_lags: int
+  window_hash: str                # Hash of the series the model was fit to
+  n_obs: int                      # Days in that series
+  lag_order: int                  # Lag order selected by AIC
+  params: np.ndarray              # [1 + lag_order * k, k] intercept and lag coefficients, as in statsmodels
+  last_observations: np.ndarray   # [max_lags, k] last days of the series
+  zz: np.ndarray                  # Z'Z of the max_lags design over the days from max_lags on
+  zy: np.ndarray                  # Z'Y over the same days
+  yy: np.ndarray                  # Y'Y over the same days
+  steps: int                      # Days forecast
+  forecast: np.ndarray            # [steps, k] forecast
+
+  def fits(self, values: np.ndarray) -> bool:
+    """Whether the model was fit to exactly this series."""
+    return len(values) == self.n_obs and window_hash(values) == self.window_hash
+
+  def extends(self, values: np.ndarray) -> bool:
+    """Whether this series is the one the model was fit to, with days appended."""
+    return len(values) > self.n_obs and window_hash(values[:self.n_obs]) == self.window_hash
+
+  def to_json(self) -> str:
+    return json.dumps({
+      name: value.tolist() if isinstance(value, np.ndarray) else value
+      for name, value in self.__dict__.items()
+    })
+
+  @classmethod
+  def from_json(cls, text: str) -> "ForecastModel":
+    fields = json.loads(text)
+    for name in ("params", "last_observations", "zz", "zy", "yy", "forecast"):
+      fields[name] = np.asarray(fields[name], dtype=np.float64)
+    return cls(**fields)
+
+
+class ForecastCache():
+  """
+    Fitted forecast models by cluster_id and max_lags.
+
+    Safe to share between threads.
+  """
+
+  def __init__(self, path: Optional[str] = None):
+    """
+      Args:
+        path (str): SQLite file of the persistent store, or None to only cache in memory.
+    """
+    self.hits = 0
+    self.misses = 0
+    self._memory: Dict[tuple, ForecastModel] = {}
+    self._lock = threading.Lock()
+    self._db = None
+
+    if path is not None:
+      Path(path).parent.mkdir(parents=True, exist_ok=True)
+      self._db = sqlite3.connect(path, check_same_thread=False)
+      self._db.execute(
+        "CREATE TABLE IF NOT EXISTS forecast_models ("
+        "cluster_id TEXT NOT NULL, max_lags INTEGER NOT NULL, model TEXT NOT NULL, "
+        "PRIMARY KEY (cluster_id, max_lags))"
+      )
+      self._db.commit()
+
+  def get_many(self, cluster_ids: List[str], max_lags: int) -> Dict[str, ForecastModel]:
+    """Returns the cached models of the given clusters, by cluster_id."""
+    found = {}
+
+    with self._lock:
+      for cluster_id in cluster_ids:
+        if (cluster_id, max_lags) in self._memory:
+          found[cluster_id] = self._memory[(cluster_id, max_lags)]
+
+      missing = [ cluster_id for cluster_id in cluster_ids if cluster_id not in found ]
+      if missing and self._db is not None:
+        for start in range(0, len(missing), 500):
+          chunk = missing[start:start + 500]
+          rows = self._db.execute(
+            f"SELECT cluster_id, model FROM forecast_models WHERE max_lags = ? AND cluster_id IN ({','.join('?' * len(chunk))})",
+            [max_lags, *chunk]
+          ).fetchall()
+          for cluster_id, text in rows:
+            model = ForecastModel.from_json(text)
+            found[cluster_id] = self._memory[(cluster_id, max_lags)] = model
+
+      self.hits += len(found)
+      self.misses += len(cluster_ids) - len(found)
+
+    return found
+
+  def put_many(self, models: Dict[str, ForecastModel]):
+    """Stores the models of the given clusters."""
+    rows = [ (cluster_id, model.max_lags, model.to_json()) for cluster_id, model in models.items() ]
+
+    with self._lock:
+      for cluster_id, model in models.items():
+        self._memory[(cluster_id, model.max_lags)] = model
+      if self._db is not None:
+        self._db.executemany("INSERT OR REPLACE INTO forecast_models VALUES (?, ?, ?)", rows)
+        self._db.commit()
+
+
+@lru_cache(maxsize=None)
+def default_forecast_cache() -> ForecastCache:
+  """The service's forecast cache, stored in FORECAST_CACHE_PATH (default: data/forecast_cache.sqlite)."""
+  return ForecastCache(os.getenv("FORECAST_CACHE_PATH", "data/forecast_cache.sqlite"))
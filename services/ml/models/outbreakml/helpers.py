@@ -1,44 +1,32 @@
-from math import radians, sin, cos, sqrt, atan2
 import numpy as np
 
-def latlon_to_unit_sphere(lat, lon):
-    """
-    Convert lat/lon to 3D unit sphere coordinates
-    """
-    lat_rad = np.radians(lat)
-    lon_rad = np.radians(lon)
-
-    x = np.cos(lat_rad) * np.cos(lon_rad)
-    y = np.cos(lat_rad) * np.sin(lon_rad)
-    z = np.sin(lat_rad)
-
-    return np.array([x, y, z])
-
-def unit_sphere_to_latlon(x, y, z):
-    lat = np.degrees(np.arcsin(z))
-    lon = np.degrees(np.arctan2(y, x))
-    return lat, lon
+from geo import to_unit_sphere, from_unit_sphere
 
 def geographic_centroid(latitudes, longitudes):
     # Convert all points to 3D Cartesian
-    vectors = np.array([latlon_to_unit_sphere(lat, lon)
-                        for lat, lon in zip(latitudes, longitudes)])
+    vectors = to_unit_sphere(np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)).T
     # Average the vectors
     avg_vector = vectors.mean(axis=0)
     # Normalize the averaged vector
     avg_vector /= np.linalg.norm(avg_vector)
     # Convert back to lat/lon
-    return unit_sphere_to_latlon(*avg_vector)
+    return from_unit_sphere(*avg_vector)
+
+def geographic_centroids(latitudes, longitudes, group_index, n_groups):
+    """
+    Spherical mean of many groups of points at once, like geographic_centroid for each group.
 
-def km_to_chord_distance(d_km, R=6371):
-    return 2 * np.sin(d_km / (2 * R))
+    Args:
+        latitudes, longitudes: Coordinates of all points, in degrees.
+        group_index: Group of each point, in [0, n_groups).
+        n_groups: Number of groups.
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371000  # Radius of Earth in meters
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    distance = R * c
-    return distance
\ No newline at end of file
+    Returns:
+        [n_groups, 2] array of (lat, lon) centroids, NaN for empty groups.
+    """
+    vectors = to_unit_sphere(np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float))
+    sums = np.stack([np.bincount(group_index, weights=v, minlength=n_groups) for v in vectors])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sums /= np.linalg.norm(sums, axis=0)
+    lat, lon = from_unit_sphere(*sums)
+    return np.column_stack([lat, lon])
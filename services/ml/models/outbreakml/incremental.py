@@ -0,0 +1,174 @@
+"""
+Incremental Clustering
+
+This module updates the DBSCAN clustering of a previous run with newly submitted
+reports, instead of re-clustering the whole report history.
+
+Only insertions are handled. A new report can turn itself and its neighbours into
+core points, which either creates a cluster, absorbs noise into an existing
+cluster, or merges existing clusters. Reports never leave a cluster.
+"""
+
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.preprocessing import MinMaxScaler
+
+
+@dataclass
+class ClusteringState:
+    """
+    DBSCAN parameters and UTM scaler of a clustering run.
+
+    Stored in the run's parameters, next to the per-report labels and neighbour
+    counts in the report_cluster_states table.
+    """
+    eps_meters: int
+    min_samples: int
+    data_min: List[float]
+    data_range: List[float]
+    next_label: int
+
+    @classmethod
+    def from_run(cls, run: Optional[dict]) -> Optional["ClusteringState"]:
+        """Load the state stored in a clustering run record, if any."""
+        parameters = (run or {}).get("parameters") or {}
+        state = parameters.get("clustering_state")
+        return cls(**state) if state else None
+
+    @classmethod
+    def from_scaler(cls, scaler: MinMaxScaler, labels, eps_meters: int, min_samples: int) -> "ClusteringState":
+        """Create the state of a full clustering run."""
+        labels = np.asarray(labels)
+        return cls(
+            eps_meters=int(eps_meters),
+            min_samples=int(min_samples),
+            data_min=[float(v) for v in scaler.data_min_],
+            data_range=[float(v) for v in scaler.data_range_],
+            next_label=int(labels.max()) + 1 if labels.size > 0 else 0
+        )
+
+    def to_parameters(self) -> dict:
+        return asdict(self)
+
+    def scaler(self) -> MinMaxScaler:
+        """Rebuild the fitted UTM scaler so new reports land in the same metric space."""
+        data_min = np.asarray(self.data_min, dtype=np.float64)
+        data_max = data_min + np.asarray(self.data_range, dtype=np.float64)
+        scaler = MinMaxScaler()
+        scaler.fit(np.vstack([data_min, data_max]))
+        return scaler
+
+    def search_radius_meters(self) -> float:
+        """
+        Radius around a new report that contains every report whose neighbourhood it can change.
+
+        A report within eps of a new one may become a core point, and its own neighbours are
+        within eps of it, so everything within twice the spatial eps is needed. The hybrid metric
+        scales the y axis by the x range, which can stretch true distances by up to range_y / range_x.
+        """
+        range_x, range_y = self.data_range
+        stretch = max(1.0, range_y / range_x) if range_x > 0 else 1.0
+        return 2 * self.eps_meters * stretch * 1.01
+
+
+@dataclass
+class ClusterUpdate:
+    """Result of inserting new reports into an existing clustering."""
+    labels: np.ndarray
+    neighbor_counts: np.ndarray
+    relabeled: Dict[int, int] = field(default_factory=dict)
+    touched_labels: Set[int] = field(default_factory=set)
+    next_label: int = 0
+
+
+def update_clusters(graph, is_new, labels, neighbor_counts, min_samples: int, next_label: int) -> ClusterUpdate:
+    """
+    Insert new reports into an existing DBSCAN clustering.
+
+    The graph must cover every new report and every existing report within twice the
+    neighbourhood radius of one (see ClusteringState.search_radius_meters), so that the
+    neighbourhoods of all reports that can become core points are complete.
+
+    Args:
+        graph: Sparse radius-neighbour graph over the local reports, including self loops
+        is_new: Boolean mask of the reports being inserted
+        labels: Previous DBSCAN labels of the local reports, -1 for noise and new reports
+        neighbor_counts: Previous neighbour counts of the local reports, 0 for new reports
+        min_samples: DBSCAN min_samples
+        next_label: First unused DBSCAN label
+
+    Returns:
+        ClusterUpdate with the new local labels and neighbour counts, the existing labels that
+        were merged into another one, and the labels of every cluster that changed
+    """
+    adjacency = graph.tocsr(copy=True)
+    adjacency.data = np.ones_like(adjacency.data)  # Explicit zeros are neighbours too.
+
+    is_new = np.asarray(is_new, dtype=bool)
+    labels = np.asarray(labels, dtype=np.int64)
+    n = len(labels)
+
+    # New reports count their whole neighbourhood; existing ones only gain the new neighbours.
+    new_neighbors = adjacency @ is_new.astype(np.int64)
+    counts = np.where(is_new, np.diff(adjacency.indptr), np.asarray(neighbor_counts) + new_neighbors)
+
+    was_core = ~is_new & (np.asarray(neighbor_counts) >= min_samples) & (labels != -1)
+    core = counts >= min_samples
+    promoted = core & ~was_core
+
+    # Connect promoted core points to their core neighbours, and existing core points to a
+    # node standing for their cluster, so connected components reveal creations and merges.
+    rows, cols = adjacency.nonzero()
+    keep = promoted[rows] & core[cols]
+    existing_labels = np.unique(labels[was_core])
+    core_idx = np.flatnonzero(was_core)
+    label_nodes = n + np.searchsorted(existing_labels, labels[core_idx])
+
+    src = np.concatenate([rows[keep], core_idx])
+    dst = np.concatenate([cols[keep], label_nodes])
+    size = n + len(existing_labels)
+    _, component = connected_components(
+        coo_matrix((np.ones(len(src)), (src, dst)), shape=(size, size)),
+        directed=False
+    )
+
+    new_labels = labels.copy()
+    relabeled = {}
+    touched = set()
+    component_labels = {}
+    point_components, label_components = component[:n], component[n:]
+    for comp in np.unique(point_components[promoted]):
+        merged = existing_labels[label_components == comp]
+        if len(merged) > 0:
+            # Merged clusters keep the oldest label.
+            target = int(merged.min())
+            relabeled.update({int(label): target for label in merged if label != target})
+        else:
+            target = next_label
+            next_label += 1
+        component_labels[comp] = target
+        touched.add(target)
+
+    for source, target in relabeled.items():
+        new_labels[labels == source] = target
+    new_labels[promoted] = [component_labels[comp] for comp in point_components[promoted]]
+
+    # Reports left without a cluster become border points of a core neighbour, if any.
+    for i in np.flatnonzero(~core & (new_labels == -1)):
+        neighbors = adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i + 1]]
+        core_neighbors = neighbors[core[neighbors]]
+        if len(core_neighbors) > 0:
+            new_labels[i] = new_labels[core_neighbors.min()]
+            touched.add(int(new_labels[i]))
+
+    return ClusterUpdate(
+        labels=new_labels,
+        neighbor_counts=counts,
+        relabeled=relabeled,
+        touched_labels=touched,
+        next_label=next_label
+    )
@@ -0,0 +1,202 @@
+"""
+Clustering Jobs
+
+ProcessClusters requests are run as background jobs, one at a time, since two runs at once
+would race on the cluster ID mappings and counter. Full and incremental runs are coalesced
+separately: a request joins the running or queued job of its mode, and a request of the other
+mode is queued to run once the current job is done, so a full re-cluster asked for during an
+incremental run is never dropped. A request made less than min_interval seconds after the
+last successful job of its mode started gets that job, so reruns from the gateway and cron are
+rate limited. Failed jobs are never reused, so the next request retries.
+
+Each job records its clustering run in the database as 'running' as soon as it starts, and
+as 'failed' if it raises in any stage. Jobs record the time spent in each stage of the
+pipeline, reported by FetchClusteringStatus.
+"""
+
+import os
+import threading
+from concurrent.futures import Future
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class StageTiming():
+  name: str
+  started_at: float                 # time.monotonic() at the start of the stage
+  seconds: Optional[float] = None   # Duration, None while the stage is running
+
+  def elapsed(self) -> float:
+    return self.seconds if self.seconds is not None else time.monotonic() - self.started_at
+
+
+class ClusteringJob():
+  """
+    A ProcessClusters run and its progress.
+
+    The pipeline reports its stages with begin(), from the thread the job runs in.
+  """
+
+  def __init__(self, incremental: bool):
+    self.job_id = uuid.uuid4().hex
+    self.incremental = incremental
+    self.status = "queued"        # 'queued', 'running', 'completed' or 'failed'
+    self.run_id = None            # Clustering run, from the start of the job
+    self.error = None
+    self.created_at = datetime.now(timezone.utc)
+    self.started_at = None
+    self.finished_at = None
+    self.stages: List[StageTiming] = []
+    self.future = Future()        # Resolved with the job when it is done
+    self._lock = threading.Lock()
+
+  @property
+  def stage(self) -> Optional[str]:
+    """Name of the running stage, if any."""
+    with self._lock:
+      if self.stages and self.stages[-1].seconds is None:
+        return self.stages[-1].name
+      return None
+
+  def begin(self, name: str):
+    """Ends the running stage, if any, and starts the named one."""
+    with self._lock:
+      self._end_stage()
+      self.stages.append(StageTiming(name, time.monotonic()))
+
+  def start(self):
+    with self._lock:
+      self.status = "running"
+      self.started_at = datetime.now(timezone.utc)
+
+  def finish(self, run_id: Optional[int] = None, error: Optional[Exception] = None):
+    with self._lock:
+      self._end_stage()
+      self.status = "failed" if error is not None else "completed"
+      self.run_id = run_id
+      self.error = str(error) if error is not None else None
+      self.finished_at = datetime.now(timezone.utc)
+
+  def timings(self) -> List[Tuple[str, float, bool]]:
+    """(name, seconds, running) of each stage so far."""
+    with self._lock:
+      return [ (stage.name, stage.elapsed(), stage.seconds is None) for stage in self.stages ]
+
+  def _end_stage(self):
+    if self.stages and self.stages[-1].seconds is None:
+      self.stages[-1].seconds = time.monotonic() - self.stages[-1].started_at
+
+
+class ClusteringJobRunner():
+  """
+    Runs ProcessClusters jobs one at a time in an executor, coalescing requests of the same mode.
+
+    Safe to share between threads.
+  """
+
+  def __init__(self, process, executor, create_run, set_run_status, min_interval: float = None, history: int = 20):
+    """
+      Args:
+        process (callable): Runs the pipeline, called as process(run_id=..., incremental=...,
+          progress=job) and returning the saved run_id, or None if there was nothing to save,
+          e.g. pipeline.process_clusters.
+        executor (Executor): Executor the jobs run in.
+        create_run (callable): Records a clustering run as 'running' when a job starts, called as
+          create_run() and returning its run_id, e.g. db.create_clustering_run.
+        set_run_status (callable): Records a run's status when its job fails, called as
+          set_run_status(run_id, "failed"), e.g. db.set_clustering_run_status.
+        min_interval (float): Seconds between job starts of a mode, default: CLUSTERING_MIN_INTERVAL or 60.
+        history (int): Number of finished jobs kept for status requests.
+    """
+    self.process = process
+    self.executor = executor
+    self.create_run = create_run
+    self.set_run_status = set_run_status
+    self.min_interval = min_interval if min_interval is not None else float(os.getenv("CLUSTERING_MIN_INTERVAL", "60"))
+    self.history = history
+    self._jobs: OrderedDict[str, ClusteringJob] = OrderedDict()
+    self._running: Optional[ClusteringJob] = None
+    self._queued: OrderedDict[bool, ClusteringJob] = OrderedDict()   # By mode, in order of request
+    self._last_started: Dict[bool, Tuple[ClusteringJob, float]] = {}  # By mode: job, time.monotonic()
+    self._last: Optional[ClusteringJob] = None
+    self._lock = threading.Lock()
+
+  def submit(self, incremental: bool = False) -> Tuple[ClusteringJob, bool]:
+    """
+      Starts a job, or queues it behind the running one.
+
+      The running or queued job of the same mode is returned instead, as is the last job of
+      that mode if it completed and started less than min_interval ago.
+
+      Returns:
+        tuple: The job serving the request, and whether it was an existing one.
+    """
+    with self._lock:
+      if self._running is not None and self._running.incremental == incremental:
+        return self._running, True
+      if incremental in self._queued:
+        return self._queued[incremental], True
+      last, started_at = self._last_started.get(incremental, (None, None))
+      if last is not None and last.status == "completed" and time.monotonic() - started_at < self.min_interval:
+        return last, True
+
+      job = ClusteringJob(incremental)
+      self._jobs[job.job_id] = job
+      while len(self._jobs) > self.history:
+        self._jobs.popitem(last=False)
+      self._last = job
+
+      if self._running is None:
+        self._start(job)
+      else:
+        self._queued[incremental] = job
+      return job, False
+
+  def get(self, job_id: Optional[str] = None) -> Optional[ClusteringJob]:
+    """The job with this ID, or the latest one if None."""
+    with self._lock:
+      if not job_id:
+        return self._last
+      return self._jobs.get(job_id)
+
+  def _start(self, job: ClusteringJob):
+    # Called with the lock held.
+    self._running = job
+    self._last_started[job.incremental] = (job, time.monotonic())
+    self.executor.submit(self._run, job)
+
+  def _run(self, job: ClusteringJob) -> ClusteringJob:
+    job.start()
+    run_id = None
+    try:
+      run_id = job.run_id = self.create_run()
+      saved_run_id = self.process(run_id=run_id, incremental=job.incremental, progress=job)
+    except Exception as e:
+      print(f"Clustering job {job.job_id} failed: {e}")
+      self._fail_run(run_id)
+      job.finish(run_id=run_id, error=e)
+    else:
+      job.finish(run_id=saved_run_id)
+
+    # Start the next queued job before resolving this one, so a request made as soon as the
+    # job is done coalesces with the queued job rather than starting another.
+    with self._lock:
+      self._running = None
+      if self._queued:
+        self._start(self._queued.popitem(last=False)[1])
+
+    job.future.set_result(job)
+    return job
+
+  def _fail_run(self, run_id: Optional[int]):
+    if run_id is None:
+      return
+    try:
+      self.set_run_status(run_id, "failed")
+    except Exception as e:
+      print(f"Could not mark clustering run {run_id} as failed: {e}")
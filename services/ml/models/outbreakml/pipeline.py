@@ -0,0 +1,255 @@
+"""
+Clustering Pipeline
+
+Runs the clustering and snapshot generation pipeline behind ProcessClusters, either
+over the whole report history or incrementally over the reports submitted since the
+previous run.
+"""
+
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import numpy as np
+
+import models.outbreakml.db as db
+import models.outbreakml.snapshots as snapshots
+from models.outbreakml.cluster import assign_cluster_ids, cluster_reports, create_feature_matrix
+from models.outbreakml.distance import SPATIAL_WEIGHT, hybrid_radius_graph
+from models.outbreakml.embedding_store import default_store
+from models.outbreakml.cluster_id_manager import split_on_time_gaps
+from models.outbreakml.incremental import ClusteringState, update_clusters
+from models.outbreakml.run_geojson import publish_run
+from models.outbreakml.structures import TimedeltaSnapshot
+
+
+def process_clusters(
+    run_id: int,
+    eps_meters: int = 5000,
+    min_samples: int = 3,
+    max_time_gap_days: int = 14,
+    incremental: bool = False,
+    progress=None
+) -> Optional[int]:
+    """
+    Cluster reports, compute their snapshots and save them into a clustering run.
+
+    In incremental mode, only the reports submitted since the previous run are clustered
+    and only the clusters they touch are recomputed. A full run is done instead when there
+    is no previous state or it was computed with different parameters.
+
+    Args:
+        run_id: Clustering run created as 'running' (see db.create_clustering_run) when the
+            job started, which the results are saved into. The caller marks it failed if
+            this raises.
+        eps_meters: Spatial component in meters for DBSCAN
+        min_samples: Minimum samples to form a cluster
+        max_time_gap_days: Maximum time gap before splitting clusters
+        incremental: Only process the reports submitted since the previous run
+        progress: ClusteringJob (see jobs.py) to report the stages of the run to, if any
+
+    Returns:
+        run_id, or None if there was nothing to save, in which case the run is deleted
+    """
+    if incremental:
+        _begin(progress, "fetch")
+        previous_run = db.fetch_latest_clustering_run()
+        state = ClusteringState.from_run(previous_run)
+
+        if state and state.eps_meters == eps_meters and state.min_samples == min_samples:
+            return process_new_reports(run_id, previous_run, state, max_time_gap_days, progress)
+
+        print("No compatible clustering state found, running a full recomputation.")
+
+    return process_all_reports(run_id, eps_meters, min_samples, max_time_gap_days, progress)
+
+
+def _begin(progress, stage: str):
+    """Reports the start of a stage of the run, if a job is tracking it."""
+    if progress is not None:
+        progress.begin(stage)
+
+
+def _publish_geojson(run_id: int, timedelta_snapshots=None):
+    """Build and store the GeoJSON served for a saved run. FetchLatestData builds it on demand if this fails."""
+    try:
+        publish_run(run_id, timedelta_snapshots)
+    except Exception as e:
+        print(f"Warning: Could not publish GeoJSON for run {run_id}: {e}")
+
+
+def process_all_reports(run_id: int, eps_meters: int = 5000, min_samples: int = 3, max_time_gap_days: int = 14, progress=None) -> Optional[int]:
+    """Cluster the whole report history and save it into run_id as a full clustering run."""
+    _begin(progress, "fetch")
+    fetched_at = datetime.now(timezone.utc).isoformat()
+
+    store = default_store()
+    store.check(db.fetch_embeddings_by_ids)
+    reports = db.fetch_all_report_batches(embedding_store=store)
+
+    if not reports:
+        print("No reports to cluster.")
+        db.delete_clustering_run(run_id)
+        return None
+
+    _begin(progress, "cluster")
+    features, scaler, report_ids = create_feature_matrix(reports)
+    dbscan_labels, graph = cluster_reports(features, scaler, report_ids, eps_meters, min_samples, return_graph=True)
+    labels, cluster_id_mapping = assign_cluster_ids(dbscan_labels, reports, max_time_gap_days)
+
+    print(f"Clustered {len(reports)} reports into {len(set(labels))} clusters.")
+
+    _begin(progress, "snapshots")
+    timedelta_snapshots = snapshots.compute_snapshots_from_clusters(labels, reports, cluster_id_mapping)
+
+    _begin(progress, "save")
+    state = ClusteringState.from_scaler(scaler, dbscan_labels, eps_meters, min_samples)
+    db.save_run_snapshots(
+        run_id,
+        timedelta_snapshots,
+        total_reports=len(reports),
+        parameters={
+            "cluster_id_mapping": cluster_id_mapping,
+            "mode": "full",
+            "reports_fetched_at": fetched_at,
+            "clustering_state": state.to_parameters()
+        }
+    )
+
+    # The run only becomes the latest one once its report states are saved.
+    neighbor_counts = np.diff(graph.indptr)
+    db.complete_clustering_run(
+        run_id,
+        {rid: (label, count) for rid, label, count in zip(report_ids, dbscan_labels, neighbor_counts)}
+    )
+
+    print(f"Saved clustering run {run_id} with {len(timedelta_snapshots)} timedelta snapshots")
+    _begin(progress, "geojson")
+    _publish_geojson(run_id, timedelta_snapshots)
+    return run_id
+
+
+def generate_snapshots(
+    start_timestamp: str = None,
+    end_timestamp: str = None,
+    eps_meters: int = 5000,
+    min_samples: int = 3,
+    max_time_gap_days: int = 14
+) -> List[TimedeltaSnapshot]:
+    """
+    Cluster the reports of a time window and compute their snapshots, without saving a run.
+
+    Clusters are split on time gaps like in a saved run, but keep temporary IDs, since
+    persistent IDs are only assigned to saved runs.
+    """
+    reports = db.fetch_all_report_batches(
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+        embedding_store=default_store()
+    )
+
+    if not reports:
+        return []
+
+    features, scaler, report_ids = create_feature_matrix(reports)
+    labels = cluster_reports(features, scaler, report_ids, eps_meters, min_samples)
+    times_ns = reports.timestamps.astype("datetime64[ns]").view(np.int64)
+    labels, _, _ = split_on_time_gaps(np.asarray(labels), times_ns, max_time_gap_days)
+
+    return snapshots.compute_snapshots_from_clusters(labels, reports)
+
+
+def process_new_reports(run_id: int, previous_run: dict, state: ClusteringState, max_time_gap_days: int = 14, progress=None) -> Optional[int]:
+    """
+    Insert the reports no run has clustered yet into previous_run's clustering and save them
+    into run_id as a delta run.
+
+    The delta run holds recomputed snapshots for the clusters touched by the new reports,
+    and the previous run's snapshots of every other cluster are carried forward into it.
+    """
+    fetched_at = datetime.now(timezone.utc).isoformat()
+
+    # Every report with an embedding that no run has clustered, however old its timestamp,
+    # e.g. one whose embedding was backfilled after the previous run.
+    new_reports = db.fetch_unclustered_reports()
+
+    if not new_reports:
+        print("No new reports since the previous clustering run.")
+        db.delete_clustering_run(run_id)
+        return None
+
+    # Every existing report whose neighbourhood can change, with its stored state.
+    new_ids = {r["id"] for r in new_reports}
+    nearby = db.fetch_reports_near(
+        [r["lat"] for r in new_reports],
+        [r["lon"] for r in new_reports],
+        state.search_radius_meters()
+    )
+    nearby = [r for r in nearby if r["id"] not in new_ids]
+    nearby_states = db.fetch_report_cluster_states(report_ids=[r["id"] for r in nearby])
+    nearby = [r for r in nearby if r["id"] in nearby_states]
+
+    local_reports = new_reports + nearby
+    is_new = np.arange(len(local_reports)) < len(new_reports)
+    labels = np.array([-1] * len(new_reports) + [nearby_states[r["id"]][0] for r in nearby])
+    neighbor_counts = np.array([0] * len(new_reports) + [nearby_states[r["id"]][1] for r in nearby])
+
+    _begin(progress, "cluster")
+    features, scaler, report_ids = create_feature_matrix(local_reports, scaler=state.scaler())
+    graph = hybrid_radius_graph(features, scaler, SPATIAL_WEIGHT * (state.eps_meters / 1000))
+    update = update_clusters(graph, is_new, labels, neighbor_counts, state.min_samples, state.next_label)
+
+    print(
+        f"Inserted {len(new_reports)} new reports: {len(update.touched_labels)} clusters touched, "
+        f"{len(update.relabeled)} merged."
+    )
+
+    _begin(progress, "snapshots")
+    # States of every member of a touched or merged cluster, with merged labels rewritten.
+    member_states = db.fetch_report_cluster_states(labels=sorted(update.touched_labels | set(update.relabeled)))
+    report_states = {
+        rid: (update.relabeled.get(label, label), count)
+        for rid, (label, count) in member_states.items()
+    }
+    report_states.update({
+        rid: (int(label), int(count))
+        for rid, label, count in zip(report_ids, update.labels, update.neighbor_counts)
+    })
+
+    # Reports of the touched clusters, which get their snapshots recomputed.
+    member_ids = [rid for rid, (label, _) in report_states.items() if label in update.touched_labels]
+    local_by_id = {r["id"]: r for r in local_reports}
+    cluster_reports_list = [local_by_id[rid] for rid in member_ids if rid in local_by_id]
+    cluster_reports_list += db.fetch_reports_by_ids([rid for rid in member_ids if rid not in local_by_id])
+    cluster_labels = np.array([report_states[r["id"]][0] for r in cluster_reports_list], dtype=np.int64)
+
+    timedelta_snapshots = []
+    cluster_id_mapping = {}
+    if cluster_reports_list:
+        split_labels, cluster_id_mapping = assign_cluster_ids(cluster_labels, cluster_reports_list, max_time_gap_days)
+        timedelta_snapshots = snapshots.compute_snapshots_from_clusters(split_labels, cluster_reports_list, cluster_id_mapping)
+
+    _begin(progress, "save")
+    state.next_label = update.next_label
+    db.save_run_snapshots(
+        run_id,
+        timedelta_snapshots,
+        total_reports=len(new_reports),
+        parameters={
+            "cluster_id_mapping": cluster_id_mapping,
+            "mode": "incremental",
+            "base_run_id": previous_run["run_id"],
+            "reports_fetched_at": fetched_at,
+            "clustering_state": state.to_parameters()
+        }
+    )
+
+    # The delta run only becomes the latest one once the other clusters are carried forward into it.
+    _begin(progress, "carry_forward")
+    carried = db.carry_forward_snapshots(previous_run["run_id"], run_id, member_ids)
+    db.complete_clustering_run(run_id, report_states)
+
+    print(f"Saved delta run {run_id}: {len(timedelta_snapshots)} recomputed timedelta snapshots, {carried} carried forward")
+    # The carried forward snapshots are only in the database, so the GeoJSON is built from there.
+    _begin(progress, "geojson")
+    _publish_geojson(run_id)
+    return run_id
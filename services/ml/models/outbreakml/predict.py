@@ -1,22 +1,233 @@
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, wait
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta
+from functools import lru_cache
+import os
+import threading
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import pytz
 from statsmodels.tsa.vector_ar.var_model import VAR
 
+from models.outbreakml.forecast_cache import ForecastCache, ForecastModel, default_forecast_cache, window_hash
 from models.outbreakml.structures import ClusterSnapshot, PredictedSnapshot
 
-def predict_future_snapshots(snapshots: list[ClusterSnapshot], forecast_steps=1, max_lags=1, min_observations=5):
+SERIES_COLUMNS = ["report_count", "latitude", "longitude", "intensity"]
+
+# Bounds of PredictEvolution requests
+MAX_HISTORY_DAYS = 90
+MAX_FORECAST_STEPS = 30
+
+def _fit_forecast(values: np.ndarray, max_lags: int, steps: int, model: ForecastModel = None) -> ForecastModel:
+  """
+    Fits a VAR model to a daily series and forecasts its next steps days. Runs in the worker processes.
+
+    If the series extends the one the cached model was fit to, its OLS statistics are updated
+    with the appended days instead of being recomputed over the whole series.
+  """
+  values = np.asarray(values, dtype=np.float64)
+
+  if model is not None and model.max_lags == max_lags and model.extends(values) and not _has_constant_lags(values, max_lags):
+    try:
+      return _refit(model, values, steps)
+    except np.linalg.LinAlgError:
+      # Too short or numerically singular: statsmodels decides whether the series can be fit at all.
+      pass
+
+  results = VAR(values).fit(maxlags=max_lags, ic='aic')
+  targets = np.arange(max_lags, len(values))
+  z, y = _lagged(values, max_lags, targets), values[targets]
+  return _model(values, max_lags, steps, results.k_ar, np.asarray(results.params), z.T @ z, z.T @ y, y.T @ y)
+
+def _refit(model: ForecastModel, values: np.ndarray, steps: int) -> ForecastModel:
+  """Refits a model to its series with days appended, like VAR.fit(ic='aic') would."""
+  max_lags = model.max_lags
+  targets = np.arange(model.n_obs, len(values))
+  z, y = _lagged(values, max_lags, targets), values[targets]
+  zz, zy, yy = model.zz + z.T @ z, model.zy + z.T @ y, model.yy + y.T @ y
+  lag_order = _select_lag_order(zz, zy, yy, len(values), max_lags)
+
+  # The final fit also uses the first max_lags - lag_order days, which order selection leaves out.
+  m = 1 + lag_order * values.shape[1]
+  head = np.arange(lag_order, max_lags)
+  z, y = _lagged(values, lag_order, head), values[head]
+  params = np.linalg.lstsq(zz[:m, :m] + z.T @ z, zy[:m] + z.T @ y, rcond=None)[0]
+  return _model(values, max_lags, steps, lag_order, params, zz, zy, yy)
+
+def _model(values, max_lags, steps, lag_order, params, zz, zy, yy) -> ForecastModel:
+  last_observations = values[len(values) - max_lags:]
+  return ForecastModel(
+    max_lags = max_lags,
+    window_hash = window_hash(values),
+    n_obs = len(values),
+    lag_order = lag_order,
+    params = params,
+    last_observations = last_observations,
+    zz = zz,
+    zy = zy,
+    yy = yy,
+    steps = steps,
+    forecast = _forecast(params, lag_order, last_observations, steps)
+  )
+
+def _lagged(values: np.ndarray, lags: int, targets: np.ndarray) -> np.ndarray:
+  """VAR design rows of the target days: a constant, then the values 1 to lags days before."""
+  return np.hstack([ np.ones((len(targets), 1)) ] + [ values[targets - lag] for lag in range(1, lags + 1) ])
+
+def _has_constant_lags(values: np.ndarray, max_lags: int) -> bool:
+  """Whether a lagged variable is a nonzero constant, which VAR.fit rejects as duplicating the intercept."""
+  for lag in range(1, max_lags + 1):
+    lagged = values[max_lags - lag:len(values) - lag]
+    if np.any((np.ptp(lagged, axis=0) == 0) & (lagged[0] != 0)):
+      return True
+  return False
+
+def _select_lag_order(zz: np.ndarray, zy: np.ndarray, yy: np.ndarray, n_obs: int, max_lags: int) -> int:
+  """
+    Selects the lag order with the lowest AIC from OLS statistics, like VAR.fit(ic='aic') does:
+    every order is fit to the days from max_lags on.
+  """
+  k = yy.shape[0]
+  if max_lags > (n_obs - k - 1) // (1 + k):
+    raise np.linalg.LinAlgError("maxlags is too large for the number of observations")
+
+  nobs = n_obs - max_lags
+  aic = []
+  for lag_order in range(max_lags + 1):
+    m = 1 + lag_order * k
+    params = np.linalg.lstsq(zz[:m, :m], zy[:m], rcond=None)[0]
+    sse = yy - zy[:m].T @ params - params.T @ zy[:m] + params.T @ zz[:m, :m] @ params
+    logdet = -np.inf
+    if nobs > m:
+      eigenvalues = np.linalg.eigvalsh(sse / nobs)
+      if eigenvalues[0] <= eigenvalues[-1] * 1e-10:
+        raise np.linalg.LinAlgError("Residual covariance is singular")
+      logdet = np.sum(np.log(eigenvalues))
+    aic.append(logdet + 2.0 / nobs * (lag_order * k ** 2 + k))
+  return int(np.argmin(aic))
+
+def _forecast(params: np.ndarray, lag_order: int, last_observations: np.ndarray, steps: int) -> np.ndarray:
+  """Iterates the fitted VAR model steps days past the last observations."""
+  history = list(last_observations)
+  forecast = np.empty((steps, params.shape[1]))
+  for step in range(steps):
+    z = np.concatenate([ [1.0] ] + [ history[-lag] for lag in range(1, lag_order + 1) ])
+    forecast[step] = z @ params
+    history.append(forecast[step])
+  return forecast
+
+class ForecastExecutor():
+  """
+    Fits the per-cluster VAR models of predict_future_snapshots in a pool of worker processes.
+
+    Results come back in the order the series were given. Fits that haven't come back timeout
+    seconds after a call started are abandoned, their worker processes are killed, and their
+    clusters fall back to their last snapshot. With a single worker, or a single fit and no
+    timeout, series are fit in this process and the timeout isn't enforced.
+  """
+
+  def __init__(self, workers: int = None, timeout: float = None):
+    """
+      Args:
+        workers (int): Worker processes, default: FORECAST_WORKERS or the number of CPUs.
+        timeout (float): Seconds to wait for the fits of a call, default: FORECAST_TIMEOUT or no limit.
+    """
+    self.workers = workers or int(os.getenv("FORECAST_WORKERS", "0")) or os.cpu_count() or 1
+    self.timeout = timeout or float(os.getenv("FORECAST_TIMEOUT", "0")) or None
+    self._pool = None
+    self._lock = threading.Lock()
+
+  def forecast(self, series: list[np.ndarray], max_lags: int, steps: int, models: list[ForecastModel] = None) -> list:
+    """
+      Forecasts each [days, len(SERIES_COLUMNS)] series.
+
+      A series' cached model (see forecast_cache.py) is reused without a fit if it was fit to
+      the same series, and refit incrementally if the series extends it.
+
+      Returns:
+        list: For each series, its fitted ForecastModel, or the exception its fit raised
+          (TimeoutError if it timed out).
+    """
+    models = models or [None] * len(series)
+    results = [None] * len(series)
+    to_fit = []
+    for i, (values, model) in enumerate(zip(series, models)):
+      if model is not None and model.max_lags == max_lags and model.fits(values):
+        if model.steps != steps:
+          model = replace(model, steps=steps, forecast=_forecast(model.params, model.lag_order, model.last_observations, steps))
+        results[i] = model
+      else:
+        to_fit.append(i)
+
+    if self.workers <= 1 or len(to_fit) == 0 or (len(to_fit) == 1 and self.timeout is None):
+      for i in to_fit:
+        try:
+          results[i] = _fit_forecast(series[i], max_lags, steps, models[i])
+        except Exception as e:
+          results[i] = e
+      return results
+
+    # Calls from several server threads take turns, so a timeout can't shut down the pool
+    # under another call's fits.
+    with self._lock:
+      if self._pool is None:
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+      futures = { i: self._pool.submit(_fit_forecast, series[i], max_lags, steps, models[i]) for i in to_fit }
+
+      # One deadline for every fit of the call.
+      _, not_done = wait(futures.values(), timeout=self.timeout)
+      for i, future in futures.items():
+        if future in not_done:
+          results[i] = TimeoutError(f"Forecast fit timed out after {self.timeout}s")
+          continue
+        try:
+          results[i] = future.result()
+        except Exception as e:
+          results[i] = e
+
+      if not_done:
+        # The stuck workers can't be reclaimed, so they are killed and later calls get a fresh pool.
+        _terminate(self._pool)
+        self._pool = None
+      return results
+
+  def shutdown(self):
+    if self._pool is not None:
+      self._pool.shutdown()
+      self._pool = None
+
+def _terminate(pool: ProcessPoolExecutor):
+  """Shuts down a pool without waiting for its running fits, and kills its worker processes."""
+  processes = list((pool._processes or {}).values())
+  pool.shutdown(wait=False, cancel_futures=True)
+  for process in processes:
+    process.terminate()
+  for process in processes:
+    process.join()
+
+@lru_cache(maxsize=None)
+def default_executor() -> ForecastExecutor:
+  """The service's forecast executor, configured by FORECAST_WORKERS and FORECAST_TIMEOUT."""
+  return ForecastExecutor()
+
+def predict_future_snapshots(snapshots: list[ClusterSnapshot], forecast_steps=1, max_lags=1, min_observations=5, executor: ForecastExecutor = None, cache: ForecastCache = None):
   """
     Predicts forecast_steps future snapshots based on historical data.
 
+    Each cluster's snapshots are resampled to a daily series starting at its first snapshot,
+    and a VAR model is fit to the series of every cluster with enough observations, in
+    parallel on the executor. The others repeat their last observation, which is taken for
+    all clusters at once without resampling. Fitted models are cached by cluster_id, so
+    clusters whose series haven't changed since the last run aren't fit again.
+
     Args:
         snapshots (list[ClusterSnapshot])
         forecast_steps (float): Number of future steps to predict, in days.
         max_lags (int): Maximum number of lags to consider in VAR model.
         min_observations (int): Minimum number of observations required to fit VAR model.
+        executor (ForecastExecutor): Executor to fit the VAR models on, default: default_executor().
+        cache (ForecastCache): Models fitted in earlier runs, default: default_forecast_cache().
 
     Returns:
         list[ClusterSnapshot]
@@ -40,72 +251,141 @@ def predict_future_snapshots(snapshots: list[ClusterSnapshot], forecast_steps=1,
       "common_symptoms": s.common_symptoms
     })
 
+  if not data:
+    return []
   df = pd.DataFrame(data)
 
-  # Group by cluster_id
+  # Only snapshots a whole number of days after their cluster's first one are observations of its daily series.
+  day = pd.Timedelta(days=1)
+  by_cluster = df.groupby("cluster_id", sort=False)["time"]
+  offset = df["time"] - by_cluster.transform("min")
+  df["on_grid"] = offset % day == pd.Timedelta(0)
+
+  # The daily series ends at its last day, where it takes the values of the last observation.
   clusters = df["cluster_id"].unique()
-  predicted_snapshots = []
+  series_end = by_cluster.min() + (by_cluster.max() - by_cluster.min()).dt.floor("D")
+  observations = df.groupby("cluster_id", sort=False)["on_grid"].sum()
+  last = df[df["on_grid"]].sort_values("time", kind="stable").drop_duplicates("cluster_id", keep="last").set_index("cluster_id")
+
+  # Fit VAR models, for the clusters with enough observations
+  var_clusters = [ cluster_id for cluster_id in clusters if observations[cluster_id] >= min_observations ]
+  grouped = df.groupby("cluster_id", sort=False)
+  series = [ _daily_series(grouped.get_group(cluster_id)) for cluster_id in var_clusters ]
+
+  # Reuse the models fitted in earlier runs. Temporary cluster ids aren't stable across runs.
+  cache = cache or default_forecast_cache()
+  models = cache.get_many([ cluster_id for cluster_id in var_clusters if not cluster_id.startswith("temp_") ], max_lags)
+  results = (executor or default_executor()).forecast(series, max_lags, forecast_steps, [ models.get(cluster_id) for cluster_id in var_clusters ])
+  forecasts = dict(zip(var_clusters, results))
+  cache.put_many({
+    cluster_id: model for cluster_id, model in forecasts.items()
+    if isinstance(model, ForecastModel) and not cluster_id.startswith("temp_") and model is not models.get(cluster_id)
+  })
 
-  # Fit VAR and predict for each cluster
+  predicted_snapshots = []
   utc = pytz.UTC
   for cluster_id in clusters:
-    cluster_df = df[df["cluster_id"] == cluster_id].set_index("time")
-
-    # Ensure daily continuity with interpolation
-    date_range = pd.date_range(start=cluster_df.index.min(), end=cluster_df.index.max(), freq='D')
-    cluster_df = cluster_df.reindex(date_range)
-    cluster_df[["report_count", "latitude", "longitude", "intensity"]] = cluster_df[["report_count", "latitude", "longitude", "intensity"]].interpolate(method='linear')
-    cluster_df["avg_embedding"] = cluster_df["avg_embedding"].ffill()  # Forward fill for embeddings
-    cluster_df["common_symptoms"] = cluster_df["common_symptoms"].ffill() # Forward fill for common_symptoms
-
-    # Store last snapshot for fallback
-    last_row = cluster_df.iloc[-1] if not cluster_df.empty else None
-    last_embedding = cluster_df["avg_embedding"].iloc[-1] if not cluster_df.empty else [0] * 768
-    last_common_symptoms = cluster_df["common_symptoms"].iloc[-1] if not cluster_df.empty else {}
-
-    # Fit VAR model, if enough observations
-    if len(cluster_df.dropna()) >= min_observations:
-      try:
-        model = VAR(cluster_df[["report_count", "latitude", "longitude", "intensity"]])
-        results = model.fit(maxlags=max_lags, ic='aic')
-
-        # Forecast n days
-        forecast = results.forecast(cluster_df[["report_count", "latitude", "longitude", "intensity"]].values, steps=forecast_steps)
-        forecast_index = pd.date_range(start=cluster_df.index[-1] + timedelta(days=1), periods=forecast_steps, freq='D')
-        forecast_df = pd.DataFrame(forecast, index=forecast_index, columns=["report_count", "latitude", "longitude", "intensity"])
-
-        # Convert to PredictedSnapshot
-        for idx, row in forecast_df.iterrows():
-          time_start = idx.replace(tzinfo=utc)
-          time_end = (idx + timedelta(days=1)).replace(tzinfo=utc)
-          predicted_snapshots.append(PredictedSnapshot(
-            cluster_id=cluster_id,
-            centroid=[row["latitude"], row["longitude"]],
-            common_symptoms={"overall": {"intensity": max(0, row["intensity"]), "count": int(max(0, row["report_count"]))}},
-            report_count=int(max(0, row["report_count"])),
-            intensity=max(0, row["intensity"]),
-            avg_embedding=last_embedding,
-            time_window_start=time_start.isoformat(),
-            time_window_end=time_end.isoformat()
-          ))
-      except Exception as e:
-        print(f"Error fitting VAR for cluster {cluster_id}: {e}.")
+    last_row = last.loc[cluster_id]
+    last_embedding = last_row["avg_embedding"]
+    forecast = forecasts.get(cluster_id)
+
+    if isinstance(forecast, ForecastModel):
+      # Convert to PredictedSnapshot
+      for i, row in enumerate(forecast.forecast, start=1):
+        report_count, latitude, longitude, intensity = row
+        time_start = (series_end[cluster_id] + timedelta(days=i)).replace(tzinfo=utc)
+        time_end = (time_start + timedelta(days=1)).replace(tzinfo=utc)
+        predicted_snapshots.append(PredictedSnapshot(
+          cluster_id=cluster_id,
+          centroid=[latitude, longitude],
+          common_symptoms={"overall": {"intensity": max(0, intensity), "count": int(max(0, report_count))}},
+          report_count=int(max(0, report_count)),
+          intensity=max(0, intensity),
+          avg_embedding=last_embedding,
+          time_window_start=time_start.isoformat(),
+          time_window_end=time_end.isoformat()
+        ))
+      continue
+
+    if isinstance(forecast, TimeoutError):
+      print(f"Timed out fitting VAR for cluster {cluster_id}, using its last snapshot.")
+    elif forecast is not None:
+      print(f"Error fitting VAR for cluster {cluster_id}: {forecast}.")
+      continue
     else:
-        print(f"Skipping VAR for cluster {cluster_id}: too few observations ({len(cluster_df.dropna())})")
-        # Fallback: Use last snapshot values
-        if last_row is not None:
-          for i in range(1, forecast_steps + 1):
-            time_start = (cluster_df.index[-1] + timedelta(days=i)).replace(tzinfo=utc)
-            time_end = (time_start + timedelta(days=1)).replace(tzinfo=utc)
-            predicted_snapshots.append(PredictedSnapshot(
-              cluster_id=cluster_id,
-              centroid=[last_row["latitude"], last_row["longitude"]],
-              common_symptoms=last_common_symptoms,
-              avg_embedding=last_embedding,
-              report_count=last_row["report_count"],
-              intensity=last_row["intensity"],
-              time_window_start=time_start.isoformat(),
-              time_window_end=time_end.isoformat()
-            ))
-
-  return predicted_snapshots
\ No newline at end of file
+      print(f"Skipping VAR for cluster {cluster_id}: too few observations ({observations[cluster_id]})")
+
+    # Fallback: Use last snapshot values
+    for i in range(1, forecast_steps + 1):
+      time_start = (series_end[cluster_id] + timedelta(days=i)).replace(tzinfo=utc)
+      time_end = (time_start + timedelta(days=1)).replace(tzinfo=utc)
+      predicted_snapshots.append(PredictedSnapshot(
+        cluster_id=cluster_id,
+        centroid=[last_row["latitude"], last_row["longitude"]],
+        common_symptoms=last_row["common_symptoms"],
+        avg_embedding=last_embedding,
+        report_count=last_row["report_count"],
+        intensity=last_row["intensity"],
+        time_window_start=time_start.isoformat(),
+        time_window_end=time_end.isoformat()
+      ))
+
+  return predicted_snapshots
+
+def predict_evolution(cluster_id: str, start_time: datetime = None, end_time: datetime = None, forecast_steps: int = 1, run_id: int = None) -> list[PredictedSnapshot]:
+  """
+    Predicts the evolution of a single cluster from its snapshots in a time window.
+
+    The window ends at end_time (default: now) and reaches back at most MAX_HISTORY_DAYS. It is
+    widened to whole hours, the granularity of snapshot windows, so that requests for nearby
+    windows share a result: forecasts are memoized per (cluster_id, window, steps, run_id), and
+    a new clustering run has a new run_id.
+
+    Args:
+        cluster_id (str)
+        start_time (datetime): Timezone-aware start of the history window.
+        end_time (datetime): Timezone-aware end of the history window.
+        forecast_steps (int): Number of future steps to predict, in days, up to MAX_FORECAST_STEPS.
+        run_id (int): Clustering run to read the snapshots of, the latest completed one if None.
+
+    Returns:
+        list[PredictedSnapshot]
+  """
+  import models.outbreakml.db as db
+
+  if run_id is None:
+    run = db.fetch_latest_clustering_run()
+    if run is None:
+      return []
+    run_id = run["run_id"]
+
+  end_time = _ceil_hour(end_time or datetime.now(pytz.UTC))
+  earliest = end_time - timedelta(days=MAX_HISTORY_DAYS)
+  start_time = max(_floor_hour(start_time), earliest) if start_time else earliest
+  steps = min(max(int(forecast_steps), 1), MAX_FORECAST_STEPS)
+
+  return list(_memoized_evolution(str(cluster_id), start_time.isoformat(), end_time.isoformat(), steps, int(run_id)))
+
+# Windowed histories rarely extend each other, so they get their own models instead of
+# replacing the full-history ones in the default forecast cache.
+_evolution_models = ForecastCache()
+
+@lru_cache(maxsize=256)
+def _memoized_evolution(cluster_id: str, start_time: str, end_time: str, steps: int, run_id: int) -> tuple:
+  import models.outbreakml.db as db
+
+  snapshots = db.fetch_cluster_snapshots(cluster_id, start_time, end_time, run_id)
+  return tuple(predict_future_snapshots(snapshots, forecast_steps=steps, cache=_evolution_models))
+
+def _floor_hour(time: datetime) -> datetime:
+  return time.replace(minute=0, second=0, microsecond=0)
+
+def _ceil_hour(time: datetime) -> datetime:
+  floor = _floor_hour(time)
+  return floor if floor == time else floor + timedelta(hours=1)
+
+def _daily_series(cluster_df: pd.DataFrame) -> np.ndarray:
+  """Resamples a cluster's snapshots to one row a day, interpolating the days without one."""
+  cluster_df = cluster_df.set_index("time")[SERIES_COLUMNS]
+  date_range = pd.date_range(start=cluster_df.index.min(), end=cluster_df.index.max(), freq='D')
+  return cluster_df.reindex(date_range).interpolate(method='linear').to_numpy(dtype=np.float64)
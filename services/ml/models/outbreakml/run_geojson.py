@@ -0,0 +1,211 @@
+"""
+GeoJSON of Clustering Runs
+
+FetchLatestData serves the latest clustering run as a GeoJSON FeatureCollection, with a
+spline boundary around each cluster. Building it fits a hull and a spline per cluster, and
+it only changes when a new run completes, so it is built once per run: when the pipeline
+saves the run, or on the first request for a run saved elsewhere.
+
+The serialized GeoJSON is stored in the database and kept in memory by run_id, with an ETag
+derived from its content, so clients that already have it can be answered with not_modified.
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+# Seconds the latest run_id is trusted before the database is asked again.
+LATEST_RUN_TTL = 5.0
+
+
+@dataclass
+class RunGeoJSON():
+  run_id: int
+  geojson: str              # Serialized FeatureCollection
+  etag: str                 # Hash of geojson
+  time_window_start: str    # ISO start of the run's first time window
+  time_window_end: str      # ISO end of the run's first time window
+
+
+def timedelta_snapshots_to_geojson(timedelta_snapshots) -> dict:
+  """Converts TimedeltaSnapshots to a GeoJSON FeatureCollection with spline boundaries."""
+  from models.outbreakml.splines import compute_hull_spline
+
+  features = []
+
+  for timedelta_snapshot in timedelta_snapshots:
+    for cluster_snapshot in timedelta_snapshot.snapshots:
+      # Create spline boundary for the cluster
+      try:
+        geometry = {
+          "type": "Polygon",
+          "coordinates": compute_hull_spline(cluster_snapshot)
+        }
+      except Exception as e:
+        # Fallback to point if spline computation fails
+        print(f"Warning: Could not compute spline for cluster {cluster_snapshot.cluster_id}: {e}")
+        geometry = {
+          "type": "Point",
+          "coordinates": [cluster_snapshot.centroid[1], cluster_snapshot.centroid[0]]
+        }
+
+      # Create GeoJSON feature for each cluster
+      features.append({
+        "type": "Feature",
+        "properties": {
+          "cluster_id": cluster_snapshot.cluster_id,
+          "time_window_start": timedelta_snapshot.time_window_start,
+          "time_window_end": timedelta_snapshot.time_window_end,
+          "timedelta": timedelta_snapshot.timedelta,
+          "report_count": len(cluster_snapshot.report_ids),
+          "common_symptoms": cluster_snapshot.common_symptoms,
+          "centroid": cluster_snapshot.centroid,
+        },
+        "geometry": geometry
+      })
+
+  return {
+    "type": "FeatureCollection",
+    "features": features,
+    "metadata": {
+      "total_clusters": len(features),
+      "generated_at": datetime.now(timezone.utc).isoformat()
+    }
+  }
+
+
+def build_run_geojson(run_id: int, timedelta_snapshots) -> RunGeoJSON:
+  # Snapshots computed in memory can hold NumPy values.
+  geojson = json.dumps(timedelta_snapshots_to_geojson(timedelta_snapshots), default=lambda value: value.tolist())
+  # Snapshots are assumed to be ordered by time, as they are stored.
+  first = timedelta_snapshots[0] if timedelta_snapshots else None
+
+  return RunGeoJSON(
+    run_id = int(run_id),
+    geojson = geojson,
+    etag = hashlib.sha256(geojson.encode()).hexdigest(),
+    time_window_start = first.time_window_start if first else None,
+    time_window_end = first.time_window_end if first else None
+  )
+
+
+class GeoJSONCache():
+  """
+    Serialized GeoJSON of the most recent runs, by run_id, and the latest run_id.
+
+    Safe to share between threads.
+  """
+
+  def __init__(self, capacity: int = 4):
+    self.capacity = capacity
+    self._runs: OrderedDict[int, RunGeoJSON] = OrderedDict()
+    self._latest_run_id = None
+    self._latest_checked_at = 0.0
+    self._lock = threading.Lock()
+
+  def get(self, run_id: int) -> Optional[RunGeoJSON]:
+    with self._lock:
+      entry = self._runs.get(run_id)
+      if entry is not None:
+        self._runs.move_to_end(run_id)
+      return entry
+
+  def put(self, entry: RunGeoJSON):
+    with self._lock:
+      self._runs[entry.run_id] = entry
+      self._runs.move_to_end(entry.run_id)
+      while len(self._runs) > self.capacity:
+        self._runs.popitem(last=False)
+
+  def latest_run_id(self, ttl: float = LATEST_RUN_TTL) -> Optional[int]:
+    """The latest run_id, if it was set less than ttl seconds ago."""
+    with self._lock:
+      if self._latest_run_id is not None and time.monotonic() - self._latest_checked_at < ttl:
+        return self._latest_run_id
+      return None
+
+  def set_latest_run_id(self, run_id: int):
+    with self._lock:
+      self._latest_run_id = run_id
+      self._latest_checked_at = time.monotonic()
+
+
+_cache = GeoJSONCache()
+
+
+def publish_run(run_id: int, timedelta_snapshots=None) -> RunGeoJSON:
+  """
+    Builds the GeoJSON of a saved run, stores it with the run and caches it.
+
+    Args:
+      run_id (int): The saved run.
+      timedelta_snapshots (list): All the run's snapshots, with their reports. Fetched from
+        the database if None, e.g. for delta runs, whose carried forward snapshots aren't in memory.
+  """
+  import models.outbreakml.db as db
+
+  if timedelta_snapshots is None:
+    timedelta_snapshots = db.fetch_run_timedelta_snapshots(run_id)
+
+  entry = build_run_geojson(run_id, timedelta_snapshots)
+  db.save_run_geojson(entry.run_id, entry.geojson, entry.etag, entry.time_window_start, entry.time_window_end)
+  _cache.put(entry)
+  _cache.set_latest_run_id(entry.run_id)
+  return entry
+
+
+def latest_run_geojson() -> Optional[RunGeoJSON]:
+  """The GeoJSON of the latest completed run, built on first use if it wasn't published."""
+  import models.outbreakml.db as db
+
+  run_id = _cache.latest_run_id()
+  if run_id is None:
+    run = db.fetch_latest_clustering_run()
+    if run is None:
+      return None
+    run_id = run["run_id"]
+    _cache.set_latest_run_id(run_id)
+
+  entry = _cache.get(run_id)
+  if entry is None:
+    row = db.fetch_run_geojson(run_id)
+    if row is not None:
+      entry = RunGeoJSON(**row)
+      _cache.put(entry)
+    else:
+      entry = publish_run(run_id)
+  return entry
+
+
+async def alatest_run_geojson(executor=None) -> Optional[RunGeoJSON]:
+  """
+    Async version of latest_run_geojson, for the servicer's event loop.
+
+    Lookups go through the async client. Building a GeoJSON that wasn't published runs in
+    executor (the loop's default if None).
+  """
+  import models.outbreakml.db as db
+
+  run_id = _cache.latest_run_id()
+  if run_id is None:
+    run = await db.afetch_latest_clustering_run()
+    if run is None:
+      return None
+    run_id = run["run_id"]
+    _cache.set_latest_run_id(run_id)
+
+  entry = _cache.get(run_id)
+  if entry is None:
+    row = await db.afetch_run_geojson(run_id)
+    if row is not None:
+      entry = RunGeoJSON(**row)
+      _cache.put(entry)
+    else:
+      entry = await asyncio.get_running_loop().run_in_executor(executor, publish_run, run_id)
+  return entry
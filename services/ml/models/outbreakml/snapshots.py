@@ -1,20 +1,31 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 import math
 from matplotlib.patches import Polygon as MplPolygon
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import random
 from scipy.interpolate import splprep, splev
 from scipy.ndimage import gaussian_filter
+from scipy.sparse import csr_matrix
 from shapely.geometry import Point
 from shapely.ops import unary_union
 
-from common.db import supabase
+from geo import haversine
 
-from models.outbreakml.embeddings import decode_embedding
-from models.outbreakml.structures import Report, ClusterSnapshot, TimedeltaSnapshot
+import models.outbreakml.db as db
+from models.outbreakml.embeddings import decode_embeddings
+from models.outbreakml.helpers import geographic_centroids
+from models.outbreakml.structures import Report, ReportBatch, ClusterSnapshot, TimedeltaSnapshot
 
-def compute_snapshots_from_clusters(labels: list[int], reports: list[Report], cluster_id_mapping: dict = None, time_delta: int = 1) -> list[TimedeltaSnapshot]:
+def compute_snapshots_from_clusters(
+    labels: list[int],
+    reports: list[Report],
+    cluster_id_mapping: dict = None,
+    time_delta: int = 1,
+    centroid_source: str = "local"
+) -> list[TimedeltaSnapshot]:
   """
     Computes snapshots given the reports and their cluster labels.
     Since clusters have reports that may span multiple time windows,
@@ -23,45 +34,34 @@ def compute_snapshots_from_clusters(labels: list[int], reports: list[Report], cl
 
     Args:
       labels (list): List of cluster labels for each report.
-      reports (list): List of report dicts with id, lat, lon, symptoms, embedding, utm_x, utm_y.
+      reports (list | ReportBatch): List of report dicts with id, lat, lon, symptoms, embedding, utm_x, utm_y,
+        or a ReportBatch with the same columns.
       cluster_id_mapping (dict): Mapping of cluster labels to persistent cluster IDs.
       time_delta (int): Time window in days to group reports into snapshots.
+      centroid_source (str): "local" to compute the centroids here, "server" to have PostGIS
+        compute all of them in a single call.
   """
 
-  # Group reports by (cluster_label, date)
-  clusters_by_time = {}
-  for report, label in zip(reports, labels):
-    if label == -1:
-      continue  # Ignore noise points
-    report_time = datetime.fromisoformat(report["timestamp"])
-    time_window_start = report_time.replace(minute=0, second=0, microsecond=0)
-    time_window_end = time_window_start + timedelta(days=time_delta)
-    key = (label, time_window_start.isoformat(), time_window_end.isoformat())
-    if key not in clusters_by_time:
-      clusters_by_time[key] = []
-    clusters_by_time[key].append(report)
+  # Group reports by (cluster_label, date) and aggregate each group
+  groups = aggregate_snapshot_groups(labels, reports, time_delta)
+  centroids = _group_centroids(reports, groups.members, groups.group_index, len(groups), centroid_source)
   
   snapshots = []
-  for (label, start_iso, end_iso), cluster_reports in clusters_by_time.items():
-    centroid = supabase.rpc("get_centroid", {"report_ids": [r["id"] for r in cluster_reports]}).execute().data[0]
-    embeddings = np.array([ decode_embedding(r["embedding"]) for r in cluster_reports ])
-    avg_embedding = np.mean(embeddings, axis=0).tolist()
-  
-    # Aggregate common symptoms
-    symptom_sets = [set(r["symptoms"]) for r in cluster_reports]
-    common_symptoms = list(symptom_sets[0].intersection(*symptom_sets[1:]))
+  for g in range(len(groups)):
+    label = groups.labels[g]
+    cluster_reports = [ reports[i] for i in groups.indices(g) ]
   
     # Use persistent cluster ID if available, otherwise fall back to temp label
     persistent_cluster_id = cluster_id_mapping.get(label, f"temp_{label}") if cluster_id_mapping else f"temp_{label}"
     
     snapshots.append(ClusterSnapshot(
       cluster_id = persistent_cluster_id,
-      centroid = [centroid["y"], centroid["x"]],
-      common_symptoms = common_symptoms,
+      centroid = centroids[g].tolist(),
+      common_symptoms = groups.common_symptoms[g],
       report_ids = [r["id"] for r in cluster_reports],
-      avg_embedding = avg_embedding,
-      time_window_start = start_iso,
-      time_window_end = end_iso,
+      avg_embedding = groups.avg_embeddings[g].tolist(),
+      time_window_start = groups.window_starts[g],
+      time_window_end = groups.window_ends[g],
       reports = cluster_reports
     ))
     
@@ -84,35 +84,203 @@ def compute_snapshots_from_clusters(labels: list[int], reports: list[Report], cl
   
   return timedelta_snapshots
 
-def compute_snapshots(reports, labels):
-  clusters = {}
-  for i, (report, label) in enumerate(zip(reports, labels)):
-      if label != -1:
-          if label not in clusters:
-              clusters[label] = {"ids": [], "lat": [], "lon": [], "symptoms": []}
-          clusters[label]["ids"].append(report["id"])
-          clusters[label]["lat"].append(report["lat"])
-          clusters[label]["lon"].append(report["lon"])
-          clusters[label]["symptoms"].append(report["symptoms"])
+def compute_group_centroids(reports, index_groups: list[list[int]], source: str = "local") -> np.ndarray:
+  """
+    Computes the centroid of every group of reports in one pass.
 
-  snapshots = []
-  for label, data in clusters.items():
-      centroid = supabase.rpc("get_centroid", {"report_ids": data["ids"]}).execute().data[0]
+    Args:
+      reports (list | ReportBatch): Reports with id, lat and lon.
+      index_groups (list[list[int]]): Indices into reports of each group.
+      source (str): "local" for the spherical mean of helpers.geographic_centroid,
+        "server" to have PostGIS compute every centroid in a single call.
+
+    Returns:
+      np.ndarray: [n_groups, 2] centroids as (lat, lon).
+  """
+
+  flat = np.concatenate([ np.asarray(indices, dtype=np.int64) for indices in index_groups ]) if index_groups else np.empty(0, dtype=np.int64)
+  group_index = np.repeat(np.arange(len(index_groups)), [ len(indices) for indices in index_groups ])
+  return _group_centroids(reports, flat, group_index, len(index_groups), source)
+
+def _group_centroids(reports, members: np.ndarray, group_index: np.ndarray, n_groups: int, source: str = "local") -> np.ndarray:
+  """Centroids of the groups of reports given by their indices and the group of each."""
+
+  if n_groups == 0:
+    return np.empty((0, 2))
+
+  if source == "server":
+    report_id_groups = [ [] for _ in range(n_groups) ]
+    for i, g in zip(members, group_index):
+      report_id_groups[g].append(reports[int(i)]["id"])
+    return db.fetch_group_centroids(report_id_groups)
+
+  lat, lon = _column(reports, "lat", members), _column(reports, "lon", members)
+  return geographic_centroids(lat, lon, group_index, n_groups)
+
+def compare_centroids_with_server(reports, index_groups: list[list[int]], tolerance_meters: float = 10.0) -> float:
+  """
+    Checks that the local centroids of the groups match the ones computed by PostGIS.
+
+    Returns:
+      float: The largest distance between a local and a server centroid, in meters.
+  """
+
+  local = compute_group_centroids(reports, index_groups, "local")
+  server = compute_group_centroids(reports, index_groups, "server")
+  distances = haversine(local[:, 0], local[:, 1], server[:, 0], server[:, 1])
+
+  max_distance = float(distances.max()) if len(distances) > 0 else 0.0
+  status = "within" if max_distance <= tolerance_meters else "OUTSIDE"
+  print(f"Centroids of {len(index_groups)} groups: max deviation {max_distance:.3f}m, {status} {tolerance_meters}m tolerance")
+  return max_distance
+
+@dataclass
+class SnapshotGroups():
+  """
+    Reports grouped by cluster label and time window, with per-group aggregates.
 
-      embeddings = np.array([ decode_embedding(r["embedding"]) for r in reports if r["id"] in data["ids"] ])
+    Groups are in order of first appearance in the reports, and the reports of each group
+    keep their input order.
+  """
+  labels: list            # Cluster label of each group
+  window_starts: list     # ISO time window start of each group, None without time windows
+  window_ends: list       # ISO time window end of each group, None without time windows
+  members: np.ndarray     # Report indices, sorted by group
+  group_index: np.ndarray # Group of each entry of members
+  starts: np.ndarray      # Offset of each group in members
+  avg_embeddings: np.ndarray  # [n_groups, 768] mean embedding of each group
+  common_symptoms: list   # Symptoms shared by every report of each group
+
+  def __len__(self):
+    return len(self.labels)
+
+  def indices(self, g: int) -> np.ndarray:
+    end = self.starts[g + 1] if g + 1 < len(self.starts) else len(self.members)
+    return self.members[self.starts[g]:end]
+
+def aggregate_snapshot_groups(labels, reports, time_delta: int = None) -> SnapshotGroups:
+  """
+    Groups reports by (cluster_label, time window), ignoring noise, and aggregates each group.
+
+    Time windows start at the hour of the report and last time_delta days. Without a
+    time_delta, reports are grouped by cluster label only.
+
+    Groups are formed by sorting the reports once by group, so embedding means are one sparse
+    matrix product over the embeddings, and common symptoms come from per-group counts of a
+    sparse report-by-symptom indicator matrix. Everything scales linearly with the reports.
+  """
+
+  labels = np.asarray(labels)
+  members = np.flatnonzero(labels != -1)
+  if members.size == 0:
+    empty = np.empty(0, dtype=np.int64)
+    return SnapshotGroups([], [], [], empty, empty, empty, np.empty((0, 768)), [])
+
+  # Group key of each report: its label, and its window start hour if windowed.
+  _, label_code = np.unique(labels[members], return_inverse=True)
+  key = label_code.astype(np.int64)
+  if time_delta is not None:
+    hours = _report_hours(reports, members)
+    unique_hours, hour_code = np.unique(hours, return_inverse=True)
+    key = key * len(unique_hours) + hour_code
+
+  # Number groups by first appearance and sort reports by group, keeping their order within it.
+  _, first, key_group = np.unique(key, return_index=True, return_inverse=True)
+  rank = np.empty(len(first), dtype=np.int64)
+  rank[np.argsort(first)] = np.arange(len(first))
+  order = np.argsort(rank[key_group], kind="stable")
+  members = members[order]
+  group_index = rank[key_group][order]
 
-      avg_embedding = np.mean(embeddings, axis=0).tolist()
+  n_groups = len(first)
+  sizes = np.bincount(group_index, minlength=n_groups)
+  starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+  group_first = members[starts]
 
-      # Aggregate common symptoms
-      symptom_sets = [set(r["symptoms"]) for r in reports if r["id"] in data["ids"]]
-      common_symptoms = list(symptom_sets[0].intersection(*symptom_sets[1:]))
+  group_labels = labels[group_first].tolist()
+  window_starts = window_ends = [None] * n_groups
+  if time_delta is not None:
+    windows = [
+      (start.isoformat(), (start + timedelta(days=time_delta)).isoformat())
+      for start in (pd.Timestamp(h).tz_localize("UTC").to_pydatetime() for h in unique_hours)
+    ]
+    group_hours = hour_code[order][starts]
+    window_starts = [ windows[h][0] for h in group_hours ]
+    window_ends = [ windows[h][1] for h in group_hours ]
 
+  # Embedding means as one product with a sparse group-by-report averaging matrix.
+  averaging = csr_matrix(
+    (1.0 / sizes[group_index], group_index, np.arange(len(members) + 1)),
+    shape=(len(members), n_groups)
+  ).T
+  avg_embeddings = np.asarray(averaging @ _embeddings(reports, members))
+
+  # A symptom is common to a group when every report of the group has it.
+  vocabulary = {}
+  rows, cols = [], []
+  for g, report_symptoms in zip(group_index, _symptoms(reports, members)):
+    for symptom in set(report_symptoms):
+      rows.append(g)
+      cols.append(vocabulary.setdefault(symptom, len(vocabulary)))
+  counts = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_groups, len(vocabulary)))
+  counts.sum_duplicates()
+
+  count_group = np.repeat(np.arange(n_groups), np.diff(counts.indptr))
+  is_common = counts.data == sizes[count_group]
+  symptoms = np.array(list(vocabulary), dtype=object)
+  common_symptoms = [
+    common.tolist()
+    for common in np.split(symptoms[counts.indices[is_common]], np.cumsum(np.bincount(count_group[is_common], minlength=n_groups))[:-1])
+  ]
+
+  return SnapshotGroups(
+    labels = group_labels,
+    window_starts = window_starts,
+    window_ends = window_ends,
+    members = members,
+    group_index = group_index,
+    starts = starts,
+    avg_embeddings = avg_embeddings,
+    common_symptoms = common_symptoms
+  )
+
+def _report_hours(reports, indices: np.ndarray) -> np.ndarray:
+  """UTC timestamps of the reports, floored to the hour."""
+  if isinstance(reports, ReportBatch):
+    return reports.timestamps[indices].astype("datetime64[h]")
+  times = pd.to_datetime([ reports[int(i)]["timestamp"] for i in indices ], utc=True, format="ISO8601")
+  return times.tz_localize(None).to_numpy().astype("datetime64[h]")
+
+def _embeddings(reports, indices: np.ndarray) -> np.ndarray:
+  if isinstance(reports, ReportBatch):
+    return reports.embeddings[indices]
+  embeddings, _ = decode_embeddings([ reports[int(i)]["embedding"] for i in indices ])
+  return embeddings
+
+def _symptoms(reports, indices: np.ndarray) -> list:
+  if isinstance(reports, ReportBatch):
+    return [ reports.symptoms[i] for i in indices ]
+  return [ reports[int(i)]["symptoms"] for i in indices ]
+
+def _column(reports, name: str, indices: np.ndarray) -> np.ndarray:
+  if isinstance(reports, ReportBatch):
+    return getattr(reports, name)[indices]
+  return np.array([ reports[int(i)][name] for i in indices ], dtype=float)
+
+def compute_snapshots(reports, labels):
+  groups = aggregate_snapshot_groups(labels, reports)
+  centroids = _group_centroids(reports, groups.members, groups.group_index, len(groups))
+
+  snapshots = []
+  for g in range(len(groups)):
       snapshots.append(ClusterSnapshot(
-          cluster_id = f"temp_{label}",
-          centroid = [centroid["y"], centroid["x"]],
-          common_symptoms = common_symptoms,
-          report_ids = data["ids"],
-          avg_embedding = avg_embedding
+          cluster_id = f"temp_{groups.labels[g]}",
+          time_window_start = groups.window_starts[g],
+          time_window_end = groups.window_ends[g],
+          centroid = centroids[g].tolist(),
+          common_symptoms = groups.common_symptoms[g],
+          report_ids = [ reports[int(i)]["id"] for i in groups.indices(g) ],
+          avg_embedding = groups.avg_embeddings[g].tolist()
       ))
 
   return snapshots
\ No newline at end of file
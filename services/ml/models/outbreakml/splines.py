@@ -1,46 +1,24 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import random
-from shapely.geometry import Point
-from shapely.ops import unary_union
 from matplotlib.patches import Polygon as MplPolygon
-from scipy.interpolate import splprep, splev
 from scipy.ndimage import gaussian_filter
 import math
 
-def compute_hull_spline(snapshot) -> list[float]:
-  points = [(r["lat"], r["lon"]) for r in snapshot.reports]
-
-  radius_deg = 0.005
-  circles = [Point(lon, lat).buffer(radius_deg) for lat, lon in points]
-  unioned = unary_union(circles)
-  hull = unioned.convex_hull
+from geo import smooth_hull
 
-  x_hull, y_hull = hull.exterior.xy
-  coords = np.array([x_hull, y_hull])
-  tck, u = splprep(coords, s=0.001, per=True)
-  spline_points = splev(np.linspace(0, 1, 200), tck)
+def compute_hull_spline(snapshot) -> list[float]:
+  points = [(r["lon"], r["lat"]) for r in snapshot.reports]
 
-  # Convert (x, y) arrays into list of [x, y] pairs
-  return [[float(x), float(y)] for x, y in zip(*spline_points)]
+  # Convert the [n, 2] region into list of [x, y] pairs
+  return smooth_hull(points).tolist()
 
 def compute_hull_splines(snapshots):
   splines = []
 
   for snapshot in snapshots:
-    points = [(r["lat"], r["lon"]) for r in snapshot.reports]
-
-    radius_deg = 0.005
-    circles = [Point(lon, lat).buffer(radius_deg) for lat, lon in points]
-    unioned = unary_union(circles)
-    hull = unioned.convex_hull
-
-    x_hull, y_hull = hull.exterior.xy
-    coords = np.array([x_hull, y_hull])
-    tck, u = splprep(coords, s=0.001, per=True)
-    spline_points = splev(np.linspace(0, 1, 200), tck)
-
-    splines.append(spline_points)
+    points = [(r["lon"], r["lat"]) for r in snapshot.reports]
+    splines.append(list(smooth_hull(points).T))
 
   return splines
 
@@ -1,4 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import numpy as np
+import pandas as pd
 
 class Report():
   def __init__(self, report, summary, embedding, cluster_id: str | None):
@@ -93,4 +95,91 @@ class TimedeltaSnapshot():
       f"snapshots=[\n\t"
       f"\t{',\n\t'.join([ repr(s).replace('\n', '\n\t') for s in self.snapshots ])}\n\t"
       f"])"
-    )
\ No newline at end of file
+    )
+
+@dataclass
+class ReportBatch():
+  """
+    A block of reports stored column by column.
+
+    Indexing or iterating a batch yields report dicts in the same format as fetch_all_reports,
+    so code written against lists of reports keeps working, while hot paths use the columns.
+  """
+  ids: np.ndarray         # int64, [n]
+  lat: np.ndarray         # float64, [n]
+  lon: np.ndarray         # float64, [n]
+  utm_x: np.ndarray       # float64, [n]
+  utm_y: np.ndarray       # float64, [n]
+  timestamps: np.ndarray  # datetime64[ns] in UTC, [n]
+  embeddings: np.ndarray  # float32, [n, 768]
+  symptoms: list = field(default_factory=list)
+  summaries: list = field(default_factory=list)
+
+  @classmethod
+  def from_rows(cls, rows: list[dict], embeddings: np.ndarray = None) -> "ReportBatch":
+    """
+      Builds a batch from report rows, skipping rows whose embedding can't be decoded.
+
+      The embedding is read from the binary "embedding_bin" column when the rows have it,
+      and from the pgvector "embedding" column otherwise, unless the [n, 768] embeddings
+      of the rows are given, e.g. from an EmbeddingStore.
+    """
+    if embeddings is None:
+      from models.outbreakml.embeddings import decode_embeddings
+
+      column = "embedding_bin" if rows and "embedding_bin" in rows[0] else "embedding"
+      embeddings, valid = decode_embeddings([ r[column] for r in rows ])
+      rows = [ r for r, v in zip(rows, valid) if v ]
+      embeddings = embeddings[valid]
+
+    return cls(
+      ids = np.array([ r["id"] for r in rows ], dtype=np.int64),
+      lat = np.array([ r["lat"] for r in rows ], dtype=np.float64),
+      lon = np.array([ r["lon"] for r in rows ], dtype=np.float64),
+      utm_x = np.array([ r["utm_x"] for r in rows ], dtype=np.float64),
+      utm_y = np.array([ r["utm_y"] for r in rows ], dtype=np.float64),
+      timestamps = pd.to_datetime([ r["timestamp"] for r in rows ], utc=True, format="ISO8601").tz_localize(None).to_numpy(),
+      embeddings = embeddings,
+      symptoms = [ r["symptoms"] for r in rows ],
+      summaries = [ r.get("summary") for r in rows ]
+    )
+
+  @classmethod
+  def concat(cls, batches: list["ReportBatch"], embeddings: np.ndarray = None) -> "ReportBatch":
+    """Concatenates batches into a single one, optionally with already concatenated embeddings."""
+    if embeddings is None:
+      embeddings = np.concatenate([ b.embeddings for b in batches ]) if batches else np.empty((0, 768), dtype=np.float32)
+
+    return cls(
+      ids = np.concatenate([ b.ids for b in batches ]) if batches else np.empty(0, dtype=np.int64),
+      lat = np.concatenate([ b.lat for b in batches ]) if batches else np.empty(0),
+      lon = np.concatenate([ b.lon for b in batches ]) if batches else np.empty(0),
+      utm_x = np.concatenate([ b.utm_x for b in batches ]) if batches else np.empty(0),
+      utm_y = np.concatenate([ b.utm_y for b in batches ]) if batches else np.empty(0),
+      timestamps = np.concatenate([ b.timestamps for b in batches ]) if batches else np.empty(0, dtype="datetime64[ns]"),
+      embeddings = embeddings,
+      symptoms = [ s for b in batches for s in b.symptoms ],
+      summaries = [ s for b in batches for s in b.summaries ]
+    )
+
+  def timestamp_iso(self, i: int) -> str:
+    return pd.Timestamp(self.timestamps[i]).tz_localize("UTC").isoformat()
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, i: int) -> dict:
+    return {
+      "id": int(self.ids[i]),
+      "timestamp": self.timestamp_iso(i),
+      "lat": float(self.lat[i]),
+      "lon": float(self.lon[i]),
+      "utm_x": float(self.utm_x[i]),
+      "utm_y": float(self.utm_y[i]),
+      "symptoms": self.symptoms[i],
+      "summary": self.summaries[i],
+      "embedding": self.embeddings[i]
+    }
+
+  def __iter__(self):
+    return (self[i] for i in range(len(self)))
@@ -9,85 +9,33 @@ import plotly.io as pio
 from scipy.interpolate import splprep, splev
 from scipy.ndimage import gaussian_filter
 from scipy.spatial import ConvexHull
-from shapely.geometry import Point, Polygon, LineString, MultiPolygon
-from shapely.ops import unary_union
 from sklearn.manifold import TSNE
 
+from geo import haversine, smooth_hull
+
+from models.outbreakml.embeddings import decode_embeddings
 from models.outbreakml.structures import Cluster, TimedeltaSnapshot, ClusterSnapshot, PredictedSnapshot
 
 def compute_hull_spline(snapshot):
-  points = [(r["lat"], r["lon"]) for r in snapshot.reports]
-
-  radius_deg = 0.005
-  circles = [Point(lon, lat).buffer(radius_deg) for lat, lon in points]
-  unioned = unary_union(circles)
-  hull = unioned.convex_hull
-
-  x_hull, y_hull = hull.exterior.xy
-  coords = np.array([x_hull, y_hull])
-  tck, u = splprep(coords, s=0.001, per=True)
-  spline_points = splev(np.linspace(0, 1, 200), tck)
-
-  return spline_points
+  points = [(r["lon"], r["lat"]) for r in snapshot.reports]
+  return list(smooth_hull(points).T)
 
 def compute_hull_spline2(snapshot):
     # Extract points
-    points = [(r["lat"], r["lon"]) for r in snapshot.reports]
+    points = [(r["lon"], r["lat"]) for r in snapshot.reports]
     if len(points) == 0:
         return np.array([[], []])
-    
-    # Buffer around each point to create small circles
-    radius_deg = 0.005
-    circles = [Point(lon, lat).buffer(radius_deg) for lat, lon in points]
-    unioned = unary_union(circles)
-
-    # Convex hull
-    hull = unioned.convex_hull
-
-    # If hull is a LineString (points are collinear), buffer it slightly
-    if isinstance(hull, LineString):
-        hull = hull.buffer(radius_deg)  # create a thin polygon around the line
-
-    # If hull is a MultiPolygon (disconnected blobs), take the largest
-    if isinstance(hull, MultiPolygon):
-        hull = max(hull.geoms, key=lambda p: p.area)
-
-    # Get boundary coords
-    if isinstance(hull, Polygon):
-        x_hull, y_hull = hull.exterior.xy
-    else:
-        # fallback (unlikely)
-        x_hull, y_hull = [], []
-
-    coords = np.array([x_hull, y_hull])
-    if coords.shape[1] < 3:
-        # not enough points for spline, just return coords
-        return coords
 
-    # Smooth spline
-    tck, u = splprep(coords, s=0.001, per=True)
-    spline_points = splev(np.linspace(0, 1, 200), tck)
-
-    return spline_points
+    # Hull of small circles around each point, smoothed by a spline
+    return list(smooth_hull(points).T)
 
 
 def compute_hull_splines(snapshots, reports):
   splines = []
 
   for snapshot in snapshots:
-    points = [(r["lat"], r["lon"]) for r in reports if r["id"] in snapshot["report_ids"]]
-
-    radius_deg = 0.005
-    circles = [Point(lon, lat).buffer(radius_deg) for lat, lon in points]
-    unioned = unary_union(circles)
-    hull = unioned.convex_hull
-
-    x_hull, y_hull = hull.exterior.xy
-    coords = np.array([x_hull, y_hull])
-    tck, u = splprep(coords, s=0.001, per=True)
-    spline_points = splev(np.linspace(0, 1, 200), tck)
-
-    splines.append(spline_points)
+    points = [(r["lon"], r["lat"]) for r in reports if r["id"] in snapshot["report_ids"]]
+    splines.append(list(smooth_hull(points).T))
 
   return splines
 
@@ -519,46 +467,18 @@ def plot_tsne_embeddings(reports, labels, perplexity=30, max_iter=1000, max_line
 
     from colorhash import ColorHash
 
-    def haversine(lat1, lon1, lat2, lon2):
-      """
-      Calculate the geographic distance between two points in meters using the Haversine formula.
-
-      Args:
-          lat1, lon1: Latitude and longitude of first point (degrees).
-          lat2, lon2: Latitude and longitude of second point (degrees).
-
-      Returns:
-          Distance in meters.
-      """
-
-      import math
-
-      R = 6371000  # Earth's radius in meters
-      lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-      dlat = lat2 - lat1
-      dlon = lon2 - lon1
-      a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-      c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-      return R * c
-
     # Extract embeddings
-    embeddings = []
-    valid_reports = []
-    valid_labels = []
-    for report, label in zip(reports, labels):
-        emb = decode_embedding(report["embedding"]) if isinstance(report["embedding"], str) else report["embedding"]
-        if emb is None or len(emb) != 768 or not all(isinstance(x, (int, float)) for x in emb):
-            print(f"Skipping report {report.get('id')}: Invalid embedding")
-            continue
-        embeddings.append(emb)
-        valid_reports.append(report)
-        valid_labels.append(label)
-
-    if not embeddings:
+    embeddings, valid = decode_embeddings([report["embedding"] for report in reports])
+    for report in (report for report, v in zip(reports, valid) if not v):
+        print(f"Skipping report {report.get('id')}: Invalid embedding")
+    valid_reports = [report for report, v in zip(reports, valid) if v]
+    valid_labels = [label for label, v in zip(labels, valid) if v]
+
+    if not valid_reports:
         print("No valid embeddings for visualization")
         return None
 
-    embeddings = np.array(embeddings, dtype=np.float64)
+    embeddings = embeddings[valid].astype(np.float64)
 
     # Apply t-SNE
     tsne = TSNE(n_components=3, perplexity=min(perplexity, len(embeddings)-1), max_iter=max_iter, random_state=42)
@@ -1,52 +1,78 @@
-import json
 import logging
 from grpc_reflection.v1alpha import reflection
 from dotenv import load_dotenv
 
 import argparse
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from functools import partial
 import grpc
+import os
 from pathlib import Path
-import pprint
 import pytz
 
 # Load the .env file from the project root
 env_path = Path(__file__).resolve().parents[1] / '.env'
 load_dotenv(dotenv_path=env_path)
 
+import models.outbreakml.backfill as backfill
 import models.outbreakml.db as db
 import models.outbreakml.embeddings as embeddings
+from models.outbreakml.embedding_store import default_store
 import models.outbreakml.cluster as cluster
+from models.outbreakml.jobs import ClusteringJobRunner
+import models.outbreakml.pipeline as pipeline
 import models.outbreakml.predict as predict
+import models.outbreakml.run_geojson as run_geojson
 import models.outbreakml.snapshots as snapshots
-from models.outbreakml.structures import TimedeltaSnapshot
 import models.outbreakml.visualize as visualize
 
 from generated.symptom_report_pb2 import SymptomReport
-from generated.ml_service_pb2 import FetchLatestDataRequest, FetchLatestDataResponse, GenerateSnapshotsRequest, GenerateSymptomReportRequest, GenerateSymptomReportResponse, ProcessClustersRequest, ProcessClustersResponse
+from generated.predicted_snapshot_pb2 import PredictedSnapshot
+from generated.snapshot_pb2 import Snapshot
+from generated.ml_service_pb2 import ClusteringStage, FetchClusteringStatusRequest, FetchClusteringStatusResponse, FetchLatestDataRequest, FetchLatestDataResponse, FetchSnapshotsRequest, FetchSnapshotsResponse, GenerateSnapshotsRequest, GenerateSnapshotsResponse, GenerateSymptomReportRequest, GenerateSymptomReportResponse, PredictEvolutionRequest, PredictEvolutionResponse, ProcessClustersRequest, ProcessClustersResponse
 from generated import ml_service_pb2, ml_service_pb2_grpc
 
+# Blocking Supabase and Gemini calls run in one thread pool, and clustering, snapshot generation
+# and forecasting in a second, smaller one. The event loop never blocks, and a clustering run
+# can't take the threads that FetchLatestData and the other lookups need.
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+COMPUTE_WORKERS = int(os.getenv("COMPUTE_WORKERS", "2"))
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="ml-io")
+compute_executor = ThreadPoolExecutor(max_workers=COMPUTE_WORKERS, thread_name_prefix="ml-compute")
+
+async def run_in(executor, fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args, **kwargs))
+
+# ProcessClusters runs one job at a time in the background, see jobs.py.
+clustering_jobs = ClusteringJobRunner(
+    partial(pipeline.process_clusters, eps_meters=5000, min_samples=3, max_time_gap_days=14),
+    compute_executor,
+    partial(db.create_clustering_run, eps_meters=5000, min_samples=3, max_time_gap_days=14),
+    db.set_clustering_run_status
+)
+
 class MLServicer(ml_service_pb2_grpc.MLServiceServicer):
-    def GenerateSymptomReport(self,
+    async def GenerateSymptomReport(self,
                          request: GenerateSymptomReportRequest,
                          context: grpc.aio.ServicerContext):
         try:
-            partial_symptom_report: SymptomReport = embeddings.infer_symptoms_and_cause(request.text)
+            partial_symptom_report: SymptomReport = await run_in(io_executor, embeddings.infer_symptoms_and_cause, request.text)
         except Exception as e:
-            return GenerateSymptomReportRequest(
+            return GenerateSymptomReportResponse(
                 success = False,
                 error = "Failed to infer symptoms and cause.",
                 report = None
             )
         
-        summary = embeddings.generate_summary(partial_symptom_report.symptoms, partial_symptom_report.cause)
+        summary = await run_in(io_executor, embeddings.generate_summary, partial_symptom_report.symptoms, partial_symptom_report.cause)
         
         try:
-            embedding = embeddings.generate_embeddings(summary)
+            embedding = await run_in(io_executor, embeddings.generate_embeddings, summary)
         except Exception as e:
-            return GenerateSymptomReportRequest(
+            return GenerateSymptomReportResponse(
                 success = False,
                 error = "Failed to generate embeddings.",
                 report = None
@@ -58,7 +84,7 @@ class MLServicer(ml_service_pb2_grpc.MLServiceServicer):
             lat = request.lat,
             lon = request.lon,
             summary = summary,
-            embedding = embedding,
+            embedding = embedding.astype("<f4").tobytes(),  # Raw little-endian float32, see decode_embeddings
         )
         
         return GenerateSymptomReportResponse(
@@ -68,94 +94,75 @@ class MLServicer(ml_service_pb2_grpc.MLServiceServicer):
         )
     
     
-    def ProcessClusters(self,
+    async def ProcessClusters(self,
                         request: ProcessClustersRequest,
                         context: grpc.aio.ServicerContext):  
-        # Execute the pipeline for clustering and snapshot generation.
-        # Fetch all reports
-        reports = db.fetch_all_reports()
+        # Start a background job for clustering and snapshot generation, or join the running one
+        # of the same mode. A request of the other mode is queued behind it.
+        # Incremental runs only cluster the reports no run has clustered yet.
+        job, coalesced = clustering_jobs.submit(incremental=request.incremental)
         
-        # Cluster the reports
-        labels, cluster_id_mapping = cluster.cluster_reports_with_id_management(
-            reports, 
-            eps_meters=5000, 
-            min_samples=3, 
-            max_time_gap_days=14
-        )
-        
-        print(f"Clustered {len(reports)} reports into {len(set(labels))} clusters.")
-        for report_id, label in zip([r['id'] for r in reports], labels):
-            cluster_id = cluster_id_mapping.get(label, f"temp_{label}")
-            print(f"Report ID: {report_id}, Label: {label}, Cluster ID: {cluster_id}")
-        
-        # Generate timedelta snapshots
-        timedelta_snapshots = snapshots.compute_snapshots_from_clusters(labels, reports, cluster_id_mapping)
-        pprint.pprint(timedelta_snapshots)
+        if request.wait:
+            await asyncio.wrap_future(job.future)
         
-        # Save TimedeltaSnapshots to database with versioning
-        run_id = db.save_timedelta_snapshots(
-            timedelta_snapshots,
-            eps_meters=5000,
-            min_samples=3,
-            max_time_gap_days=14,
-            total_reports=len(reports),
-            parameters={"cluster_id_mapping": cluster_id_mapping}
-        )   
+        return ProcessClustersResponse(
+            success = job.status != "failed",
+            error = job.error,
+            job_id = job.job_id,
+            coalesced = coalesced
+        )
+    
+    async def FetchClusteringStatus(self,
+                                    request: FetchClusteringStatusRequest,
+                                    context: grpc.aio.ServicerContext):
+        job = clustering_jobs.get(request.job_id)
         
-        print(f"\nSaved clustering run {run_id} with {len(timedelta_snapshots)} timedelta snapshots")
-        print(f"Total clusters: {sum(len(ts.snapshots) for ts in timedelta_snapshots)}")
+        if job is None:
+            return FetchClusteringStatusResponse(
+                success = False,
+                error = "No such clustering job."
+            )
         
-        return ProcessClustersResponse(
+        return FetchClusteringStatusResponse(
             success = True,
-            error = None,
+            job_id = job.job_id,
+            status = job.status,
+            incremental = job.incremental,
+            run_id = job.run_id or 0,
+            stage = job.stage,
+            stages = [
+                ClusteringStage(name = name, seconds = seconds, running = running)
+                for name, seconds, running in job.timings()
+            ],
+            created_at = self._datetime_to_timestamp(job.created_at),
+            started_at = self._datetime_to_timestamp(job.started_at),
+            finished_at = self._datetime_to_timestamp(job.finished_at)
         )
     
     
-    def FetchLatestData(self,
+    async def FetchLatestData(self,
                         request: FetchLatestDataRequest,
                         context: grpc.aio.ServicerContext):
-       
+        # The GeoJSON of a run is built once, when it is saved, and served from memory until
+        # a newer run completes. Clients that send its etag get not_modified instead.
         try:
-            # Fetch the latest TimedeltaSnapshots from the database
-            timedelta_snapshots = db.fetch_latest_timedelta_snapshots()
-            print("Found timedelta snapshots:")
-            print(timedelta_snapshots)
+            latest = await run_geojson.alatest_run_geojson(compute_executor)
             
-            if not timedelta_snapshots:
+            if latest is None:
                 return FetchLatestDataResponse(
                     time_window_start=None,
                     time_window_end=None,
                     geojson=None
                 )
             
-            # Convert TimedeltaSnapshots to GeoJSON
-            geojson_data = json.dumps(self._timedelta_snapshots_to_geojson(timedelta_snapshots))
-            print(geojson_data)
+            if request.etag == latest.etag:
+                return FetchLatestDataResponse(etag=latest.etag, not_modified=True)
             
-            # Get the time window from the latest snapshot
-            latest_snapshot = timedelta_snapshots[0]  # Assuming they're ordered by time
-            time_window_start = latest_snapshot.time_window_start
-            time_window_end = latest_snapshot.time_window_end
-            
-            # Convert timestamps to protobuf format
-            from google.protobuf.timestamp_pb2 import Timestamp
-            from datetime import datetime
-            
-            start_timestamp = Timestamp()
-            end_timestamp = Timestamp()
-            
-            # Parse ISO format timestamps
-            start_dt = datetime.fromisoformat(time_window_start.replace('Z', '+00:00'))
-            end_dt = datetime.fromisoformat(time_window_end.replace('Z', '+00:00'))
-            
-            start_timestamp.FromDatetime(start_dt)
-            end_timestamp.FromDatetime(end_dt)
-            
-            print("Sending FetchLatestDataResponse...")
             return FetchLatestDataResponse(
-                time_window_start=start_timestamp,
-                time_window_end=end_timestamp,
-                geojson=geojson_data
+                time_window_start=self._iso_to_timestamp(latest.time_window_start) if latest.time_window_start else None,
+                time_window_end=self._iso_to_timestamp(latest.time_window_end) if latest.time_window_end else None,
+                geojson=latest.geojson,
+                etag=latest.etag
             )
             
         except Exception as e:
@@ -166,56 +173,131 @@ class MLServicer(ml_service_pb2_grpc.MLServiceServicer):
                 geojson=None
             )
     
-    def _timedelta_snapshots_to_geojson(self, timedelta_snapshots: TimedeltaSnapshot):
-        """Convert TimedeltaSnapshot to GeoJSON format with spline boundaries."""
-        from models.outbreakml.splines import compute_hull_spline
+    async def PredictEvolution(self,
+                         request: PredictEvolutionRequest,
+                         context: grpc.aio.ServicerContext):
+        # Forecast a single cluster from its snapshots in the requested window.
+        # Repeated requests for the same cluster, window and steps are served from memory.
+        try:
+            predicted_snapshots = await run_in(
+                compute_executor,
+                predict.predict_evolution,
+                request.cluster_id,
+                start_time = request.start_date.ToDatetime(tzinfo=timezone.utc) if request.HasField("start_date") else None,
+                end_time = request.end_date.ToDatetime(tzinfo=timezone.utc) if request.HasField("end_date") else None,
+                forecast_steps = request.forecast_steps or 1
+            )
+            
+            return PredictEvolutionResponse(
+                predictions = [ self._predicted_snapshot_to_proto(p) for p in predicted_snapshots ]
+            )
+            
+        except Exception as e:
+            print(f"Error in PredictEvolution: {e}")
+            return PredictEvolutionResponse(predictions = [])
+    
+    async def FetchSnapshots(self,
+                       request: FetchSnapshotsRequest,
+                       context: grpc.aio.ServicerContext):
+        # Stream the stored snapshots of the latest run in the window, one page per message,
+        # so long histories are never held in memory at once.
+        try:
+            pages = db.aiter_snapshot_pages(
+                start_time = self._timestamp_to_iso(request, "start_date"),
+                end_time = self._timestamp_to_iso(request, "end_date"),
+                cluster_id = request.cluster_id if request.HasField("cluster_id") else None
+            )
+            async for page in pages:
+                yield FetchSnapshotsResponse(
+                    snapshots = [ self._snapshot_to_proto(s) for s in page ]
+                )
+                
+        except Exception as e:
+            print(f"Error in FetchSnapshots: {e}")
+            # End the stream with an error, so clients can tell a failure from a short history.
+            await context.abort(grpc.StatusCode.INTERNAL, str(e))
+    
+    async def GenerateSnapshots(self,
+                          request: GenerateSnapshotsRequest,
+                          context: grpc.aio.ServicerContext):
+        # Cluster the reports in the window without saving a run, and stream the snapshots
+        # one time window per message.
+        try:
+            timedelta_snapshots = await run_in(
+                compute_executor,
+                pipeline.generate_snapshots,
+                start_timestamp = self._timestamp_to_iso(request, "start_date"),
+                end_timestamp = self._timestamp_to_iso(request, "end_date"),
+                eps_meters = 5000,
+                min_samples = 3,
+                max_time_gap_days = 14
+            )
+            for timedelta_snapshot in timedelta_snapshots:
+                yield GenerateSnapshotsResponse(
+                    snapshots = [ self._snapshot_to_proto(s) for s in timedelta_snapshot.snapshots ]
+                )
+                
+        except Exception as e:
+            print(f"Error in GenerateSnapshots: {e}")
+            # End the stream with an error, so clients can tell a failure from a short history.
+            await context.abort(grpc.StatusCode.INTERNAL, str(e))
+    
+    def _timestamp_to_iso(self, request, field):
+        if not request.HasField(field):
+            return None
+        return getattr(request, field).ToDatetime(tzinfo=timezone.utc).isoformat()
+    
+    def _snapshot_to_proto(self, cluster_snapshot):
+        return Snapshot(
+            cluster_id = str(cluster_snapshot.cluster_id),
+            centroid = [ float(c) for c in cluster_snapshot.centroid ],
+            avg_embedding = [ float(v) for v in cluster_snapshot.avg_embedding ],
+            report_ids = [ int(rid) for rid in cluster_snapshot.report_ids ],
+            common_symptoms = self._symptoms_to_struct(cluster_snapshot.common_symptoms),
+            time_window_start = self._iso_to_timestamp(cluster_snapshot.time_window_start),
+            time_window_end = self._iso_to_timestamp(cluster_snapshot.time_window_end)
+        )
+    
+    def _predicted_snapshot_to_proto(self, predicted_snapshot):
+        return PredictedSnapshot(
+            cluster_id = str(predicted_snapshot.cluster_id),
+            centroid = [ float(c) for c in predicted_snapshot.centroid ],
+            avg_embedding = [ float(v) for v in predicted_snapshot.avg_embedding ],
+            report_count = [ int(predicted_snapshot.report_count) ],
+            common_symptoms = self._symptoms_to_struct(predicted_snapshot.common_symptoms),
+            time_window_start = self._iso_to_timestamp(predicted_snapshot.time_window_start),
+            time_window_end = self._iso_to_timestamp(predicted_snapshot.time_window_end),
+            intensity = float(predicted_snapshot.intensity)
+        )
+    
+    def _symptoms_to_struct(self, common_symptoms):
+        from google.protobuf.struct_pb2 import Struct
+        
+        # Snapshots list their common symptoms, predictions aggregate them in a dict.
+        struct = Struct()
+        struct.update(common_symptoms if isinstance(common_symptoms, dict) else {"symptoms": list(common_symptoms or [])})
+        return struct
+    
+    def _datetime_to_timestamp(self, value):
+        if value is None:
+            return None
         
-        features = []
+        from google.protobuf.timestamp_pb2 import Timestamp
         
-        for timedelta_snapshot in timedelta_snapshots:
-            for cluster_snapshot in timedelta_snapshot.snapshots:
-                # Create spline boundary for the cluster
-                try:
-                    spline_points = compute_hull_spline(cluster_snapshot)
-                    
-                    geometry = {
-                        "type": "Polygon",
-                        "coordinates": spline_points
-                    }
-                        
-                except Exception as e:
-                    # Fallback to point if spline computation fails
-                    print(f"Warning: Could not compute spline for cluster {cluster_snapshot.cluster_id}: {e}")
-                    
-                # Create GeoJSON feature for each cluster
-                feature = {
-                    "type": "Feature",
-                    "properties": {
-                        "cluster_id": cluster_snapshot.cluster_id,
-                        "time_window_start": timedelta_snapshot.time_window_start,
-                        "time_window_end": timedelta_snapshot.time_window_end,
-                        "timedelta": timedelta_snapshot.timedelta,
-                        "report_count": len(cluster_snapshot.report_ids),
-                        "common_symptoms": cluster_snapshot.common_symptoms,
-                        "centroid": cluster_snapshot.centroid,
-                    },
-                    "geometry": geometry
-                }
-                    
-                features.append(feature)
+        timestamp = Timestamp()
+        timestamp.FromDatetime(value)
+        return timestamp
+    
+    def _iso_to_timestamp(self, iso_time):
+        from google.protobuf.timestamp_pb2 import Timestamp
         
-        return {
-            "type": "FeatureCollection",
-            "features": features,
-            "metadata": {
-                "total_clusters": len(features),
-                "generated_at": datetime.now(timezone.utc).isoformat()
-            }
-        }
+        timestamp = Timestamp()
+        timestamp.FromDatetime(datetime.fromisoformat(iso_time.replace('Z', '+00:00')))
+        return timestamp
 
 async def main(args):
     if args.plot:
-        reports = db.fetch_all_reports()
+        reports = db.fetch_all_report_batches(embedding_store=default_store())
 
         # Use the new cluster ID management system
         labels, cluster_id_mapping = cluster.cluster_reports_with_id_management(
@@ -231,11 +313,9 @@ async def main(args):
             print(f"Report ID: {report_id}, Label: {label}, Cluster ID: {cluster_id}")
             
         timedelta_snapshots = snapshots.compute_snapshots_from_clusters(labels, reports, cluster_id_mapping)
-        pprint.pprint(timedelta_snapshots)
 
         computed_snapshots = [ s for ts in timedelta_snapshots for s in ts.snapshots ]
-        predicted_snapshots = predict.predict_future_snapshots(computed_snapshots)
-        pprint.pprint(predicted_snapshots)
+        predicted_snapshots = await asyncio.to_thread(predict.predict_future_snapshots, computed_snapshots)
 
         all_snapshots = computed_snapshots + predicted_snapshots
         visualize.plot(all_snapshots)
@@ -252,6 +332,7 @@ async def main(args):
         
         # Save predicted snapshots
         db.save_predicted_snapshots(predicted_snapshots, run_id)
+        run_geojson.publish_run(run_id, timedelta_snapshots)
         
         print(f"\nSaved clustering run {run_id} with {len(timedelta_snapshots)} timedelta snapshots")
         print(f"Total clusters: {sum(len(ts.snapshots) for ts in timedelta_snapshots)}")
@@ -260,7 +341,14 @@ async def main(args):
         return
     
     if args.process:
-        res = MLServicer().ProcessClusters(ProcessClustersRequest(), None)
+        res = await MLServicer().ProcessClusters(ProcessClustersRequest(incremental=args.incremental, wait=True), None)
+        if not res.success:
+            print(f"Clustering failed: {res.error}")
+        return
+
+    if args.backfill:
+        backfill.backfill_summaries()
+        await asyncio.to_thread(backfill.backfill_embeddings)
         return
     
     print("Initializing VigilML service...")
@@ -286,6 +374,8 @@ def parse_args():
     
     parser.add_argument('--plot', action='store_true', help='Show a plot of the clusters and snapshots.')
     parser.add_argument('--process', action='store_true', help='Process the clusters and snapshots.')
+    parser.add_argument('--incremental', action='store_true', help='Only process reports submitted since the last run.')
+    parser.add_argument('--backfill', action='store_true', help='Backfill missing report summaries and embeddings.')
     
     return parser.parse_args()
 
@@ -0,0 +1,33 @@
+"""
+Geometry shared by the analytics and ML services.
+
+The source lives in shared/python/geo and is copied into each service by
+`make geo-py`, like the generated protobuf code, so both services compute distances
+and cluster regions the same way. Functions are vectorized over NumPy arrays.
+"""
+
+from .hull import circle_vertices, offset_hull, smooth_hull
+from .polygon import convex_hull, polygon_area, polygon_centroid
+from .sphere import (
+    EARTH_RADIUS_M,
+    from_unit_sphere,
+    haversine,
+    haversine_rad,
+    meters_to_chord,
+    to_unit_sphere,
+)
+
+__all__ = [
+    "EARTH_RADIUS_M",
+    "circle_vertices",
+    "convex_hull",
+    "from_unit_sphere",
+    "haversine",
+    "haversine_rad",
+    "meters_to_chord",
+    "offset_hull",
+    "polygon_area",
+    "polygon_centroid",
+    "smooth_hull",
+    "to_unit_sphere",
+]
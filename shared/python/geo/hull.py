@@ -0,0 +1,90 @@
+import numpy as np
+from scipy.interpolate import splev, splprep
+from scipy.spatial import QhullError
+
+from .polygon import convex_hull
+
+
+def circle_vertices(radius: float, segments: int = 64) -> np.ndarray:
+    """
+    Vertices of a circle around the origin as a regular polygon, counterclockwise from
+    (radius, 0). 64 segments are the 16 per quadrant shapely buffers points with.
+    """
+    angles = np.arange(segments) * (2 * np.pi / segments)
+    return radius * np.column_stack([ np.cos(angles), np.sin(angles) ])
+
+def _from_bottom(polygon: np.ndarray) -> np.ndarray:
+    """Counterclockwise vertices rolled to start at the lowest one (then leftmost)."""
+    return np.roll(polygon, -np.lexsort((polygon[:, 0], polygon[:, 1]))[0], axis=0)
+
+def _edges(polygon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Non-zero edges of a closed polygon and their angles in [0, 2π)."""
+    edges = np.roll(polygon, -1, axis=0) - polygon
+    edges = edges[np.any(edges != 0, axis=1)]
+    return edges, np.arctan2(edges[:, 1], edges[:, 0]) % (2 * np.pi)
+
+def offset_hull(points: np.ndarray, radius: float, segments: int = 64) -> np.ndarray:
+    """
+    Convex hull of circles of the given radius around [n, 2] points, computed
+    analytically.
+
+    This is the Minkowski sum of the points' convex hull and the circle polygon. Both
+    are convex, so their sum is walked by merging their edges by angle, in
+    O(h + segments) for h hull vertices, instead of buffering every point and taking
+    the hull of their union.
+
+    Returns:
+        Vertices of the region, clockwise from the lowest one, as shapely's
+        convex_hull orders them
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        raise ValueError("At least 1 point is required to offset a hull")
+    try:
+        hull = convex_hull(points)
+    except (QhullError, ValueError):
+        # Fewer than 3 points, or all on a line: the hull is the segment between the
+        # extremes
+        order = np.lexsort((points[:, 1], points[:, 0]))
+        hull = np.unique(points[order[[0, -1]]], axis=0)
+
+    hull, circle = _from_bottom(hull), _from_bottom(circle_vertices(radius, segments))
+    hull_edges, hull_angles = _edges(hull)
+    circle_edges, circle_angles = _edges(circle)
+    order = np.argsort(np.concatenate([hull_angles, circle_angles]), kind="stable")
+    edges = np.concatenate([hull_edges, circle_edges])[order]
+
+    # The sum starts at the sum of the lowest vertices, then follows the merged edges
+    steps = np.concatenate([np.zeros((1, 2)), np.cumsum(edges[:-1], axis=0)])
+    vertices = hull[0] + circle[0] + steps
+
+    # Drop the vertices between parallel edges
+    before = vertices - np.roll(vertices, 1, axis=0)
+    after = np.roll(vertices, -1, axis=0) - vertices
+    cross = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0]
+    lengths = np.hypot(*before.T) * np.hypot(*after.T)
+    vertices = vertices[np.abs(cross) > 1e-12 * lengths]
+
+    return np.concatenate([vertices[:1], vertices[:0:-1]])
+
+def smooth_hull(
+    points: np.ndarray,
+    radius: float = 0.005,
+    smoothing: float = 0.001,
+    num_points: int = 200
+) -> np.ndarray:
+    """
+    Smoothed region around [n, 2] points: the convex hull of circles of the given
+    radius around them (see offset_hull), interpolated by a periodic spline.
+
+    Cluster boundaries use lon/lat points and the default radius in degrees.
+
+    Returns:
+        [num_points, 2] vertices of the smoothed region, in the units of points
+    """
+    region = offset_hull(points, radius)
+
+    # Spline smoothing, over the closed ring
+    coords = np.concatenate([region, region[:1]]).T
+    tck, u = splprep(coords, s=smoothing, per=True)
+    return np.column_stack(splev(np.linspace(0, 1, num_points), tck))
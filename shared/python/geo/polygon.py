@@ -0,0 +1,44 @@
+import numpy as np
+from scipy.spatial import ConvexHull
+
+
+def convex_hull(points: np.ndarray) -> np.ndarray:
+    """
+    Vertices of the convex hull of [n, 2] points, counterclockwise.
+
+    Raises:
+        QhullError, ValueError: For fewer than 3 points, or points on a line
+    """
+    return points[ConvexHull(points).vertices]
+
+def polygon_area(vertices: np.ndarray) -> float:
+    """
+    Area of a polygon from its [n, 2] ordered vertices, by the shoelace formula.
+    The first vertex may be repeated at the end.
+    """
+    if len(vertices) < 3:
+        return 0.0
+
+    # Around the mean vertex, so large projected coordinates don't cancel out.
+    x = vertices[:, 0] - vertices[:, 0].mean()
+    y = vertices[:, 1] - vertices[:, 1].mean()
+
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+def polygon_centroid(vertices: np.ndarray) -> np.ndarray:
+    """
+    Centroid of the area of a polygon, from its [n, 2] ordered vertices.
+    Falls back to the mean vertex for a degenerate polygon.
+    """
+    mean = vertices.mean(axis=0)
+    x = vertices[:, 0] - mean[0]
+    y = vertices[:, 1] - mean[1]
+    x_next, y_next = np.roll(x, -1), np.roll(y, -1)
+
+    cross = x * y_next - x_next * y
+    area = cross.sum() / 2
+    if area == 0:
+        return mean
+
+    moments = np.array([ np.dot(x + x_next, cross), np.dot(y + y_next, cross) ])
+    return mean + moments / (6 * area)
@@ -0,0 +1,49 @@
+import numpy as np
+
+# Mean Earth radius, in meters.
+EARTH_RADIUS_M = 6_371_000.0
+
+def haversine_rad(lat1, lon1, lat2, lon2):
+    """
+    Great-circle angles in radians between points given in radians, broadcast like
+    NumPy operands.
+    """
+    h = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def haversine(lat1, lon1, lat2, lon2, radius: float = EARTH_RADIUS_M):
+    """
+    Great-circle distances in meters between points given in degrees.
+
+    Takes scalars or arrays, broadcast like NumPy operands, e.g. one point against
+    many. Returns a float for scalars.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2)
+    )
+    distance = radius * haversine_rad(lat1, lon1, lat2, lon2)
+    return float(distance) if np.ndim(distance) == 0 else distance
+
+def to_unit_sphere(lat, lon) -> np.ndarray:
+    """[3, ...] x/y/z coordinates on the unit sphere of points given in degrees."""
+    lat_rad = np.radians(lat)
+    lon_rad = np.radians(lon)
+    return np.array([
+        np.cos(lat_rad) * np.cos(lon_rad),
+        np.cos(lat_rad) * np.sin(lon_rad),
+        np.sin(lat_rad)
+    ])
+
+def from_unit_sphere(x, y, z):
+    """
+    Latitudes and longitudes in degrees of points on the unit sphere, inverse of
+    to_unit_sphere.
+    """
+    return np.degrees(np.arcsin(z)), np.degrees(np.arctan2(y, x))
+
+def meters_to_chord(meters, radius: float = EARTH_RADIUS_M):
+    """Length on the unit sphere of the chord under an arc of the given meters."""
+    return 2 * np.sin(np.asarray(meters) / (2 * radius))
@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import argparse
+import time
+
+import numpy as np
+from check_geo import legacy_haversine, legacy_polygon_area, legacy_smooth_hull
+
+import geo
+
+# Benchmarks the shared geo package against the implementations it replaced in the
+# services (see check_geo), on 10 to 100k points:
+#   haversine:   a Python loop over the scalar function, against one batched call.
+#   smooth_hull: a shapely circle around every point unioned before taking the hull,
+#                against the hull of the points offset analytically.
+#   polygon_area: the shoelace sum as a Python generator, against the NumPy one.
+
+def legacy_haversines(lat1, lon1, lat2, lon2):
+    return [ legacy_haversine(*p) for p in zip(lat1, lon1, lat2, lon2) ]
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def row(name: str, n: int, legacy: float, kernel: float):
+    print(
+        f"{name:<14} {n:>8} {legacy:>12.5f} {kernel:>12.5f} {legacy / kernel:>9.1f}x"
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the shared geo package."
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10, 100, 1_000, 10_000, 100_000]
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(
+        f"{'kernel':<14} {'points':>8} {'legacy (s)':>12} {'geo (s)':>12} "
+        f"{'speedup':>10}"
+    )
+
+    for n in args.sizes:
+        repeat = 1 if n >= 10_000 else 3
+        lat1, lat2 = rng.uniform(-60, 60, (2, n))
+        lon1, lon2 = rng.uniform(-180, 180, (2, n))
+        row("haversine", n,
+            timed(legacy_haversines, lat1, lon1, lat2, lon2, repeat=repeat),
+            timed(geo.haversine, lat1, lon1, lat2, lon2))
+
+        points = rng.normal(0, 0.02, (n, 2)) + [ -47.85, -23.35 ]
+        row("smooth_hull", n,
+            timed(legacy_smooth_hull, points, repeat=repeat),
+            timed(geo.smooth_hull, points))
+
+        angles = np.linspace(0, 2 * np.pi, n)
+        polygon = np.column_stack([ np.cos(angles), np.sin(angles) ]) * 1e5
+        row("polygon_area", n,
+            timed(legacy_polygon_area, polygon, repeat=repeat),
+            timed(geo.polygon_area, polygon))
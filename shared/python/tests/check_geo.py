@@ -0,0 +1,183 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import argparse
+import math
+
+import numpy as np
+from scipy.interpolate import splev, splprep
+from shapely.geometry import MultiPoint, Point, Polygon
+from shapely.ops import unary_union
+
+import geo
+
+# Numeric equivalence of geo with the implementations it replaced in the services:
+#   haversine: the scalar functions of analytics calcs, ml helpers and visualize, and
+#              the radian distances of the analytics neighbour graph.
+#   to_unit_sphere / from_unit_sphere: ml helpers.
+#   offset_hull / smooth_hull: the convex hull of the union of a shapely circle around
+#              every point, smoothed by a spline, as in analytics calcs, ml splines
+#              and visualize.
+#   polygon_area / polygon_centroid: the shoelace sum of analytics calcs and shapely's
+#              centroid.
+# Exits with an error on the first mismatch.
+
+def legacy_haversine(lat1, lon1, lat2, lon2):
+    R = 6371000  # Radius of Earth in meters
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
+    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+def legacy_smooth_hull(points: np.ndarray):
+    hull = unary_union([ Point(x, y).buffer(0.005) for x, y in points ]).convex_hull
+    x, y = hull.exterior.xy
+    tck, u = splprep(np.array([x, y]), s=0.001, per=True)
+    return hull, np.column_stack(splev(np.linspace(0, 1, 200), tck))
+
+def legacy_polygon_area(vertices: np.ndarray) -> float:
+    x, y = vertices[:, 0], vertices[:, 1]
+    return 0.5 * abs(
+        sum(x[i] * y[i + 1] - x[i + 1] * y[i] for i in range(-1, len(x) - 1))
+    )
+
+def relative_difference(expected, region: np.ndarray) -> float:
+    """Area of the symmetric difference of a shapely polygon and a region, relative."""
+    return expected.symmetric_difference(Polygon(region)).area / expected.area
+
+def check(name: str, error: float, tolerance: float):
+    print(f"{name:<40} {error:>12.3e}  (tolerance {tolerance:.0e})")
+    assert error <= tolerance, f"{name} differs by {error}"
+
+def check_haversine(rng: np.random.Generator, n: int):
+    lat1, lat2 = rng.uniform(-89, 89, (2, n))
+    lon1, lon2 = rng.uniform(-180, 180, (2, n))
+    # Half of the pairs nearby, at the scale of clusters
+    lat2[::2] = lat1[::2] + rng.normal(0, 0.01, len(lat1[::2]))
+    lon2[::2] = lon1[::2] + rng.normal(0, 0.01, len(lon1[::2]))
+
+    expected = np.array([ legacy_haversine(*p) for p in zip(lat1, lon1, lat2, lon2) ])
+    distances = geo.haversine(lat1, lon1, lat2, lon2)
+    check("haversine, batched (m)", np.abs(distances - expected).max(), 1e-6)
+
+    scalar = geo.haversine(lat1[0], lon1[0], lat2[0], lon2[0])
+    check("haversine, scalar (m)", abs(scalar - expected[0]), 1e-6)
+
+    one_to_many = geo.haversine(lat1[0], lon1[0], lat2, lon2)
+    expected_one_to_many = [
+        legacy_haversine(lat1[0], lon1[0], a, b) for a, b in zip(lat2, lon2)
+    ]
+    check(
+        "haversine, one to many (m)",
+        np.abs(one_to_many - expected_one_to_many).max(),
+        1e-6
+    )
+
+    angles = geo.haversine_rad(*np.radians([ lat1, lon1, lat2, lon2 ]))
+    angle_error = np.abs(angles * geo.EARTH_RADIUS_M - expected).max()
+    check("haversine_rad (rad)", angle_error / geo.EARTH_RADIUS_M, 1e-12)
+
+    # The chord of eps, which neighbour searches on the unit sphere use, bounds its
+    # haversine neighbours
+    xyz1, xyz2 = geo.to_unit_sphere(lat1, lon1), geo.to_unit_sphere(lat2, lon2)
+    chords = np.linalg.norm(xyz1 - xyz2, axis=0)
+    chord_error = np.abs(geo.meters_to_chord(expected) - chords).max()
+    check("meters_to_chord (unit)", chord_error, 1e-9)
+
+def check_unit_sphere(rng: np.random.Generator, n: int):
+    lat = rng.uniform(-89, 89, n)
+    lon = rng.uniform(-180, 180, n)
+    xyz = geo.to_unit_sphere(lat, lon)
+    expected = np.array([
+        [
+            math.cos(math.radians(a)) * math.cos(math.radians(b)),
+            math.cos(math.radians(a)) * math.sin(math.radians(b)),
+            math.sin(math.radians(a))
+        ]
+        for a, b in zip(lat, lon)
+    ]).T
+    check("to_unit_sphere", np.abs(xyz - expected).max(), 1e-15)
+    back_lat, back_lon = geo.from_unit_sphere(*xyz)
+    back_error = max(np.abs(back_lat - lat).max(), np.abs(back_lon - lon).max())
+    check("from_unit_sphere (deg)", back_error, 1e-9)
+
+def check_hulls(rng: np.random.Generator, trials: int):
+    region_error = spline_error = 0.0
+    collinear = 0
+    for trial in range(trials):
+        n = int(rng.integers(3, 200))
+        spread = rng.choice([ 0.002, 0.01, 0.05 ])
+        points = rng.normal(0, spread, (n, 2)) + [ -47.85, -23.35 ]
+        if trial % 5 == 0:
+            # Reports at the same coordinates
+            points = np.round(points, 3)
+
+        hull, expected = legacy_smooth_hull(points)
+        region = geo.offset_hull(points, 0.005)
+        region_error = max(region_error, relative_difference(hull, region))
+        if len(hull.exterior.coords) - 1 != len(region):
+            # GEOS can keep vertices on the straight edges between points on a line,
+            # which offset_hull drops. The ring is the same but the spline is fit to
+            # other vertices.
+            collinear += 1
+            continue
+        spline_error = max(
+            spline_error, np.abs(geo.smooth_hull(points) - expected).max()
+        )
+
+    check("offset_hull (relative area difference)", region_error, 1e-9)
+    check(f"smooth_hull (deg, {trials - collinear} same rings)", spline_error, 1e-9)
+
+    # Degenerate inputs: one point and points on a line, where the hull is a circle or
+    # a stadium
+    degenerate = (
+        [ [ -47.85, -23.35 ] ],
+        [ [ -47.85, -23.35 ], [ -47.84, -23.34 ] ],
+        [ [ -47.85 + t, -23.35 + 0.5 * t ] for t in np.linspace(0, 0.02, 20) ]
+    )
+    for points in degenerate:
+        points = np.array(points)
+        expected = MultiPoint(points).buffer(0.005).convex_hull
+        check(
+            f"offset_hull, degenerate ({len(points)} points)",
+            relative_difference(expected, geo.offset_hull(points, 0.005)),
+            1e-9
+        )
+
+def check_polygons(rng: np.random.Generator, trials: int):
+    area_error = centroid_error = 0.0
+    for _ in range(trials):
+        n = int(rng.integers(3, 500))
+        points = rng.normal(0, 1000, (n, 2)) + rng.uniform(-1e7, 1e7, 2)
+        vertices = geo.convex_hull(points)
+        polygon = Polygon(vertices)
+        area = geo.polygon_area(vertices)
+        area_error = max(
+            area_error, abs(area - legacy_polygon_area(vertices)) / polygon.area
+        )
+        centroid = geo.polygon_centroid(vertices)
+        centroid_error = max(
+            centroid_error,
+            np.abs(centroid - np.array(polygon.centroid.coords[0])).max()
+        )
+
+    check("polygon_area (relative)", area_error, 1e-6)
+    check("polygon_centroid (units)", centroid_error, 1e-6)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Numeric equivalence checks of the shared geo package."
+    )
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    check_haversine(rng, 10_000)
+    check_unit_sphere(rng, 10_000)
+    check_hulls(rng, args.trials)
+    check_polygons(rng, args.trials)
+    print("All checks passed")